@@ -0,0 +1,197 @@
+"""
+Benchmarks of typical pipelines, run against recorded
+api responses (see playlistcake.replay) so results are
+repeatable and need no network.
+
+Record the responses once with a live token:
+
+    PLAYLISTCAKE_TEST_TOKEN="{...}" python benchmarks.py --record
+
+Then run the benchmarks offline:
+
+    python benchmarks.py --latency 0.05 --save results.json
+    python benchmarks.py --compare results.json
+
+Or against a local fake api (see playlistcake.fakeserver)
+with a synthetic library:
+
+    python benchmarks.py --fake --latency 0.05
+
+--compare exits with status 1 if a benchmark makes more api
+requests than in the saved results, or gets slower or uses
+more memory by more than --tolerance.
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+from collections import Counter
+
+from playlistcake import cache, sessionenv
+from playlistcake.fakeserver import FakeSpotifyServer
+from playlistcake.ratelimit import Scheduler
+from playlistcake.replay import ReplaySession
+from playlistcake.spotify import (
+    set_session_token, set_scheduler, get_spotify)
+
+
+def library_features():
+    from playlistcake.library import saved_tracks
+    from playlistcake.filters import tracks_filter_tuneables
+    from playlistcake.sources import sort
+    tracks = saved_tracks(max_results=500, track_only=True)
+    tracks = tracks_filter_tuneables(
+        tracks, min_energy=0.3, max_energy=0.9, target_valence=0.5)
+    tracks = sort(tracks, lambda t: t['audio_features']['tempo'])
+    return list(tracks)
+
+
+def batch_recommendations():
+    from playlistcake.library import saved_artists
+    from playlistcake.recommendations import batch_recommendations
+    artists = saved_artists(max_results=50)
+    return list(batch_recommendations(artists, max_per_seed=20))
+
+
+def artist_fanout():
+    from playlistcake.library import followed_artists
+    from playlistcake.sources import (
+        artists_albums, artists_top_tracks, tracks_from_albums, alternate)
+    artists = list(followed_artists(max_results=20))
+    albums = artists_albums(artists, workers=4)
+    return list(alternate(
+        tracks_from_albums(albums, full=False),
+        artists_top_tracks(artists, workers=4)))
+
+
+BENCHMARKS = [
+    library_features,
+    batch_recommendations,
+    artist_fanout,
+]
+
+
+def run_benchmark(func, request_counts):
+    """
+    Run func with an empty cache, returns a dict
+    of wall time, api requests and peak memory.
+    request_counts returns a Counter of requests
+    made so far per endpoint.
+    """
+    cache.set_cache(cache.default_cache())
+    before = request_counts()
+    tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        items = func()
+        elapsed = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    counts = request_counts() - before
+    return {'seconds': round(elapsed, 4),
+            'requests': sum(counts.values()),
+            'endpoints': dict(counts),
+            'peak_memory': peak,
+            'items': len(items)}
+
+
+def compare(results, baseline, tolerance):
+    """
+    Returns a list of regressions of results against baseline.
+    """
+    problems = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        if result['requests'] > base['requests']:
+            problems.append('{}: {} requests, was {}'.format(
+                name, result['requests'], base['requests']))
+        for field in ('seconds', 'peak_memory'):
+            if result[field] > base[field]*(1 + tolerance):
+                problems.append('{}: {} {}, was {}'.format(
+                    name, field, result[field], base[field]))
+    return problems
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--cassette', default='benchmarks.json',
+                        help='file with recorded responses')
+    parser.add_argument('--record', action='store_true',
+                        help='record responses using PLAYLISTCAKE_TEST_TOKEN')
+    parser.add_argument('--fake', action='store_true',
+                        help='run against a local fake api')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='seconds added to each request')
+    parser.add_argument('--jitter', type=float, default=0)
+    parser.add_argument('--save', help='write results to this json file')
+    parser.add_argument('--compare', help='json results to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    parser.add_argument('names', nargs='*',
+                        help='benchmarks to run (default all)')
+    args = parser.parse_args(argv)
+
+    server = session = None
+    if args.fake:
+        server = FakeSpotifyServer(
+            latency=args.latency, jitter=args.jitter).start()
+        token = server.token()
+        sessionenv.set('spotify_kwargs', server.spotify_kwargs())
+
+        def request_counts():
+            return Counter({endpoint: m['requests']
+                            for endpoint, m in server.metrics().items()})
+    else:
+        if args.record:
+            token = eval(os.getenv('PLAYLISTCAKE_TEST_TOKEN'))
+            session = ReplaySession(args.cassette, mode='record')
+        else:
+            token = {'access_token': 'replay', 'refresh_token': None,
+                     'expires_at': time.time() + 24*3600}
+            session = ReplaySession(args.cassette, latency=args.latency,
+                                    jitter=args.jitter)
+        sessionenv.set('spotify_kwargs', {'requests_session': session})
+
+        def request_counts():
+            return Counter(session.counts)
+    # Replayed and fake requests are not rate limited
+    set_scheduler(Scheduler(rate=None))
+    set_session_token(token)
+    get_spotify().trace_out = False
+
+    results = {}
+    for func in BENCHMARKS:
+        if args.names and func.__name__ not in args.names:
+            continue
+        if session:
+            session.rewind()
+        result = results[func.__name__] = run_benchmark(
+            func, request_counts)
+        print('{:<24} {:>8.3f}s {:>6} requests {:>10.1f} KiB peak'.format(
+            func.__name__, result['seconds'], result['requests'],
+            result['peak_memory']/1024))
+
+    if args.record:
+        session.save()
+    if server:
+        server.stop()
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            problems = compare(results, json.load(f), args.tolerance)
+        for problem in problems:
+            print('REGRESSION', problem)
+        return 1 if problems else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,91 @@
+"""
+Async versions of the filters in playlistcake.filters.
+"""
+
+from ..filters import compile_tuneables, release_year
+from ..genutils import content_type, infer_content
+from ..dedup import seen_set
+from .sources import several_albums, with_audio_features
+from .util import aiterate, aiter_chunked
+
+
+@infer_content
+async def tracks_filter_tuneables(tracks, invert=False, margins=None,
+                                  missing='exclude', **tuneables):
+    """
+    Async version of filters.tracks_filter_tuneables.
+    """
+    predicate = compile_tuneables(margins, missing, **tuneables)
+    async for chunk in aiter_chunked(with_audio_features(tracks), 100):
+        for track, is_match in zip(chunk, predicate.batch(chunk)):
+            if is_match != invert:
+                yield track
+
+
+async def _albums_filter_release_years(albums, start=1990, end=2000,
+                                       invert=False):
+    async for album in aiterate(albums):
+        if (start <= release_year(album) <= end) != invert:
+            yield album
+
+
+async def _tracks_filter_release_years(tracks, start=1990, end=2000,
+                                       invert=False):
+    """
+    Async version of filters._tracks_filter_release_years.
+    """
+    async for chunk in aiter_chunked(tracks, 20):
+        missing = [track['album']['id'] for track in chunk
+                   if 'release_date' not in track['album']]
+        albums = {}
+        if missing:
+            albums = {album['id']: album
+                      async for album in several_albums(missing) if album}
+        for track in chunk:
+            album = track['album']
+            if 'release_date' not in album:
+                album = albums.get(album['id'])
+                if album is None:
+                    continue
+            if (start <= release_year(album) <= end) != invert:
+                yield track
+
+
+@infer_content
+async def filter_release_years(items, start=1990, end=2000, invert=False):
+    ctype = content_type(items)
+    if ctype == 'albums':
+        func = _albums_filter_release_years
+    elif ctype == 'tracks':
+        func = _tracks_filter_release_years
+    else:
+        raise ValueError('arg items must contain track or album objects.')
+    async for item in func(items, start, end, invert):
+        yield item
+
+
+@infer_content
+async def filter_unique(tracks, mode='exact', **options):
+    """
+    Async version of filters.filter_unique.
+    """
+    seen = seen_set(mode, **options)
+    async for track in aiterate(tracks):
+        if seen.add(track['id']):
+            yield track
+
+
+@infer_content
+async def tracks_filter_artist_variety(tracks, limit=1):
+    """
+    Goes through the track stream and yields no more
+    than limit tracks by each unique artist.
+    """
+    # artist_id: track_count
+    track_count = {}
+    async for track in aiterate(tracks):
+        aid = track['artists'][0]['id']
+        if track_count.get(aid, 0) >= limit:
+            continue
+        track_count[aid] = track_count.get(aid, 0) + 1
+        yield track
@@ -0,0 +1,131 @@
+"""
+Async versions of the sources in playlistcake.library.
+"""
+
+from datetime import datetime
+
+import isodate
+
+from ..util import get_limit
+from ..genutils import yields, infer_content
+from ..dedup import seen_set
+from .spotify import iterate_results
+from .util import aiterate
+
+
+@yields('albums')
+async def saved_albums(max_results=None, album_only=False):
+    """
+    Yields saved album objects.
+    {'album' full album, 'added_at': timestamp}
+    If album_only==True, yield only album.
+    """
+    limit = get_limit(max_results, 50)
+    async for item in iterate_results(
+            'current_user_saved_albums',
+            max_results=max_results,
+            limit=limit):
+        yield item['album'] if album_only else item
+
+
+@yields('tracks')
+async def saved_tracks(max_results=None, track_only=False):
+    """
+    Yields saved track objects.
+    {'track' full track, 'added_at': timestamp}
+    If track_only==True, yield only track.
+    """
+    limit = get_limit(max_results, 50)
+    async for item in iterate_results(
+            'current_user_saved_tracks',
+            max_results=max_results,
+            limit=limit):
+        yield item['track'] if track_only else item
+
+
+@yields('artists')
+async def followed_artists(max_results=None):
+    limit = get_limit(max_results, 50)
+    async for artist in iterate_results(
+            'current_user_followed_artists',
+            items_path=['artists', 'items'],
+            next_path=['artists', 'next'],
+            max_results=max_results,
+            limit=limit):
+        yield artist
+
+
+@yields('artists')
+async def saved_artists(max_results=None, dedup='exact'):
+    """
+    Return all artists from saved_albums,
+    saved_tracks and followed_artists.
+    Each unique artist is returned only once.
+    """
+    async def artists():
+        for items in (saved_albums(album_only=True),
+                      saved_tracks(track_only=True)):
+            async for item in items:
+                for artist in item['artists']:
+                    yield artist
+        async for artist in followed_artists():
+            yield artist
+
+    seen = seen_set(dedup)
+    count = 0
+    async for artist in artists():
+        if max_results and count >= max_results:
+            return
+        if not seen.add(artist['id']):
+            continue
+        count += 1
+        yield artist
+
+
+@yields('artists')
+async def user_top_artists(time_range='medium_term',
+                           max_results=None):
+    limit = get_limit(max_results, 50)
+    async for artist in iterate_results(
+            'current_user_top_artists',
+            time_range=time_range,
+            max_results=max_results,
+            limit=limit):
+        yield artist
+
+
+@yields('artists')
+async def user_top_tracks(time_range='medium_term',
+                          max_results=None):
+    limit = get_limit(max_results, 50)
+    async for track in iterate_results(
+            'current_user_top_tracks',
+            time_range=time_range,
+            max_results=max_results,
+            limit=limit):
+        yield track
+
+
+@infer_content
+async def library_filter_added_at(items, start=None, end=None,
+                                  newest_first=True):
+    """
+    Async version of library.library_filter_added_at.
+    """
+    if end is None:
+        end = datetime.utcnow()
+    async for item in aiterate(items):
+        added = isodate.parse_datetime(item['added_at'])
+        added = added.replace(tzinfo=None)
+
+        if start is not None and added < start:
+            if newest_first:
+                return
+            continue
+        if added <= end:
+            if 'track' in item:
+                yield item['track']
+            elif 'album' in item:
+                yield item['album']
+            else:
+                yield item
@@ -0,0 +1,56 @@
+"""
+Async versions of playlistcake.playlists.
+"""
+
+from ..util import get_limit, get_ids
+from ..genutils import yields
+from .spotify import iterate_results, get_spotify, current_user
+from .util import aiterate, aiter_chunked
+
+
+@yields('playlists')
+async def user_playlists(max_results=None):
+    limit = get_limit(max_results, 50)
+    user = (await current_user())['id']
+    async for playlist in iterate_results(
+            'user_playlists',
+            user,
+            limit=limit,
+            max_results=max_results):
+        yield playlist
+
+
+@yields('tracks')
+async def playlists_tracks(playlists):
+    """
+    Given a list/generator of simplified playlist
+    objects, yield the tracks from them.
+    """
+    async for playlist in aiterate(playlists):
+        user = playlist['owner']['id']
+        async for track in iterate_results(
+                'user_playlist_tracks',
+                user,
+                playlist_id=playlist['id'],
+                limit=100):
+            yield track
+
+
+async def create_playlist(name='Generated playlist', public=True):
+    s = await get_spotify()
+    return await s.user_playlist_create(
+        (await current_user())['id'],
+        name,
+        public=public)
+
+
+async def add_to_playlist(tracks, playlist):
+    if isinstance(playlist, str):
+        playlist = await create_playlist(playlist)
+    s = await get_spotify()
+    async for chunk in aiter_chunked(tracks, 50):
+        tids = get_ids(chunk)
+        await s.user_playlist_add_tracks(
+            playlist['owner']['id'],
+            playlist['id'],
+            tids)
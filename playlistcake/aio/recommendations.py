@@ -0,0 +1,110 @@
+"""
+Async versions of the sources in playlistcake.recommendations.
+"""
+
+from ..util import get_id, get_ids, get_limit
+from ..genutils import yields, content_type
+from ..dedup import seen_set
+from .spotify import iterate_results
+from .util import aiterate
+
+
+async def _generate_seeds(objects, seed_size=5, dedup='exact'):
+    """
+    Async version of recommendations._generate_seeds.
+    """
+    if seed_size > 5 or seed_size < 1:
+        raise ValueError('Seed size must be between 1 and 5')
+    been_used = seen_set(dedup)
+    chunk = []
+    async for item in aiterate(objects):
+        iid = get_id(item)
+        if not been_used.add(iid):
+            continue
+        chunk.append(iid)
+        if len(chunk) == seed_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+@yields('tracks')
+async def recommendations(seed_artists=(),
+                          seed_tracks=(),
+                          seed_genres=(),
+                          max_results=50,
+                          **tuneables):
+    limit = get_limit(max_results, 50)
+    async for track in iterate_results(
+            'recommendations',
+            items_path='tracks',
+            next_path=None,
+            seed_artists=seed_artists,
+            seed_tracks=seed_tracks,
+            seed_genres=seed_genres,
+            max_results=max_results,
+            limit=limit,
+            **tuneables):
+        yield track
+
+
+@yields('tracks')
+async def batch_recommendations(seed_gen=None, seed_size=5,
+                                suppl_artists=(),
+                                suppl_tracks=(),
+                                seed_genres=(),
+                                max_results=None,
+                                max_per_seed=50,
+                                dedup='exact',
+                                **tuneables):
+    """
+    Async version of recommendations.batch_recommendations.
+    """
+    seed_type = content_type(seed_gen)
+    result_count = 0
+    async for seed in _generate_seeds(seed_gen, seed_size, dedup):
+        seed_artists = []
+        seed_tracks = []
+        if seed_type == 'artists':
+            seed_artists += get_ids(seed)
+        elif seed_type == 'tracks':
+            seed_tracks += get_ids(seed)
+        seed_artists += get_ids(suppl_artists)
+        seed_tracks += get_ids(suppl_tracks)
+        recs = recommendations(seed_artists=seed_artists,
+                               seed_tracks=seed_tracks,
+                               seed_genres=seed_genres,
+                               max_results=max_per_seed,
+                               **tuneables)
+        async for track in recs:
+            yield track
+            result_count += 1
+        if max_results and result_count >= max_results:
+            return
+
+
+@yields('albums')
+async def recommended_albums(seed_gen=None, seed_size=5,
+                             suppl_artists=(),
+                             suppl_tracks=(),
+                             seed_genres=(),
+                             max_results=None,
+                             dedup='exact',
+                             **tuneables):
+    batch = batch_recommendations(
+        seed_gen, seed_size,
+        suppl_artists, suppl_tracks,
+        seed_genres,
+        dedup=dedup,
+        **tuneables)
+    seen = seen_set(dedup)
+    count = 0
+    async for track in batch:
+        if max_results and count >= max_results:
+            return
+        album = track['album']
+        if not seen.add(album['id']):
+            continue
+        count += 1
+        yield album
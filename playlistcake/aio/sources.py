@@ -0,0 +1,262 @@
+"""
+Async versions of the sources in playlistcake.sources.
+"""
+
+import heapq
+import random
+
+from .. import cache
+from ..util import get_id, get_ids, reservoir_sample
+from ..genutils import yields, infer_content
+from ..dedup import seen_set
+from .spotify import (
+    get_spotify, iterate_paging, iterate_results, current_user)
+from .util import aiterate, aiter_chunked, alist, amap
+
+
+async def _fetch_albums(aids):
+    return (await (await get_spotify()).albums(aids))['albums']
+
+
+async def _fetch_tracks(tids):
+    return (await (await get_spotify()).tracks(tids))['tracks']
+
+
+async def _fetch_artists(aids):
+    return (await (await get_spotify()).artists(aids))['artists']
+
+
+async def _fetch_audio_features(tids):
+    return await (await get_spotify()).audio_features(tracks=tids)
+
+
+# kind: (fetch function, max ids per request)
+_fetchers = {
+    'albums': (_fetch_albums, 20),
+    'tracks': (_fetch_tracks, 50),
+    'artists': (_fetch_artists, 50),
+    'audio_features': (_fetch_audio_features, 100),
+}
+
+
+async def _lookup(kind, ids):
+    fetch, batch_size = _fetchers[kind]
+    return await cache.alookup(kind, ids, fetch, batch_size)
+
+
+@yields('albums')
+async def several_albums(albums):
+    async for chunk in aiter_chunked(albums, 20):
+        for album in await _lookup('albums', get_ids(chunk)):
+            yield album
+
+
+@yields('tracks')
+async def several_tracks(tracks):
+    async for chunk in aiter_chunked(tracks, 50):
+        for track in await _lookup('tracks', get_ids(chunk)):
+            yield track
+
+
+@yields('artists')
+async def several_artists(artists):
+    async for chunk in aiter_chunked(artists, 50):
+        for artist in await _lookup('artists', get_ids(chunk)):
+            yield artist
+
+
+@yields('tracks')
+async def with_audio_features(tracks):
+    """
+    Yields the given tracks with
+    audio_features (track['audio_features'])
+    Tracks that already have them are not looked up again.
+    """
+    async for chunk in aiter_chunked(tracks, 100):
+        missing = [t for t in chunk if 'audio_features' not in t]
+        if missing:
+            features = await _lookup('audio_features', get_ids(missing))
+            for track, item in zip(missing, features):
+                track['audio_features'] = item
+        for track in chunk:
+            yield track
+
+
+@yields('albums')
+async def artists_albums(artists, album_type='album', workers=None):
+    """
+    Async version of sources.artists_albums.
+    If workers > 1, albums for that many artists are
+    fetched concurrently. Albums are yielded in artist order.
+    """
+    country = await user_country()
+
+    async def _artist_albums(artist):
+        return await alist(iterate_results(
+            'artist_albums',
+            get_id(artist),
+            country=country,
+            album_type=album_type,
+            limit=50))
+
+    async def _simple_albums():
+        async for albums in amap(_artist_albums, artists, workers or 1):
+            for album in albums:
+                yield album
+
+    async for chunk in aiter_chunked(_simple_albums(), 20):
+        async for album in several_albums(chunk):
+            yield album
+
+
+@yields('tracks')
+async def artists_top_tracks(artists, max_per_artist=10, workers=None):
+    """
+    Async version of sources.artists_top_tracks.
+    If workers > 1, top tracks for that many artists are
+    fetched concurrently. Tracks are yielded in artist order.
+    """
+    s = await get_spotify()
+    country = await user_country()
+
+    async def _top_tracks(artist):
+        return (await s.artist_top_tracks(
+            get_id(artist), country=country))['tracks']
+
+    async for tracks in amap(_top_tracks, artists, workers or 1):
+        for track in reservoir_sample(tracks, max_per_artist):
+            yield track
+
+
+@yields('tracks')
+async def tracks_from_albums(albums, full=True):
+    """
+    Async version of sources.tracks_from_albums.
+    """
+    async def simple_tracks():
+        async for album in aiterate(albums):
+            album_info = {k: v for k, v in album.items() if k != 'tracks'}
+            async for track in iterate_paging(album['tracks']):
+                yield dict(track, album=album_info)
+
+    if not full:
+        async for track in simple_tracks():
+            yield track
+        return
+    seen = seen_set()
+
+    async def unique_ids():
+        async for track in simple_tracks():
+            if seen.add(track['id']):
+                yield track['id']
+
+    async for track in several_tracks(unique_ids()):
+        yield track
+
+
+@infer_content
+async def alternate(*streams):
+    iterators = [aiterate(stream) for stream in streams]
+    while iterators:
+        for iterator in list(iterators):
+            try:
+                item = await iterator.__anext__()
+            except StopAsyncIteration:
+                iterators.remove(iterator)
+                continue
+            if item is not None:
+                yield item
+
+
+@infer_content
+async def sort(items, sort_func, order='asc', limit=None,
+               audio_features=False):
+    """
+    Async version of sources.sort.
+    """
+    reverse = order == 'desc'
+    if audio_features:
+        items = with_audio_features(items)
+    if limit:
+        select = heapq.nlargest if reverse else heapq.nsmallest
+        best = []
+        async for chunk in aiter_chunked(items, 1000):
+            best = select(limit, best + chunk, key=sort_func)
+        items = best
+    else:
+        items = sorted(await alist(items), key=sort_func, reverse=reverse)
+    for item in items:
+        yield item
+
+
+@infer_content
+async def shuffle(items):
+    """
+    Shuffles the stream.
+    """
+    items = await alist(items)
+    random.shuffle(items)
+    for item in items:
+        yield item
+
+
+async def full_album(album_or_uri):
+    """
+    Given a partial album object or album uri,
+    return a full album object from the spotify api.
+    """
+    a = album_or_uri
+    if isinstance(a, dict):
+        if 'tracks' in a:
+            # already a full object
+            return a
+        else:
+            a = a['uri']
+    return (await _lookup('albums', [a]))[0]
+
+
+async def full_track(track_or_uri):
+    """
+    Given a partial track object or track uri,
+    return a full track object from the spotify api.
+    """
+    a = track_or_uri
+    if isinstance(a, dict):
+        if 'album' in a:
+            # already a full object
+            return a
+        else:
+            a = a['uri']
+    return (await _lookup('tracks', [a]))[0]
+
+
+async def _search_first(q, type):
+    s = await get_spotify()
+    result = await s.search(q, limit=1, type=type,
+                            market=await user_country())
+    items = result[type + 's']['items']
+    return items[0] if items else None
+
+
+async def find_artist(name):
+    """
+    Given an artist name, return an artist object
+    from search results.
+    returns None if no artist is found.
+    """
+    return await _search_first('artist:{}'.format(name), 'artist')
+
+
+async def find_album(artist, name):
+    album = await _search_first(
+        'artist:{} album:{}'.format(artist, name), 'album')
+    return await full_album(album) if album else None
+
+
+async def find_track(artist, name):
+    return await _search_first(
+        'artist:{} track:{}'.format(artist, name), 'track')
+
+
+async def user_country():
+    return (await current_user())['country']
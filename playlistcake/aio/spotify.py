@@ -0,0 +1,318 @@
+"""
+Asyncio spotify client and result iteration.
+Requires aiohttp.
+"""
+
+import asyncio
+from collections import namedtuple
+import json
+
+from spotipy.client import SpotifyException
+
+from .. import sessionenv
+from ..ratelimit import Scheduler, endpoint_name
+from ..spotify import get_token_manager, get_scheduler, _offset_paging
+from ..util import dict_get_nested, is_iterable, parse_id
+from .util import amap
+
+
+def _format_params(params):
+    """
+    Drop None values and join lists the way
+    the spotify api expects them.
+    """
+    result = {}
+    for key, value in params.items():
+        if value is None:
+            continue
+        if is_iterable(value):
+            value = ','.join(value)
+        elif isinstance(value, bool):
+            value = str(value).lower()
+        result[key] = value
+    return result
+
+
+# A read response
+_Response = namedtuple('_Response', 'status_code headers text url')
+
+
+class AsyncSpotify(object):
+    """
+    Minimal asyncio counterpart of spotipy.Spotify.
+    Method names and arguments mirror spotipy.
+    Requests go through `scheduler` (a ratelimit.Scheduler,
+    by default one without a rate limit).
+    """
+    prefix = 'https://api.spotify.com/v1/'
+
+    def __init__(self, auth, session, scheduler=None):
+        self._auth = auth
+        self._session = session
+        self.scheduler = scheduler or Scheduler()
+
+    async def _internal_call(self, method, url, payload, params):
+        if not url.startswith('http'):
+            url = self.prefix + url
+        headers = {'Authorization': 'Bearer {}'.format(self._auth),
+                   'Content-Type': 'application/json'}
+        data = json.dumps(payload) if payload else None
+
+        async def send():
+            async with self._session.request(
+                    method, url, headers=headers, data=data,
+                    params=_format_params(params)) as r:
+                return _Response(r.status, r.headers, await r.text(), r.url)
+
+        r = await self.scheduler.arequest(send, endpoint_name(url))
+        if r.status_code >= 400:
+            try:
+                msg = json.loads(r.text)['error']['message']
+            except (ValueError, KeyError, TypeError):
+                msg = 'error'
+            raise SpotifyException(
+                r.status_code, -1, '{}:\n {}'.format(r.url, msg))
+        if r.text and r.text != 'null':
+            return json.loads(r.text)
+        return None
+
+    async def _get(self, url, **kwargs):
+        return await self._internal_call('GET', url, None, kwargs)
+
+    async def _post(self, url, payload=None, **kwargs):
+        return await self._internal_call('POST', url, payload, kwargs)
+
+    async def current_user(self):
+        return await self._get('me/')
+
+    me = current_user
+
+    async def current_user_saved_tracks(self, limit=20, offset=0):
+        return await self._get('me/tracks', limit=limit, offset=offset)
+
+    async def current_user_saved_albums(self, limit=20, offset=0):
+        return await self._get('me/albums', limit=limit, offset=offset)
+
+    async def current_user_followed_artists(self, limit=20, after=None):
+        return await self._get(
+            'me/following', type='artist', limit=limit, after=after)
+
+    async def current_user_top_artists(self, limit=20, offset=0,
+                                       time_range='medium_term'):
+        return await self._get('me/top/artists', time_range=time_range,
+                               limit=limit, offset=offset)
+
+    async def current_user_top_tracks(self, limit=20, offset=0,
+                                      time_range='medium_term'):
+        return await self._get('me/top/tracks', time_range=time_range,
+                               limit=limit, offset=offset)
+
+    async def album(self, album_id):
+        return await self._get('albums/' + parse_id(album_id))
+
+    async def albums(self, albums):
+        return await self._get(
+            'albums/', ids=[parse_id(a) for a in albums])
+
+    async def track(self, track_id):
+        return await self._get('tracks/' + parse_id(track_id))
+
+    async def tracks(self, tracks):
+        return await self._get(
+            'tracks/', ids=[parse_id(t) for t in tracks])
+
+    async def artists(self, artists):
+        return await self._get(
+            'artists/', ids=[parse_id(a) for a in artists])
+
+    async def audio_features(self, tracks=()):
+        results = await self._get(
+            'audio-features', ids=[parse_id(t) for t in tracks])
+        if 'audio_features' in results:
+            return results['audio_features']
+        return results
+
+    async def artist_albums(self, artist_id, album_type=None,
+                            country=None, limit=20, offset=0):
+        return await self._get(
+            'artists/' + parse_id(artist_id) + '/albums',
+            album_type=album_type, country=country,
+            limit=limit, offset=offset)
+
+    async def artist_top_tracks(self, artist_id, country='US'):
+        return await self._get(
+            'artists/' + parse_id(artist_id) + '/top-tracks',
+            country=country)
+
+    async def recommendations(self, seed_artists=(), seed_genres=(),
+                              seed_tracks=(), limit=20, country=None,
+                              **kwargs):
+        params = dict(kwargs, limit=limit, market=country)
+        if seed_artists:
+            params['seed_artists'] = [parse_id(a) for a in seed_artists]
+        if seed_genres:
+            params['seed_genres'] = seed_genres
+        if seed_tracks:
+            params['seed_tracks'] = [parse_id(t) for t in seed_tracks]
+        return await self._get('recommendations', **params)
+
+    async def search(self, q, limit=10, offset=0, type='track', market=None):
+        return await self._get('search', q=q, limit=limit,
+                               offset=offset, type=type, market=market)
+
+    async def user_playlists(self, user, limit=50, offset=0):
+        return await self._get('users/{}/playlists'.format(user),
+                               limit=limit, offset=offset)
+
+    async def user_playlist_tracks(self, user, playlist_id=None,
+                                   fields=None, limit=100, offset=0):
+        return await self._get(
+            'users/{}/playlists/{}/tracks'.format(
+                user, parse_id(playlist_id)),
+            fields=fields, limit=limit, offset=offset)
+
+    async def user_playlist_create(self, user, name, public=True):
+        return await self._post('users/{}/playlists'.format(user),
+                                payload={'name': name, 'public': public})
+
+    async def user_playlist_add_tracks(self, user, playlist_id, tracks,
+                                       position=None):
+        uris = ['spotify:track:' + parse_id(t) for t in tracks]
+        return await self._post(
+            'users/{}/playlists/{}/tracks'.format(
+                user, parse_id(playlist_id)),
+            payload=uris, position=position)
+
+
+def _http_session():
+    """
+    The session's aiohttp session for the running event loop,
+    aiohttp sessions only work in the loop they were made in.
+    """
+    import aiohttp
+    loop = asyncio.get_running_loop()
+    with sessionenv.lock():
+        sessions = sessionenv.get('aiohttp_sessions')
+        if sessions is None:
+            sessions = {}
+            sessionenv.set('aiohttp_sessions', sessions)
+        # Forget sessions of finished loops (e.g. earlier asyncio.run)
+        for old in [old for old in sessions if old.is_closed()]:
+            del sessions[old]
+        session = sessions.get(loop)
+        if session is None or session.closed:
+            session = sessions[loop] = aiohttp.ClientSession()
+    return session
+
+
+async def get_spotify():
+    manager = get_token_manager()
+    token = manager.token
+    if manager.needs_refresh():
+        loop = asyncio.get_event_loop()
+        token = await loop.run_in_executor(None, manager.get_token)
+    s = AsyncSpotify(token['access_token'], _http_session(), get_scheduler())
+    prefix = manager.spotify_kwargs.get('prefix')
+    if prefix:
+        s.prefix = prefix
+    return s
+
+
+async def iterate_paging(paging):
+    """
+    Async version of spotify.iterate_paging.
+    """
+    s = None
+    while True:
+        for item in paging['items']:
+            yield item
+        if not paging.get('next'):
+            return
+        s = s or await get_spotify()
+        paging = await s._get(paging['next'])
+
+
+async def current_user():
+    """
+    Async version of spotify.current_user.
+    """
+    user = sessionenv.get('current_user')
+    if user is None:
+        user = await (await get_spotify()).current_user()
+        sessionenv.set('current_user', user)
+    return user
+
+
+async def close():
+    """
+    Close the session's http connections
+    of the running event loop.
+    """
+    loop = asyncio.get_running_loop()
+    with sessionenv.lock():
+        session = (sessionenv.get('aiohttp_sessions') or {}).pop(loop, None)
+    if session is not None:
+        await session.close()
+
+
+async def iterate_results(endpoint, *args, **kwargs):
+    """
+    Async version of spotify.iterate_results.
+    """
+    s = await get_spotify()
+    func = getattr(s, endpoint)
+    items_path = kwargs.pop('items_path', 'items')
+    next_path = kwargs.pop('next_path', 'next')
+    max_results = kwargs.pop('max_results',  None)
+    workers = kwargs.pop('workers', sessionenv.get('page_workers'))
+
+    result = await func(*args, **kwargs)
+    paging = None
+    if workers and workers > 1 and items_path and next_path:
+        paging = _offset_paging(result, items_path)
+    if paging:
+        limit = paging['limit']
+        end = paging['total']
+        if max_results:
+            end = min(end, paging['offset'] + max_results)
+
+        async def fetch_page(offset):
+            page_kwargs = dict(kwargs, limit=limit, offset=offset)
+            return await func(*args, **page_kwargs)
+
+        pages = amap(fetch_page,
+                     range(paging['offset'] + limit, end, limit), workers)
+    else:
+        pages = None
+    count = 0
+    try:
+        while True:
+            if items_path:
+                itemlist = dict_get_nested(items_path, result)
+            else:
+                itemlist = result
+            for item in itemlist:
+                if max_results and count >= max_results:
+                    return
+                count += 1
+                yield item
+            if max_results and count >= max_results:
+                return
+            if pages is not None:
+                try:
+                    result = await pages.__anext__()
+                except StopAsyncIteration:
+                    return
+                continue
+            if not next_path:
+                return
+            try:
+                next_url = dict_get_nested(next_path, result)
+            except KeyError:
+                return
+            if not next_url:
+                return
+            result = await s._get(next_url)
+    finally:
+        if pages is not None:
+            await pages.aclose()
@@ -0,0 +1,58 @@
+import asyncio
+from collections import deque
+
+from ..genutils import infer_content
+
+
+@infer_content
+async def aiterate(items):
+    """
+    Yield from a sync or async iterable.
+    The content type of items is kept.
+    """
+    if hasattr(items, '__aiter__'):
+        async for item in items:
+            yield item
+    else:
+        for item in items:
+            yield item
+
+
+async def aiter_chunked(items, n):
+    """
+    Async version of util.iter_chunked.
+    """
+    chunk = []
+    async for item in aiterate(items):
+        chunk.append(item)
+        if len(chunk) == n:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+async def alist(items):
+    """
+    Collect a sync or async iterable in a list.
+    """
+    return [item async for item in aiterate(items)]
+
+
+async def amap(func, items, workers):
+    """
+    Async version of util.parallel_map.
+    Awaits func(item) for up to `workers` items at a time and
+    yields the results in input order.
+    """
+    pending = deque()
+    try:
+        async for item in aiterate(items):
+            pending.append(asyncio.ensure_future(func(item)))
+            if len(pending) >= workers:
+                yield await pending.popleft()
+        while pending:
+            yield await pending.popleft()
+    finally:
+        for future in pending:
+            future.cancel()
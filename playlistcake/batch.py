@@ -0,0 +1,290 @@
+"""
+Run a pipeline (see playlistcake.pipeline) for many users
+in a process pool, e.g. to build everyone's playlists nightly.
+
+    users = [{'id': 'alice', 'token': {...}}, ...]
+    run_batch(users, spec, playlist='Daily mix',
+              workers=8, rate=20, cache_path='cache.sqlite',
+              checkpoint='batch.jsonl')
+
+Each worker process keeps one warm http session, scheduler and
+entity cache (an in memory LRU backed by the sqlite file at
+`cache_path`, shared by all workers) for all users it runs.
+The token bucket limiting requests to `rate` per second is
+shared by the workers, as are Retry-After pauses.
+
+A user is retried up to `retries` times, with exponential
+backoff, on connection errors and 5xx/429 responses.
+Every finished user is appended to the `checkpoint` file (json
+lines), and users done in a previous run with the same file
+are skipped, so a crashed run can be resumed.
+
+Or from the command line:
+
+    python -m playlistcake.batch users.json spec.json \\
+        --playlist 'Daily mix' --workers 8 --checkpoint batch.jsonl
+"""
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import json
+import os
+import time
+import traceback
+
+import requests
+from spotipy.client import SpotifyException
+
+from . import sessionenv, pipeline, playlists
+from .cache import default_cache
+from .explain import Pipeline, BudgetExceeded
+from .ratelimit import Scheduler, SharedTokenBucket
+from .spotify import current_user, get_scheduler, get_spotify
+
+# State of the worker process, set by _init_worker
+_worker = {}
+
+
+def _init_worker(config, bucket):
+    _worker.clear()
+    _worker['config'] = config
+    _worker['spec'] = pipeline.plan(config['spec'])
+    _worker['http_session'] = requests.Session()
+    _worker['cache'] = default_cache(config.get('cache_path'))
+    # Without a shared bucket there is no rate limit
+    _worker['scheduler'] = Scheduler(
+        rate=None, max_concurrency=config.get('max_concurrency', 10),
+        bucket=bucket)
+
+
+def _retryable(error):
+    if isinstance(error, SpotifyException):
+        return error.http_status == 429 or error.http_status >= 500
+    return isinstance(error, requests.RequestException)
+
+
+def _request_count():
+    return sum(m['requests'] for m in get_scheduler().metrics().values())
+
+
+def find_playlist(name):
+    """
+    Returns the current user's playlist called name,
+    creating it if there is none.
+    """
+    user = current_user()['id']
+    for playlist in playlists.user_playlists():
+        if playlist['name'] == name and playlist['owner']['id'] == user:
+            return playlist
+    return playlists.create_playlist(name, public=False)
+
+
+def _run_once(user, config):
+    get_spotify().trace_out = False
+    pipe = Pipeline(lambda: pipeline.build(_worker['spec'], optimize=False),
+                    budget=config.get('budget'))
+    tracks = list(pipe.run())
+    result = {'tracks': len(tracks)}
+    name = config.get('playlist')
+    if name:
+        playlist = find_playlist(name.format(user=user['id']))
+        playlists.sync_playlist(tracks, playlist)
+        result['playlist'] = playlist['id']
+    return result
+
+
+def run_user(user):
+    """
+    Run the batch's pipeline for user (a dict with `id` and
+    `token`) in a worker, with the worker's warm session.
+    Returns the user's checkpoint record.
+    """
+    config = _worker['config']
+    record = {'user': user['id'], 'status': 'failed', 'attempts': 0,
+              'tracks': 0, 'requests': 0, 'error': None}
+    start = time.monotonic()
+    with sessionenv.session(
+            token=user.get('token'),
+            credentials=config.get('credentials'),
+            http_session=_worker['http_session'],
+            cache=_worker['cache'],
+            scheduler=_worker['scheduler'],
+            spotify_kwargs=config.get('spotify_kwargs')):
+        before = _request_count()
+        retries = config.get('retries', 3)
+        while True:
+            record['attempts'] += 1
+            try:
+                record.update(_run_once(user, config))
+                record['status'] = 'ok'
+                record['error'] = None
+                break
+            except BudgetExceeded as e:
+                record['error'] = str(e)
+                break
+            except Exception as e:
+                record['error'] = ''.join(
+                    traceback.format_exception_only(type(e), e)).strip()
+                if not _retryable(e) or record['attempts'] > retries:
+                    break
+            time.sleep(config.get('backoff', 1) *
+                       2**(record['attempts'] - 1))
+        record['requests'] = _request_count() - before
+    record['seconds'] = round(time.monotonic() - start, 3)
+    return record
+
+
+def load_checkpoint(path):
+    """
+    Returns {user id: record} of the users
+    finished successfully according to the checkpoint file.
+    """
+    done = {}
+    if not path or not os.path.exists(path):
+        return done
+    with open(path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # A line cut short by a crash
+                continue
+            if record.get('status') == 'ok':
+                done[record['user']] = record
+            else:
+                done.pop(record['user'], None)
+    return done
+
+
+def format_summary(summary):
+    return (
+        '{done} users done, {failed} failed, {skipped} skipped '
+        'in {seconds:.1f}s ({users_per_second:.2f} users/s)\n'
+        '{tracks} tracks, {requests} requests '
+        '({requests_per_second:.1f} requests/s)').format(**summary)
+
+
+def run_batch(users, spec, playlist=None, workers=None, rate=20,
+              burst=None, max_concurrency=10, cache_path=None,
+              checkpoint=None, retries=3, backoff=1, budget=None,
+              credentials=None, spotify_kwargs=None, verbose=True):
+    """
+    Run the pipeline `spec` for each of `users`
+    (dicts with the user's `id` and `token`).
+    playlist: name of the playlist to sync each user's tracks to
+              ({user} is replaced with the user id), if given
+    workers: number of worker processes, defaults to the number
+             of cpus, 0 runs the users in this process
+    rate, burst: requests per second allowed across all workers
+    max_concurrency: concurrent requests per worker
+    cache_path: sqlite file of the shared entity cache
+    checkpoint: json lines file of finished users for resuming
+    retries, backoff: retries per user and the first retry's
+                      delay in seconds, doubled on every retry
+    budget: maximum requests of one user's pipeline
+    credentials, spotify_kwargs: as sessionenv variables,
+                                 for refreshing tokens and
+                                 configuring the client
+    Returns the summary (also printed if verbose): counts of
+    users done, failed and skipped, tracks, requests and rates.
+    """
+    config = {
+        'spec': pipeline.load(spec), 'playlist': playlist,
+        'max_concurrency': max_concurrency, 'cache_path': cache_path,
+        'retries': retries, 'backoff': backoff, 'budget': budget,
+        'credentials': credentials, 'spotify_kwargs': spotify_kwargs,
+    }
+    done = load_checkpoint(checkpoint)
+    todo = [user for user in users if user['id'] not in done]
+    bucket = SharedTokenBucket(rate, burst) if rate else None
+    summary = {'done': 0, 'failed': 0, 'skipped': len(users) - len(todo),
+               'tracks': 0, 'requests': 0}
+    failures = []
+    start = time.monotonic()
+    out = open(checkpoint, 'a') if checkpoint else None
+    try:
+        if workers == 0:
+            _init_worker(config, bucket)
+            results = map(run_user, todo)
+            executor = None
+        else:
+            executor = ProcessPoolExecutor(
+                workers, initializer=_init_worker,
+                initargs=(config, bucket))
+            # Records are written as users finish, not in input
+            # order, so a slow user doesn't hold back the others'
+            results = (future.result() for future in as_completed(
+                [executor.submit(run_user, user) for user in todo]))
+        try:
+            for record in results:
+                if out:
+                    out.write(json.dumps(record) + '\n')
+                    out.flush()
+                if record['status'] == 'ok':
+                    summary['done'] += 1
+                else:
+                    summary['failed'] += 1
+                    failures.append(record)
+                summary['tracks'] += record['tracks']
+                summary['requests'] += record['requests']
+        finally:
+            if executor:
+                executor.shutdown(cancel_futures=True)
+    finally:
+        if out:
+            out.close()
+    elapsed = time.monotonic() - start
+    summary['seconds'] = elapsed
+    summary['users_per_second'] = (
+        (summary['done'] + summary['failed'])/elapsed if elapsed else 0)
+    summary['requests_per_second'] = (
+        summary['requests']/elapsed if elapsed else 0)
+    summary['failures'] = failures
+    if verbose:
+        print(format_summary(summary))
+        for record in failures:
+            print('{user}: {error}'.format(**record))
+    return summary
+
+
+def _load_json(path):
+    with open(path) as f:
+        text = f.read()
+    try:
+        return json.loads(text)
+    except ValueError:
+        # json lines
+        return [json.loads(line) for line in text.splitlines() if line]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Run a pipeline for many users.')
+    parser.add_argument('users', help='json (lines) file of users, '
+                        'objects with id and token')
+    parser.add_argument('spec', help='json file of the pipeline spec')
+    parser.add_argument('--playlist', help='name of the playlist to sync')
+    parser.add_argument('--workers', type=int)
+    parser.add_argument('--rate', type=float, default=20)
+    parser.add_argument('--burst', type=float)
+    parser.add_argument('--max-concurrency', type=int, default=10)
+    parser.add_argument('--cache', help='sqlite cache file')
+    parser.add_argument('--checkpoint', help='json lines file to resume from')
+    parser.add_argument('--retries', type=int, default=3)
+    parser.add_argument('--budget', type=int)
+    parser.add_argument('--prefix', help='api url, e.g. of a fake server')
+    args = parser.parse_args(argv)
+    credentials = {key: os.environ.get('SPOTIPY_' + key.upper())
+                   for key in ('client_id', 'client_secret', 'redirect_uri')}
+    summary = run_batch(
+        _load_json(args.users), _load_json(args.spec),
+        playlist=args.playlist, workers=args.workers, rate=args.rate,
+        burst=args.burst, max_concurrency=args.max_concurrency,
+        cache_path=args.cache, checkpoint=args.checkpoint,
+        retries=args.retries, budget=args.budget, credentials=credentials,
+        spotify_kwargs={'prefix': args.prefix} if args.prefix else None)
+    return 1 if summary['failed'] else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
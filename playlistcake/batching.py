@@ -0,0 +1,119 @@
+"""
+Coalescing of id lookups from concurrent pipelines
+into full api batches.
+"""
+
+from collections import OrderedDict
+from concurrent.futures import Future, wait
+import threading
+
+from . import sessionenv
+
+
+class Coalescer(object):
+    """
+    Collects ids requested by concurrent callers of `get_many`
+    and sends them to `fetch` in batches of `batch_size`.
+    A partial batch is sent once the oldest caller has waited
+    `window` seconds. An id that is already queued or being
+    fetched is not requested again.
+    """
+    def __init__(self, fetch, batch_size, window=0.01):
+        self.fetch = fetch
+        self.batch_size = batch_size
+        self.window = window
+        self._lock = threading.Lock()
+        # id: Future, waiting to be sent
+        self._pending = OrderedDict()
+        # id: Future, being fetched
+        self._inflight = {}
+
+    def _take(self):
+        batch = []
+        while self._pending and len(batch) < self.batch_size:
+            key, future = self._pending.popitem(last=False)
+            self._inflight[key] = future
+            batch.append((key, future))
+        return batch
+
+    def _send(self, batch):
+        try:
+            results = self.fetch([key for key, future in batch])
+        except Exception as e:
+            for key, future in batch:
+                future.set_exception(e)
+        else:
+            results = list(results)
+            for i, (key, future) in enumerate(batch):
+                if i < len(results):
+                    future.set_result(results[i])
+                else:
+                    # Don't leave callers waiting forever
+                    future.set_exception(KeyError(
+                        'No result for {} in the fetched batch'.format(key)))
+        finally:
+            with self._lock:
+                for key, future in batch:
+                    if self._inflight.get(key) is future:
+                        del self._inflight[key]
+
+    def flush(self):
+        """
+        Send everything that is waiting, including partial batches.
+        """
+        with self._lock:
+            batches = []
+            while self._pending:
+                batches.append(self._take())
+        for batch in batches:
+            self._send(batch)
+
+    def get_many(self, ids):
+        """
+        Returns the objects for ids, in order.
+        """
+        futures = []
+        batches = []
+        with self._lock:
+            for key in ids:
+                future = self._inflight.get(key) or self._pending.get(key)
+                if future is None:
+                    future = self._pending[key] = Future()
+                futures.append(future)
+            while len(self._pending) >= self.batch_size:
+                batches.append(self._take())
+        # Full batches are sent right away by the caller filling them
+        for batch in batches:
+            self._send(batch)
+        done, not_done = wait(futures, timeout=self.window)
+        if not_done:
+            self.flush()
+        return [future.result() for future in futures]
+
+
+def enable_coalescing(window=0.01):
+    """
+    Coalesce album, track, artist and audio features
+    lookups from all threads of the current session.
+    window is how long (seconds) a partial batch
+    waits for more ids. Pass None to disable.
+    """
+    sessionenv.set('coalesce_window', window)
+    sessionenv.set('coalescers', {})
+
+
+def get_coalescer(kind, fetch, batch_size):
+    """
+    Returns the session's Coalescer for kind,
+    or None if coalescing is not enabled.
+    """
+    window = sessionenv.get('coalesce_window')
+    if window is None:
+        return None
+    coalescers = sessionenv.get('coalescers')
+    coalescer = coalescers.get(kind)
+    if coalescer is None:
+        with sessionenv.lock():
+            coalescer = coalescers.setdefault(
+                kind, Coalescer(fetch, batch_size, window))
+    return coalescer
@@ -0,0 +1,279 @@
+"""
+Caching of spotify entities (albums, tracks, artists and audio features).
+
+A cache is set per session with `set_cache` and is used
+by the batch lookups in `sources`. Any object with
+`get_many(kind, keys)` and `set_many(kind, items)` methods
+can be used as a cache.
+"""
+
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from . import sessionenv
+from .util import iter_chunked, parse_id
+
+DAY = 60*60*24
+
+# Default time to live (seconds) per entity type.
+# None means the entry never expires.
+DEFAULT_TTLS = {
+    'albums': DAY*30,
+    'tracks': DAY*30,
+    # Artist popularity, followers and genres change often
+    'artists': DAY,
+    'audio_features': None,
+}
+
+
+def _expires_at(ttls, kind, now):
+    ttl = ttls.get(kind, DAY)
+    if ttl is None:
+        return None
+    return now + ttl
+
+
+def _is_expired(expires, now):
+    return expires is not None and expires < now
+
+
+class MemoryCache(object):
+    """
+    In-memory LRU cache.
+    Holds at most `max_size` entries in total, least
+    recently used entries are evicted first.
+    """
+    def __init__(self, max_size=10000, ttls=None):
+        self.max_size = max_size
+        self.ttls = dict(DEFAULT_TTLS, **(ttls or {}))
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_many(self, kind, keys):
+        now = time.time()
+        found = {}
+        with self._lock:
+            for key in keys:
+                entry = self._data.get((kind, key))
+                if entry is None:
+                    continue
+                expires, value = entry
+                if _is_expired(expires, now):
+                    del self._data[(kind, key)]
+                    continue
+                self._data.move_to_end((kind, key))
+                found[key] = dict(value)
+        return found
+
+    def set_many(self, kind, items):
+        now = time.time()
+        expires = _expires_at(self.ttls, kind, now)
+        with self._lock:
+            for key, value in items.items():
+                self._data[(kind, key)] = (expires, dict(value))
+                self._data.move_to_end((kind, key))
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class SQLiteCache(object):
+    """
+    On-disk cache backed by a sqlite database.
+    When the number of entries exceeds `max_size`,
+    the least recently used entries are deleted.
+    Entries are only counted every 1% of max_size inserts
+    (counting is a full scan), so the cache can briefly hold
+    that many more per process writing to it.
+    """
+    def __init__(self, path, max_size=1000000, ttls=None):
+        self.path = path
+        self.max_size = max_size
+        self._check_every = max(1, max_size//100)
+        self._unchecked = 0
+        self.ttls = dict(DEFAULT_TTLS, **(ttls or {}))
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(
+            path, check_same_thread=False, timeout=30)
+        # Lets several processes read and write the file at once
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        with self._conn:
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS entities ('
+                'kind TEXT, key TEXT, value TEXT, '
+                'expires REAL, accessed REAL, '
+                'PRIMARY KEY (kind, key))')
+            self._conn.execute(
+                'CREATE INDEX IF NOT EXISTS entities_accessed '
+                'ON entities (accessed)')
+
+    def get_many(self, kind, keys):
+        now = time.time()
+        found = {}
+        expired = []
+        with self._lock:
+            # Stay well below sqlite's max number of query variables
+            for chunk in iter_chunked(keys, 500):
+                rows = self._conn.execute(
+                    'SELECT key, value, expires FROM entities '
+                    'WHERE kind = ? AND key IN ({})'.format(
+                        ','.join('?'*len(chunk))),
+                    [kind] + chunk)
+                for key, value, expires in rows:
+                    if _is_expired(expires, now):
+                        expired.append(key)
+                    else:
+                        found[key] = json.loads(value)
+            with self._conn:
+                self._conn.executemany(
+                    'UPDATE entities SET accessed = ? '
+                    'WHERE kind = ? AND key = ?',
+                    [(now, kind, key) for key in found])
+                self._conn.executemany(
+                    'DELETE FROM entities WHERE kind = ? AND key = ?',
+                    [(kind, key) for key in expired])
+        return found
+
+    def set_many(self, kind, items):
+        now = time.time()
+        expires = _expires_at(self.ttls, kind, now)
+        with self._lock, self._conn:
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO entities '
+                '(kind, key, value, expires, accessed) '
+                'VALUES (?, ?, ?, ?, ?)',
+                [(kind, key, json.dumps(value), expires, now)
+                 for key, value in items.items()])
+            self._unchecked += len(items)
+            if self._unchecked >= self._check_every:
+                self._unchecked = 0
+                self._evict()
+
+    def _evict(self):
+        count = self._conn.execute(
+            'SELECT COUNT(*) FROM entities').fetchone()[0]
+        if count <= self.max_size:
+            return
+        # Evict a little more than needed so we don't
+        # have to do this on every insert
+        excess = count - self.max_size + self.max_size//10
+        self._conn.execute(
+            'DELETE FROM entities WHERE rowid IN ('
+            'SELECT rowid FROM entities ORDER BY accessed LIMIT ?)',
+            (excess,))
+
+    def clear(self):
+        with self._lock, self._conn:
+            self._conn.execute('DELETE FROM entities')
+
+
+class TieredCache(object):
+    """
+    Chains several caches, fastest first.
+    Entries found in a slower tier are copied
+    to the faster tiers.
+    """
+    def __init__(self, *tiers):
+        self.tiers = tiers
+
+    def get_many(self, kind, keys):
+        found = {}
+        missing = list(keys)
+        for i, tier in enumerate(self.tiers):
+            if not missing:
+                break
+            hits = tier.get_many(kind, missing)
+            if hits:
+                for faster in self.tiers[:i]:
+                    faster.set_many(kind, hits)
+                found.update(hits)
+                missing = [key for key in missing if key not in hits]
+        return found
+
+    def set_many(self, kind, items):
+        for tier in self.tiers:
+            tier.set_many(kind, items)
+
+    def clear(self):
+        for tier in self.tiers:
+            tier.clear()
+
+
+def default_cache(path=None, memory_size=10000,
+                  disk_size=1000000, ttls=None):
+    """
+    Returns a memory LRU cache, backed by a sqlite
+    cache at `path` if given.
+    """
+    memory = MemoryCache(max_size=memory_size, ttls=ttls)
+    if not path:
+        return memory
+    return TieredCache(
+        memory, SQLiteCache(path, max_size=disk_size, ttls=ttls))
+
+
+def set_cache(cache):
+    """
+    Set the entity cache for the current session.
+    Pass None to disable caching.
+    """
+    sessionenv.set('cache', cache)
+
+
+def get_cache():
+    return sessionenv.get('cache')
+
+
+def _cached(kind, keys):
+    """
+    Returns (cache, found, missing) for the given
+    normalized keys.
+    """
+    cache = get_cache()
+    found = cache.get_many(kind, keys) if cache else {}
+    missing = [key for key in OrderedDict.fromkeys(keys)
+               if key not in found]
+    return cache, found, missing
+
+
+def _store(cache, kind, chunk, objects, found):
+    fetched = {}
+    for key, obj in zip(chunk, objects):
+        # The api returns null for unknown ids
+        if obj is not None:
+            fetched[key] = obj
+    if cache and fetched:
+        cache.set_many(kind, fetched)
+    found.update(fetched)
+
+
+def lookup(kind, keys, fetch, batch_size):
+    """
+    Get objects of type `kind` for the given ids/uris.
+    Returns a list in the same order as `keys`.
+    Only ids missing from the session cache are passed to
+    `fetch` (a function taking a list of at most `batch_size`
+    ids and returning a list of objects).
+    """
+    keys = [parse_id(key) for key in keys]
+    cache, found, missing = _cached(kind, keys)
+    for chunk in iter_chunked(missing, batch_size):
+        _store(cache, kind, chunk, fetch(chunk), found)
+    return [found.get(key) for key in keys]
+
+
+async def alookup(kind, keys, fetch, batch_size):
+    """
+    Same as `lookup`, for a coroutine `fetch` function.
+    """
+    keys = [parse_id(key) for key in keys]
+    cache, found, missing = _cached(kind, keys)
+    for chunk in iter_chunked(missing, batch_size):
+        _store(cache, kind, chunk, await fetch(chunk), found)
+    return [found.get(key) for key in keys]
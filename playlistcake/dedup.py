@@ -0,0 +1,134 @@
+"""
+Sets for keeping track of which ids have been seen
+in a stream.
+All have an `add(item_id)` method which returns True if
+the id was not seen before.
+"""
+
+from collections import deque
+import hashlib
+import math
+
+BASE62 = ('0123456789'
+          'abcdefghijklmnopqrstuvwxyz'
+          'ABCDEFGHIJKLMNOPQRSTUVWXYZ')
+_base62 = {c: i for i, c in enumerate(BASE62)}
+
+
+def compact_key(item_id):
+    """
+    Returns a base62 spotify id as an int, which takes about
+    half the memory of the str. Other ids are returned as bytes.
+    """
+    if not isinstance(item_id, str):
+        return item_id
+    # Start from 1 so leading zeros are not lost
+    n = 1
+    try:
+        for c in item_id:
+            n = n*62 + _base62[c]
+    except KeyError:
+        return item_id.encode()
+    return n
+
+
+class ExactSet(object):
+    """
+    Remembers every id, stored as compact keys.
+    """
+    def __init__(self):
+        self._keys = set()
+
+    def add(self, item_id):
+        key = compact_key(item_id)
+        if key in self._keys:
+            return False
+        self._keys.add(key)
+        return True
+
+    def __contains__(self, item_id):
+        return compact_key(item_id) in self._keys
+
+    def __len__(self):
+        return len(self._keys)
+
+
+class BloomFilter(object):
+    """
+    Approximate set using a fixed amount of memory, sized for
+    `capacity` ids with a false positive rate of `error_rate`.
+    A false positive makes a new id look already seen.
+    """
+    def __init__(self, capacity=1000000, error_rate=0.001):
+        self.size = max(8, int(
+            -capacity*math.log(error_rate)/math.log(2)**2))
+        self.hashes = max(1, round(self.size/capacity*math.log(2)))
+        self._bits = bytearray(self.size//8 + 1)
+        self._count = 0
+
+    def _positions(self, item_id):
+        digest = hashlib.blake2b(
+            str(item_id).encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i*h2) % self.size for i in range(self.hashes)]
+
+    def add(self, item_id):
+        is_new = False
+        for pos in self._positions(item_id):
+            byte, bit = divmod(pos, 8)
+            if not self._bits[byte] & (1 << bit):
+                is_new = True
+                self._bits[byte] |= 1 << bit
+        self._count += is_new
+        return is_new
+
+    def __contains__(self, item_id):
+        return all(self._bits[pos//8] & (1 << pos % 8)
+                   for pos in self._positions(item_id))
+
+    def __len__(self):
+        return self._count
+
+
+class WindowSet(object):
+    """
+    Only remembers the last `window` distinct ids added.
+    """
+    def __init__(self, window=10000):
+        self.window = window
+        self._order = deque()
+        self._keys = set()
+
+    def add(self, item_id):
+        key = compact_key(item_id)
+        if key in self._keys:
+            return False
+        self._keys.add(key)
+        self._order.append(key)
+        if len(self._order) > self.window:
+            self._keys.discard(self._order.popleft())
+        return True
+
+    def __contains__(self, item_id):
+        return compact_key(item_id) in self._keys
+
+    def __len__(self):
+        return len(self._keys)
+
+
+def seen_set(mode='exact', capacity=1000000, error_rate=0.001,
+             window=10000):
+    """
+    Returns a set for deduplicating ids.
+    mode: 'exact' (ExactSet), 'approximate' (BloomFilter with
+          given capacity and error_rate) or
+          'window' (WindowSet of given window size)
+    """
+    if mode == 'exact':
+        return ExactSet()
+    elif mode == 'approximate':
+        return BloomFilter(capacity, error_rate)
+    elif mode == 'window':
+        return WindowSet(window)
+    raise ValueError('Unknown dedup mode: {}'.format(mode))
@@ -0,0 +1,334 @@
+"""
+Explain a pipeline before running it: the graph of its
+stages with estimated item and api request counts, and after
+running it, the actual request counts per stage.
+A request budget aborts the run when exceeded.
+
+    pipeline = Pipeline(
+        lambda: sort(tracks_filter_tuneables(
+            saved_tracks(track_only=True), min_energy=0.5),
+            lambda t: t['popularity']),
+        budget=200)
+    print(pipeline.explain())
+    tracks = list(pipeline.run())
+    print(pipeline.explain())
+
+Estimates follow the page and batch sizes of each stage
+(50 per page, 20 albums, 50 tracks/artists and 100 audio
+features per request) and ignore caching, so they are an
+upper bound for the given library `sizes`.
+"""
+
+import math
+
+from . import instrument
+from .sources import _fetchers
+
+# Assumed sizes of what can't be known before running
+DEFAULT_SIZES = {
+    'saved_tracks': 1000,
+    'saved_albums': 200,
+    'followed_artists': 100,
+    'saved_artists': 500,
+    'user_playlists': 20,
+    'playlist_tracks': 100,
+    'artist_albums': 10,
+    'album_tracks': 12,
+}
+
+
+class BudgetExceeded(Exception):
+    pass
+
+
+def _pages(n, size):
+    return int(math.ceil(n/size)) if n else 0
+
+
+def _cap(n, max_results):
+    return min(n, max_results) if max_results else n
+
+
+def _batches(kind, n):
+    return _pages(n, _fetchers[kind][1])
+
+
+def _library(size_key):
+    def model(params, n_in, sizes):
+        n = _cap(sizes[size_key], params.get('max_results'))
+        return n, _pages(n, 50)
+    return model
+
+
+def _saved_artists(params, n_in, sizes):
+    requests = sum(_pages(sizes[key], 50) for key in
+                   ('saved_albums', 'saved_tracks', 'followed_artists'))
+    return _cap(sizes['saved_artists'], params.get('max_results')), requests
+
+
+def _top(params, n_in, sizes):
+    n = _cap(50, params.get('max_results'))
+    return n, _pages(n, 50)
+
+
+def _playlists_tracks(params, n_in, sizes):
+    per_playlist = sizes['playlist_tracks']
+    return n_in*per_playlist, n_in*max(1, _pages(per_playlist, 100))
+
+
+def _recommendations(params, n_in, sizes):
+    return params.get('max_results') or 50, 1
+
+
+def _batch_recommendations(params, n_in, sizes):
+    seeds = _pages(n_in, params.get('seed_size') or 5)
+    per_seed = params.get('max_per_seed') or 50
+    max_results = params.get('max_results')
+    if max_results:
+        seeds = min(seeds, _pages(max_results, per_seed))
+    return _cap(seeds*per_seed, max_results), seeds
+
+
+def _recommended_albums(params, n_in, sizes):
+    n, requests = _batch_recommendations(
+        dict(params, max_per_seed=50, max_results=None), n_in, sizes)
+    return _cap(n, params.get('max_results')), requests
+
+
+def _lookup(kind):
+    def model(params, n_in, sizes):
+        return n_in, _batches(kind, n_in)
+    return model
+
+
+def _artists_albums(params, n_in, sizes):
+    n = n_in*sizes['artist_albums']
+    pages = n_in*max(1, _pages(sizes['artist_albums'], 50))
+    return n, pages + _batches('albums', n)
+
+
+def _artists_top_tracks(params, n_in, sizes):
+    return n_in*min(params.get('max_per_artist') or 10, 10), n_in
+
+
+def _tracks_from_albums(params, n_in, sizes):
+    per_album = sizes['album_tracks']
+    n = n_in*per_album
+    # The first 50 tracks come with the album
+    requests = n_in*max(0, _pages(per_album, 50) - 1)
+    if params.get('full', True):
+        requests += _batches('tracks', n)
+    return n, requests
+
+
+def _passthrough(params, n_in, sizes):
+    return n_in, 0
+
+
+def _sort(params, n_in, sizes):
+    requests = 0
+    if params.get('audio_features'):
+        requests = _batches('audio_features', n_in)
+    return _cap(n_in, params.get('limit')), requests
+
+
+def _filter_tuneables(params, n_in, sizes):
+    return n_in, _batches('audio_features', n_in)
+
+
+# Stage name: function of (params, input items, sizes)
+# returning estimated (items, requests)
+COST_MODELS = {
+    'library.saved_tracks': _library('saved_tracks'),
+    'library.saved_albums': _library('saved_albums'),
+    'library.followed_artists': _library('followed_artists'),
+    'library.saved_artists': _saved_artists,
+    'library.user_top_artists': _top,
+    'library.user_top_tracks': _top,
+    'library.library_filter_added_at': _passthrough,
+    'playlists.user_playlists': _library('user_playlists'),
+    'playlists.playlists_tracks': _playlists_tracks,
+    'recommendations.recommendations': _recommendations,
+    'recommendations.batch_recommendations': _batch_recommendations,
+    'recommendations.recommended_albums': _recommended_albums,
+    'sources.several_albums': _lookup('albums'),
+    'sources.several_tracks': _lookup('tracks'),
+    'sources.several_artists': _lookup('artists'),
+    'sources.with_audio_features': _lookup('audio_features'),
+    'sources.artists_albums': _artists_albums,
+    'sources.artists_top_tracks': _artists_top_tracks,
+    'sources.tracks_from_albums': _tracks_from_albums,
+    'sources.alternate': _passthrough,
+    'sources.prefetch': _passthrough,
+    'sources.sort': _sort,
+    'sources.shuffle': _passthrough,
+    'filters.tracks_filter_tuneables': _filter_tuneables,
+    'filters.filter_release_years': _passthrough,
+    'filters.filter_unique': _passthrough,
+    'filters.tracks_filter_artist_variety': _passthrough,
+}
+
+
+class _PipelineCollector(instrument.MemoryCollector):
+    """
+    Keeps all stages and counts requests, raising
+    BudgetExceeded before a request over the budget is made.
+    """
+    def __init__(self, budget=None):
+        super(_PipelineCollector, self).__init__()
+        self.budget = budget
+        self.requests = 0
+
+    def before_request(self, stats, endpoint):
+        with self._lock:
+            if self.budget is not None and self.requests >= self.budget:
+                raise BudgetExceeded(
+                    'Request budget of {} exceeded by {} request'.format(
+                        self.budget, endpoint))
+            self.requests += 1
+
+
+class Pipeline(object):
+    """
+    A pipeline built by calling `build`, which should
+    return the pipeline's last generator.
+    budget is the maximum number of api requests a run
+    may make, sizes override DEFAULT_SIZES for estimates.
+    """
+    def __init__(self, build, budget=None, sizes=None):
+        self.build = build
+        self.budget = budget
+        self.sizes = dict(DEFAULT_SIZES, **(sizes or {}))
+        self.collector = None
+        self.planned = []
+        self.ran = False
+        self.aborted = False
+
+    def _prepare(self):
+        collector = _PipelineCollector(self.budget)
+        with instrument.use_collector(collector):
+            gen = self.build()
+        self.collector = collector
+        # Stages are lazy, so those created by build are the
+        # pipeline's plan, the rest are created while running.
+        self.planned = list(collector.stages)
+        self.ran = self.aborted = False
+        return gen
+
+    def estimate(self):
+        """
+        Returns {stage id: (estimated items, estimated requests)}
+        for the planned stages.
+        """
+        if self.collector is None:
+            self._prepare().close()
+        by_id = {stats.id: stats for stats in self.planned}
+        estimates = {}
+
+        def visit(stats):
+            if stats.id not in estimates:
+                n_in = stats.input_size or 0
+                for input_id in stats.inputs:
+                    if input_id in by_id:
+                        n_in += visit(by_id[input_id])[0]
+                model = COST_MODELS.get(stats.name, _passthrough)
+                estimates[stats.id] = model(stats.params, n_in, self.sizes)
+            return estimates[stats.id]
+
+        for stats in self.planned:
+            visit(stats)
+        return estimates
+
+    def estimated_requests(self):
+        return sum(r for n, r in self.estimate().values())
+
+    def actual_requests(self):
+        """
+        Returns {planned stage id: requests} of the last run.
+        Requests of stages created while running (like
+        pagination or lookups inside a stage) count towards
+        the planned stage consuming them.
+        """
+        stages = {stats.id: stats for stats in self.collector.stages}
+        planned = {stats.id for stats in self.planned}
+        actual = dict.fromkeys(planned, 0)
+        for stats in stages.values():
+            owner = stats
+            while owner is not None and owner.id not in planned:
+                owner = stages.get(owner.consumer)
+            if owner is not None:
+                actual[owner.id] += stats.requests
+        return actual
+
+    def run(self, check_estimate=False):
+        """
+        Build the pipeline and yield its items.
+        Raises BudgetExceeded when the pipeline would make
+        more requests than the budget, after closing it.
+        If check_estimate is True, it is raised before running
+        if the estimate is over the budget.
+        Only requests made while the pipeline produces an item
+        are counted, not those of the consumer between items.
+        """
+        gen = self._prepare()
+        if check_estimate and self.budget is not None:
+            estimate = self.estimated_requests()
+            if estimate > self.budget:
+                gen.close()
+                raise BudgetExceeded(
+                    'Estimated {} requests, budget is {}'.format(
+                        estimate, self.budget))
+        self.ran = True
+        try:
+            while True:
+                with instrument.use_collector(self.collector):
+                    try:
+                        item = next(gen)
+                    except StopIteration:
+                        return
+                yield item
+        except BudgetExceeded:
+            self.aborted = True
+            raise
+        finally:
+            with instrument.use_collector(self.collector):
+                gen.close()
+
+    def explain(self):
+        """
+        Returns a text tree of the stages with estimated items
+        and requests, and actual requests once run.
+        """
+        estimates = self.estimate()
+        actual = self.actual_requests() if self.ran else {}
+        by_id = {stats.id: stats for stats in self.planned}
+        consumed = {i for stats in self.planned for i in stats.inputs}
+        lines = ['{:<48} {:>10} {:>10} {:>10}'.format(
+            'stage', 'est.items', 'est.reqs', 'requests')]
+        shown = set()
+
+        def show(stats, depth):
+            items, requests = estimates[stats.id]
+            name = '  '*depth + stats.name
+            if stats.id in shown:
+                lines.append(name + ' (see above)')
+                return
+            shown.add(stats.id)
+            lines.append('{:<48} {:>10} {:>10} {:>10}'.format(
+                name, items, requests, actual.get(stats.id, '-')))
+            for input_id in stats.inputs:
+                if input_id in by_id:
+                    show(by_id[input_id], depth + 1)
+
+        for stats in reversed(self.planned):
+            if stats.id not in consumed:
+                show(stats, 0)
+        lines.append('estimated requests: {}'.format(
+            sum(r for n, r in estimates.values())))
+        if self.ran:
+            lines.append('actual requests: {}'.format(
+                self.collector.requests))
+        if self.budget is not None:
+            lines.append('budget: {}{}'.format(
+                self.budget, ' (exceeded, aborted)' if self.aborted else ''))
+        return '\n'.join(lines)
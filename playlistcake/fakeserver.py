@@ -0,0 +1,697 @@
+"""
+Local stand-in for the spotify web api, serving a synthetic
+catalogue, for load testing without network access.
+
+    with FakeSpotifyServer(Catalogue(artists=500), latency=0.05) as server:
+        sessionenv.set('spotify_kwargs', server.spotify_kwargs())
+        set_session_token(server.token())
+        ... run pipelines ...
+        print(server.metrics())
+
+Or run it standalone:
+
+    python -m playlistcake.fakeserver --port 8000 --artists 1000
+
+It covers the endpoints playlistcake uses: the user profile,
+saved tracks and albums, followed artists (cursor paged), top
+items, playlists, albums, tracks, artists, audio features,
+recommendations, search and artist albums/top tracks.
+Lists are offset paged like the real api.
+Requests can be slowed down with `latency` and throttled with
+429 responses, either at random (`error_rate`) or when they
+exceed `rate_limit` requests per second.
+"""
+
+import argparse
+import json
+import random
+import re
+import string
+import threading
+import time
+from collections import Counter, deque
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qsl, urlencode
+
+from .ratelimit import endpoint_name
+
+_id_chars = string.ascii_letters + string.digits
+
+FEATURES = {
+    'acousticness': (0, 1),
+    'danceability': (0, 1),
+    'energy': (0, 1),
+    'instrumentalness': (0, 1),
+    'liveness': (0, 1),
+    'loudness': (-40, 0),
+    'speechiness': (0, 1),
+    'tempo': (50, 200),
+    'valence': (0, 1),
+}
+
+GENRES = ('rock', 'pop', 'jazz', 'blues', 'folk', 'hip hop',
+          'electronic', 'metal', 'soul', 'country')
+
+
+def _simple(obj, *fields):
+    return {k: obj[k] for k in ('id', 'uri', 'name', 'type') + fields
+            if k in obj}
+
+
+class Catalogue(object):
+    """
+    Synthetic artists, albums and tracks plus one user's
+    library, generated from `seed`.
+    """
+    def __init__(self, artists=100, albums_per_artist=5,
+                 tracks_per_album=10, saved_tracks=500, saved_albums=100,
+                 followed_artists=50, playlists=10, seed=0,
+                 user_id='fakeuser', country='US'):
+        self.rng = random.Random(seed)
+        self.user = {'id': user_id, 'uri': 'spotify:user:' + user_id,
+                     'type': 'user', 'display_name': user_id,
+                     'country': country}
+        self.artists = {}
+        self.albums = {}
+        self.tracks = {}
+        self.features = {}
+        self.artist_albums = {}
+        self._lock = threading.Lock()
+        for i in range(artists):
+            artist = self._add_artist(i)
+            for j in range(albums_per_artist):
+                self._add_album(artist, j, tracks_per_album)
+        self.track_ids = list(self.tracks)
+        self.album_ids = list(self.albums)
+        self.artist_ids = list(self.artists)
+
+        now = datetime(2017, 6, 1)
+        self.saved_tracks = self._saved(
+            self.track_ids, saved_tracks, now, 'track', self.tracks)
+        self.saved_albums = self._saved(
+            self.album_ids, saved_albums, now, 'album', self.albums)
+        self.followed = sorted(self._sample(self.artist_ids,
+                                            followed_artists))
+        self.playlists = {}
+        for i in range(playlists):
+            playlist = self.create_playlist('Playlist {}'.format(i))
+            playlist['tracks'] = [
+                {'added_at': '2017-01-01T00:00:00Z', 'track': self.tracks[tid]}
+                for tid in self._sample(self.track_ids,
+                                        self.rng.randint(0, 100))]
+
+    def _id(self):
+        return ''.join(self.rng.choice(_id_chars) for i in range(22))
+
+    def _sample(self, population, k):
+        return self.rng.sample(population, min(k, len(population)))
+
+    def _add_artist(self, i):
+        aid = self._id()
+        artist = self.artists[aid] = {
+            'id': aid, 'uri': 'spotify:artist:' + aid, 'type': 'artist',
+            'name': 'Artist {}'.format(i),
+            'genres': self._sample(GENRES, 2),
+            'popularity': self.rng.randint(0, 100)}
+        self.artist_albums[aid] = []
+        return artist
+
+    def _add_album(self, artist, j, tracks_per_album):
+        aid = self._id()
+        album = self.albums[aid] = {
+            'id': aid, 'uri': 'spotify:album:' + aid, 'type': 'album',
+            'name': '{} {}'.format(artist['name'], j),
+            'album_type': self.rng.choice(('album', 'album', 'single')),
+            'artists': [_simple(artist)],
+            'genres': artist['genres'],
+            'release_date': '{}-{:02d}-{:02d}'.format(
+                self.rng.randint(1960, 2017), self.rng.randint(1, 12),
+                self.rng.randint(1, 28)),
+            'release_date_precision': 'day',
+            'popularity': self.rng.randint(0, 100)}
+        self.artist_albums[artist['id']].append(aid)
+        simple_tracks = []
+        for n in range(tracks_per_album):
+            tid = self._id()
+            track = self.tracks[tid] = {
+                'id': tid, 'uri': 'spotify:track:' + tid, 'type': 'track',
+                'name': '{} track {}'.format(album['name'], n + 1),
+                'artists': [_simple(artist)],
+                'album': _simple(album, 'album_type', 'artists',
+                                 'release_date', 'release_date_precision'),
+                'duration_ms': self.rng.randint(60000, 600000),
+                'popularity': self.rng.randint(0, 100),
+                'track_number': n + 1,
+                'explicit': False}
+            features = {k: round(self.rng.uniform(low, high), 3)
+                        for k, (low, high) in FEATURES.items()}
+            features.update(
+                id=tid, uri=track['uri'], type='audio_features',
+                key=self.rng.randint(0, 11), mode=self.rng.randint(0, 1),
+                time_signature=4, duration_ms=track['duration_ms'])
+            self.features[tid] = features
+            simple_tracks.append(_simple(
+                track, 'artists', 'duration_ms', 'track_number'))
+        album['tracks'] = simple_tracks
+
+    def _saved(self, ids, count, now, kind, objects):
+        items = []
+        added = now
+        for oid in self._sample(ids, count):
+            added -= timedelta(hours=self.rng.randint(1, 200))
+            items.append({'added_at': added.strftime('%Y-%m-%dT%H:%M:%SZ'),
+                          kind: objects[oid]})
+        return items
+
+    def create_playlist(self, name, public=True):
+        pid = self._id()
+        playlist = self.playlists[pid] = {
+            'id': pid, 'uri': 'spotify:user:{}:playlist:{}'.format(
+                self.user['id'], pid),
+            'type': 'playlist', 'name': name, 'public': public,
+            'owner': _simple(self.user), 'snapshot_id': self._id(),
+            'tracks': []}
+        return playlist
+
+
+class ApiError(Exception):
+    def __init__(self, status, message):
+        super(ApiError, self).__init__(message)
+        self.status = status
+        self.message = message
+
+
+def _ids(value, maximum):
+    ids = [i for i in value.split(',') if i]
+    if len(ids) > maximum:
+        raise ApiError(400, 'Too many ids requested')
+    return ids
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def _handle(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        status, content, headers = self.server.handle_api(
+            self.command, self.path, self.headers, body)
+        data = json.dumps(content).encode() if content is not None else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    do_GET = do_POST = do_PUT = do_DELETE = _handle
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeSpotifyServer(ThreadingHTTPServer):
+    """
+    Serves `catalogue` (a default Catalogue if not given)
+    on host:port, port 0 picks a free one.
+    latency: seconds each request takes, plus a random
+             amount up to `jitter`
+    error_rate: fraction of requests answered with 429
+    rate_limit: requests per second over which requests
+                are answered with 429
+    retry_after: Retry-After seconds sent with 429 responses
+    seed: seed of the random latency and errors
+    """
+    daemon_threads = True
+
+    def __init__(self, catalogue=None, host='127.0.0.1', port=0,
+                 latency=0, jitter=0, error_rate=0, rate_limit=None,
+                 retry_after=1, seed=None):
+        super(FakeSpotifyServer, self).__init__((host, port), _Handler)
+        self.catalogue = catalogue or Catalogue()
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.retry_after = retry_after
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._recent = deque()
+        self._requests = Counter()
+        self._throttled = Counter()
+        self._thread = None
+        self.routes = [
+            ('GET', r'me', self.me),
+            ('GET', r'me/tracks', self.saved_tracks),
+            ('GET', r'me/albums', self.saved_albums),
+            ('GET', r'me/following', self.followed_artists),
+            ('GET', r'me/top/(artists|tracks)', self.top),
+            ('GET', r'albums', self.several_albums),
+            ('GET', r'albums/(\w+)', self.album),
+            ('GET', r'albums/(\w+)/tracks', self.album_tracks),
+            ('GET', r'tracks', self.several_tracks),
+            ('GET', r'tracks/(\w+)', self.track),
+            ('GET', r'artists', self.several_artists),
+            ('GET', r'artists/(\w+)', self.artist),
+            ('GET', r'artists/(\w+)/albums', self.artist_albums),
+            ('GET', r'artists/(\w+)/top-tracks', self.artist_top_tracks),
+            ('GET', r'audio-features', self.audio_features),
+            ('GET', r'recommendations', self.recommendations),
+            ('GET', r'search', self.search),
+            ('GET', r'users/([^/]+)/playlists', self.user_playlists),
+            ('POST', r'users/([^/]+)/playlists', self.create_playlist),
+            ('GET', r'users/([^/]+)/playlists/(\w+)', self.playlist),
+            ('GET', r'users/([^/]+)/playlists/(\w+)/tracks',
+             self.playlist_tracks),
+            ('POST', r'users/([^/]+)/playlists/(\w+)/tracks',
+             self.add_playlist_tracks),
+            ('PUT', r'users/([^/]+)/playlists/(\w+)/tracks',
+             self.reorder_playlist_tracks),
+            ('DELETE', r'users/([^/]+)/playlists/(\w+)/tracks',
+             self.remove_playlist_tracks),
+        ]
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return 'http://{}:{}/'.format(host, port)
+
+    @property
+    def prefix(self):
+        return self.url + 'v1/'
+
+    def spotify_kwargs(self):
+        """
+        `spotify_kwargs` session variable pointing
+        the spotify client at this server.
+        """
+        return {'prefix': self.prefix}
+
+    def token(self):
+        """
+        A token the server accepts which doesn't expire
+        for a day.
+        """
+        return {'access_token': 'fake', 'refresh_token': None,
+                'token_type': 'Bearer',
+                'expires_at': int(time.time()) + 24*3600}
+
+    def start(self):
+        """
+        Serve in a background thread.
+        """
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self._thread:
+            self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def metrics(self):
+        """
+        Requests and 429 responses per endpoint.
+        """
+        with self._lock:
+            return {endpoint: {'requests': count,
+                               'throttled': self._throttled[endpoint]}
+                    for endpoint, count in self._requests.items()}
+
+    def _throttle(self):
+        with self._lock:
+            if self.rate_limit:
+                now = time.monotonic()
+                while self._recent and self._recent[0] < now - 1:
+                    self._recent.popleft()
+                if len(self._recent) >= self.rate_limit:
+                    return True
+                self._recent.append(now)
+            return self._rng.random() < self.error_rate
+
+    def handle_api(self, method, path, headers, body):
+        """
+        Returns (status, json content, headers) for a request.
+        """
+        parts = urlsplit(path)
+        endpoint = endpoint_name(parts.path)
+        with self._lock:
+            self._requests[endpoint] += 1
+        delay = self.latency + self._rng.uniform(0, self.jitter)
+        if delay:
+            time.sleep(delay)
+        if not (headers.get('Authorization') or '').startswith('Bearer '):
+            return _error(401, 'No token provided')
+        if self._throttle():
+            with self._lock:
+                self._throttled[endpoint] += 1
+            return (429, _error(429, 'API rate limit exceeded')[1],
+                    {'Retry-After': str(self.retry_after)})
+        query = {}
+        for key, value in parse_qsl(parts.query):
+            # Lists are sent either comma separated or repeated
+            query[key] = query[key] + ',' + value if key in query else value
+        payload = json.loads(body.decode()) if body else None
+        route_path = parts.path.strip('/')
+        if route_path.startswith('v1/'):
+            route_path = route_path[3:]
+        for route_method, pattern, view in self.routes:
+            match = re.fullmatch(pattern, route_path)
+            if match and route_method == method:
+                try:
+                    content = view(query, payload, *match.groups())
+                except ApiError as e:
+                    return _error(e.status, e.message)
+                except (KeyError, ValueError, TypeError) as e:
+                    return _error(400, 'Bad request: {}'.format(e))
+                return 200, content, {}
+        return _error(404, 'Service not found')
+
+    # Paging
+
+    def _next_url(self, endpoint, query, **changes):
+        return '{}{}?{}'.format(
+            self.prefix, endpoint, urlencode(dict(query, **changes)))
+
+    def _page(self, endpoint, query, items, max_limit=50):
+        limit = int(query.get('limit', 20))
+        offset = int(query.get('offset', 0))
+        if not 0 < limit <= max_limit:
+            raise ApiError(400, 'Invalid limit')
+        nxt = prev = None
+        if offset + limit < len(items):
+            nxt = self._next_url(endpoint, query, offset=offset + limit)
+        if offset > 0:
+            prev = self._next_url(
+                endpoint, query, offset=max(0, offset - limit))
+        return {'href': self._next_url(endpoint, query),
+                'items': items[offset:offset + limit],
+                'limit': limit, 'offset': offset, 'total': len(items),
+                'next': nxt, 'previous': prev}
+
+    def _album(self, aid):
+        album = dict(self.catalogue.albums[aid])
+        album['tracks'] = self._page(
+            'albums/{}/tracks'.format(aid), {'limit': 50},
+            album['tracks'])
+        return album
+
+    def _get(self, objects, oid, kind):
+        if oid not in objects:
+            raise ApiError(404, 'non existing {} id'.format(kind))
+        return objects[oid]
+
+    # Endpoints
+
+    def me(self, query, payload):
+        return self.catalogue.user
+
+    def saved_tracks(self, query, payload):
+        return self._page('me/tracks', query, self.catalogue.saved_tracks)
+
+    def saved_albums(self, query, payload):
+        items = [{'added_at': item['added_at'],
+                  'album': self._album(item['album']['id'])}
+                 for item in self.catalogue.saved_albums]
+        return self._page('me/albums', query, items)
+
+    def followed_artists(self, query, payload):
+        if query.get('type') != 'artist':
+            raise ApiError(400, 'type must be artist')
+        limit = int(query.get('limit', 20))
+        ids = self.catalogue.followed
+        after = query.get('after')
+        start = ids.index(after) + 1 if after in ids else 0
+        page = ids[start:start + limit]
+        nxt = None
+        if start + limit < len(ids):
+            nxt = self._next_url('me/following', query, after=page[-1])
+        return {'artists': {
+            'href': self._next_url('me/following', query),
+            'items': [self.catalogue.artists[aid] for aid in page],
+            'limit': limit, 'next': nxt, 'total': len(ids),
+            'cursors': {'after': page[-1] if nxt else None}}}
+
+    def top(self, query, payload, kind):
+        objects = getattr(self.catalogue, kind)
+        items = sorted(objects.values(), key=lambda o: -o['popularity'])
+        return self._page('me/top/' + kind, query, items)
+
+    def several_albums(self, query, payload):
+        return {'albums': [self._album(aid)
+                           if aid in self.catalogue.albums else None
+                           for aid in _ids(query['ids'], 20)]}
+
+    def album(self, query, payload, aid):
+        self._get(self.catalogue.albums, aid, 'album')
+        return self._album(aid)
+
+    def album_tracks(self, query, payload, aid):
+        album = self._get(self.catalogue.albums, aid, 'album')
+        return self._page('albums/{}/tracks'.format(aid), query,
+                          album['tracks'])
+
+    def several_tracks(self, query, payload):
+        return {'tracks': [self.catalogue.tracks.get(tid)
+                           for tid in _ids(query['ids'], 50)]}
+
+    def track(self, query, payload, tid):
+        return self._get(self.catalogue.tracks, tid, 'track')
+
+    def several_artists(self, query, payload):
+        return {'artists': [self.catalogue.artists.get(aid)
+                            for aid in _ids(query['ids'], 50)]}
+
+    def artist(self, query, payload, aid):
+        return self._get(self.catalogue.artists, aid, 'artist')
+
+    def artist_albums(self, query, payload, aid):
+        self._get(self.catalogue.artists, aid, 'artist')
+        types = query.get('album_type', 'album,single').split(',')
+        items = []
+        for album_id in self.catalogue.artist_albums[aid]:
+            album = self.catalogue.albums[album_id]
+            if album['album_type'] in types:
+                items.append({k: v for k, v in album.items()
+                              if k != 'tracks'})
+        return self._page('artists/{}/albums'.format(aid), query, items)
+
+    def artist_top_tracks(self, query, payload, aid):
+        self._get(self.catalogue.artists, aid, 'artist')
+        tracks = [self.catalogue.tracks[t['id']]
+                  for album_id in self.catalogue.artist_albums[aid]
+                  for t in self.catalogue.albums[album_id]['tracks']]
+        tracks.sort(key=lambda t: -t['popularity'])
+        return {'tracks': tracks[:10]}
+
+    def audio_features(self, query, payload):
+        return {'audio_features': [self.catalogue.features.get(tid)
+                                   for tid in _ids(query['ids'], 100)]}
+
+    def recommendations(self, query, payload):
+        seeds = []
+        for kind in ('artists', 'tracks', 'genres'):
+            seeds += [{'id': s, 'type': kind[:-1]} for s in
+                      _ids(query.get('seed_' + kind, ''), 5)]
+        if not seeds or len(seeds) > 5:
+            raise ApiError(400, 'Between 1 and 5 seeds are needed')
+        limit = int(query.get('limit', 20))
+        if not 0 < limit <= 100:
+            raise ApiError(400, 'Invalid limit')
+        rng = random.Random(','.join(s['id'] for s in seeds))
+        candidates = self.catalogue.track_ids
+        tracks = []
+        for tid in rng.sample(candidates, min(len(candidates), limit*5)):
+            features = self.catalogue.features[tid]
+            if _matches(features, query):
+                tracks.append(self.catalogue.tracks[tid])
+                if len(tracks) == limit:
+                    break
+        return {'tracks': tracks, 'seeds': seeds}
+
+    def search(self, query, payload):
+        # 'artist:Tom Waits album:Mule' or free text
+        parts = re.split(r'(\w+):', query.get('q', ''))
+        text = parts[0].strip().lower()
+        terms = {field: value.strip()
+                 for field, value in zip(parts[1::2], parts[2::2])}
+        result = {}
+        for kind in query.get('type', 'track').split(','):
+            objects = getattr(self.catalogue, kind + 's').values()
+            items = [o for o in objects if _search_match(o, kind, terms, text)]
+            result[kind + 's'] = self._page('search', query, items)
+        return result
+
+    def user_playlists(self, query, payload, user):
+        items = [dict(p, tracks={'total': len(p['tracks'])})
+                 for p in self.catalogue.playlists.values()
+                 if p['owner']['id'] == user]
+        return self._page('users/{}/playlists'.format(user), query, items)
+
+    def create_playlist(self, query, payload, user):
+        if user != self.catalogue.user['id']:
+            raise ApiError(403, 'You cannot create a playlist for another user')
+        with self.catalogue._lock:
+            playlist = self.catalogue.create_playlist(
+                payload['name'], payload.get('public', True))
+        return dict(playlist, tracks={'total': 0})
+
+    def _playlist(self, pid):
+        return self._get(self.catalogue.playlists, pid, 'playlist')
+
+    def playlist(self, query, payload, user, pid):
+        playlist = self._playlist(pid)
+        return dict(playlist, tracks=self._page(
+            'users/{}/playlists/{}/tracks'.format(user, pid),
+            {'limit': 100}, playlist['tracks'], 100))
+
+    def playlist_tracks(self, query, payload, user, pid):
+        return self._page('users/{}/playlists/{}/tracks'.format(user, pid),
+                          query, self._playlist(pid)['tracks'], 100)
+
+    def _check_snapshot(self, playlist, payload):
+        # The real api applies changes to the given snapshot,
+        # here they just fail if the playlist changed since
+        snapshot = payload.get('snapshot_id')
+        if snapshot and snapshot != playlist['snapshot_id']:
+            raise ApiError(400, 'Playlist changed since snapshot')
+
+    def _changed(self, playlist):
+        playlist['snapshot_id'] = self.catalogue._id()
+        return {'snapshot_id': playlist['snapshot_id']}
+
+    def add_playlist_tracks(self, query, payload, user, pid):
+        uris = payload if isinstance(payload, list) else payload['uris']
+        if len(uris) > 100:
+            raise ApiError(400, 'You can add a maximum of 100 tracks')
+        now = datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
+        items = [{'added_at': now,
+                  'track': self._get(self.catalogue.tracks,
+                                     uri.split(':')[-1], 'track')}
+                 for uri in uris]
+        with self.catalogue._lock:
+            playlist = self._playlist(pid)
+            position = int(query.get('position', len(playlist['tracks'])))
+            playlist['tracks'][position:position] = items
+            return self._changed(playlist)
+
+    def reorder_playlist_tracks(self, query, payload, user, pid):
+        with self.catalogue._lock:
+            playlist = self._playlist(pid)
+            tracks = playlist['tracks']
+            self._check_snapshot(playlist, payload)
+            if 'uris' in payload:
+                if len(payload['uris']) > 100:
+                    raise ApiError(
+                        400, 'You can set a maximum of 100 tracks')
+                tracks[:] = [{'added_at': '2017-01-01T00:00:00Z',
+                              'track': self.catalogue.tracks[
+                                  uri.split(':')[-1]]}
+                             for uri in payload['uris']]
+                return self._changed(playlist)
+            start = payload['range_start']
+            length = payload.get('range_length', 1)
+            before = payload['insert_before']
+            block = tracks[start:start + length]
+            if before > start:
+                tracks[before:before] = block
+                del tracks[start:start + length]
+            else:
+                del tracks[start:start + length]
+                tracks[before:before] = block
+            return self._changed(playlist)
+
+    def remove_playlist_tracks(self, query, payload, user, pid):
+        if len(payload['tracks']) > 100:
+            raise ApiError(400, 'You can remove a maximum of 100 tracks')
+        with self.catalogue._lock:
+            playlist = self._playlist(pid)
+            tracks = playlist['tracks']
+            self._check_snapshot(playlist, payload)
+            remove = set()
+            for item in payload['tracks']:
+                tid = item['uri'].split(':')[-1]
+                positions = item.get('positions')
+                if positions is None:
+                    positions = [i for i, t in enumerate(tracks)
+                                 if t['track'] and t['track']['id'] == tid]
+                for i in positions:
+                    if i >= len(tracks) or not tracks[i]['track'] or \
+                       tracks[i]['track']['id'] != tid:
+                        raise ApiError(400, 'Track not at position')
+                    remove.add(i)
+            tracks[:] = [t for i, t in enumerate(tracks) if i not in remove]
+            return self._changed(playlist)
+
+
+def _error(status, message):
+    return status, {'error': {'status': status, 'message': message}}, {}
+
+
+def _matches(features, query):
+    for key, value in query.items():
+        prefix, _, field = key.partition('_')
+        if field not in features:
+            continue
+        if prefix == 'min' and features[field] < float(value):
+            return False
+        if prefix == 'max' and features[field] > float(value):
+            return False
+    return True
+
+
+def _search_match(obj, kind, terms, text):
+    if text and text not in obj['name'].lower():
+        return False
+    names = {'artist': [a['name'] for a in obj.get('artists', [obj])]
+             if kind != 'artist' else [obj['name']],
+             kind: [obj['name']]}
+    for field, value in terms.items():
+        value = value.lower()
+        if not any(value in name.lower() for name in names.get(field, [])):
+            return False
+    return True
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Serve a fake spotify web api.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--artists', type=int, default=100)
+    parser.add_argument('--albums-per-artist', type=int, default=5)
+    parser.add_argument('--tracks-per-album', type=int, default=10)
+    parser.add_argument('--saved-tracks', type=int, default=500)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--latency', type=float, default=0)
+    parser.add_argument('--jitter', type=float, default=0)
+    parser.add_argument('--error-rate', type=float, default=0)
+    parser.add_argument('--rate-limit', type=int)
+    args = parser.parse_args(argv)
+    catalogue = Catalogue(
+        artists=args.artists, albums_per_artist=args.albums_per_artist,
+        tracks_per_album=args.tracks_per_album,
+        saved_tracks=args.saved_tracks, seed=args.seed)
+    server = FakeSpotifyServer(
+        catalogue, args.host, args.port, latency=args.latency,
+        jitter=args.jitter, error_rate=args.error_rate,
+        rate_limit=args.rate_limit)
+    print('Serving fake spotify api at', server.prefix)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
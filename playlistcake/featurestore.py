@@ -0,0 +1,157 @@
+"""
+Columnar store of numeric track attributes (audio features,
+popularity and duration) for a set of tracks.
+Each attribute is a numpy float array indexed by track id,
+missing values are nan.
+Requires numpy.
+"""
+
+import json
+import os
+
+import numpy as np
+
+from .filters import compile_tuneables
+from .sources import with_audio_features
+
+FIELDS = (
+    'acousticness',
+    'danceability',
+    'duration_ms',
+    'energy',
+    'instrumentalness',
+    'key',
+    'liveness',
+    'loudness',
+    'mode',
+    'popularity',
+    'speechiness',
+    'tempo',
+    'time_signature',
+    'valence',
+    )
+
+
+def _track_value(track, field):
+    if field in ('popularity', 'duration_ms') and field in track:
+        return track[field]
+    features = track.get('audio_features') or {}
+    return features.get(field)
+
+
+class FeatureStore(object):
+    """
+    Holds one numpy column per field in FIELDS,
+    row i belongs to the track with id ids[i].
+    """
+    def __init__(self, ids, columns):
+        self.ids = list(ids)
+        self.index = {tid: i for i, tid in enumerate(self.ids)}
+        self.columns = columns
+
+    @classmethod
+    def from_tracks(cls, tracks):
+        """
+        Build a store from full track objects,
+        fetching their audio features.
+        """
+        ids = []
+        values = {field: [] for field in FIELDS}
+        for track in with_audio_features(tracks):
+            ids.append(track['id'])
+            for field in FIELDS:
+                values[field].append(_track_value(track, field))
+        columns = {field: np.array(v, dtype=float)
+                   for field, v in values.items()}
+        return cls(ids, columns)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, track_id):
+        return track_id in self.index
+
+    def column(self, field, ids=None):
+        """
+        Values of field for given track ids (or all tracks).
+        Tracks not in the store get nan.
+        """
+        col = self.columns[field]
+        if ids is None:
+            return np.asarray(col)
+        rows = np.array([self.index.get(tid, -1) for tid in ids],
+                        dtype=np.intp)
+        if len(rows) == 0:
+            return np.empty(0)
+        values = col[rows]
+        values[rows < 0] = np.nan
+        return values
+
+    def query(self, ids=None, margins=None, missing='exclude',
+              **tuneables):
+        """
+        Boolean mask over ids (or all tracks) of those
+        matching the tuneables (min_/max_/target_ as
+        in filters.tracks_filter_tuneables).
+        """
+        predicate = compile_tuneables(margins, missing, **tuneables)
+        size = len(self.ids) if ids is None else len(ids)
+        mask = np.ones(size, dtype=bool)
+        for field, low, high in predicate.ranges:
+            values = self.column(field, ids)
+            unknown = np.isnan(values)
+            if missing == 'error' and unknown.any():
+                raise ValueError('Missing values for {}'.format(field))
+            matches = (values >= low) & (values <= high)
+            if missing == 'include':
+                matches |= unknown
+            mask &= matches
+        return mask
+
+    def select(self, ids=None, **tuneables):
+        """
+        Returns the ids matching the tuneables.
+        """
+        ids = self.ids if ids is None else list(ids)
+        mask = self.query(ids, **tuneables)
+        return [tid for tid, match in zip(ids, mask) if match]
+
+    def argsort(self, field, ids=None, order='asc'):
+        """
+        Positions in ids (or all tracks) ordered by field.
+        The sort is stable and tracks without a value come last.
+        """
+        values = self.column(field, ids)
+        if order == 'desc':
+            values = -values
+        values = np.where(np.isnan(values), np.inf, values)
+        return np.argsort(values, kind='stable')
+
+    def sorted_ids(self, field, order='asc'):
+        return [self.ids[i] for i in self.argsort(field, order=order)]
+
+    def save(self, path):
+        """
+        Save to directory path, one .npy file per field.
+        """
+        os.makedirs(path, exist_ok=True)
+        for field, col in self.columns.items():
+            np.save(os.path.join(path, field + '.npy'), col)
+        with open(os.path.join(path, 'ids.json'), 'w') as f:
+            json.dump(self.ids, f)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """
+        Load a store saved with `save`.
+        Columns are memory-mapped read only if mmap is True.
+        """
+        with open(os.path.join(path, 'ids.json')) as f:
+            ids = json.load(f)
+        columns = {}
+        for field in FIELDS:
+            filename = os.path.join(path, field + '.npy')
+            if os.path.exists(filename):
+                columns[field] = np.load(
+                    filename, mmap_mode='r' if mmap else None)
+        return cls(ids, columns)
@@ -1,86 +1,186 @@
-import isodate
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
-from .util import iter_chunked
+from .util import get_ids, iter_chunked
 from .sources import several_albums, with_audio_features
 from .genutils import content_type, infer_content
+from .dedup import seen_set
 
 
-def _matches_tunables(track, **tuneables):
-    margins = {
-        'acousticness': 0.1,
-        'danceability': 0.1,
-        'duration_ms': 10000,
-        'energy': 0.1,
-        'instrumentalness': 0.1,
-        'key': 0,
-        'liveness': 0.1,
-        'loudness': 1,
-        'mode': 0,
-        'popularity': 5,
-        'speechiness': 0.1,
-        'tempo': 8,
-        'time_signature': 0,
-        'valence': 0.1
-        }
-    _track = track
-    is_match = True
-    for key, value in tuneables.items():
-        track = _track['audio_features']
-        if key.endswith('popularity'):
+# Default +/- margin for target_ tuneables
+DEFAULT_MARGINS = {
+    'acousticness': 0.1,
+    'danceability': 0.1,
+    'duration_ms': 10000,
+    'energy': 0.1,
+    'instrumentalness': 0.1,
+    'key': 0,
+    'liveness': 0.1,
+    'loudness': 1,
+    'mode': 0,
+    'popularity': 5,
+    'speechiness': 0.1,
+    'tempo': 8,
+    'time_signature': 0,
+    'valence': 0.1
+    }
+
+# Policies for tracks missing a tuneable value
+MISSING_POLICIES = ('exclude', 'include', 'error')
+
+
+class TuneablesPredicate(object):
+    """
+    Tuneables compiled to a (field, low, high) range per field.
+    Call with a track to test one track or use `batch`
+    to test a list of tracks at once.
+    Tracks missing a value (e.g. audio_features is None) are
+    treated according to `missing`:
+    'exclude' fails the track, 'include' ignores the tuneable
+    and 'error' raises a ValueError.
+    """
+    def __init__(self, tuneables, margins=None, missing='exclude'):
+        if missing not in MISSING_POLICIES:
+            raise ValueError(
+                'missing must be one of {}'.format(MISSING_POLICIES))
+        self.missing = missing
+        margins = dict(DEFAULT_MARGINS, **(margins or {}))
+        bounds = {}
+        for key, value in tuneables.items():
+            if key.startswith('min_'):
+                field, low, high = key[len('min_'):], value, float('inf')
+            elif key.startswith('max_'):
+                field, low, high = key[len('max_'):], float('-inf'), value
+            else:
+                if key.startswith('target_'):
+                    key = key[len('target_'):]
+                if key not in margins:
+                    raise ValueError('Unknown tuneable: {}'.format(key))
+                field = key
+                low, high = value - margins[key], value + margins[key]
+            # Several tuneables for one field narrow the range
+            old_low, old_high = bounds.get(
+                field, (float('-inf'), float('inf')))
+            bounds[field] = (max(low, old_low), min(high, old_high))
+        self.ranges = [(f, low, high) for f, (low, high) in bounds.items()]
+
+    def _value(self, track, field):
+        if field == 'popularity':
             # Popularity is not under audio_features, but include it anyway
-            track = _track
-        if key.startswith('min_'):
-            key = key[len('min_'):]
-            is_match = track[key] >= value
-        elif key.startswith('max_'):
-            key = key[len('max_'):]
-            is_match = track[key] <= value
-        elif key.startswith('target_') or key in margins:
-            key = key[len('target_'):]
-            margin = margins[key]
-            low = value - margin
-            high = value + margin
-            is_match = low <= track[key] <= high
-        if not is_match:
-            return False
-    return is_match
+            value = track.get(field)
+        else:
+            features = track.get('audio_features') or {}
+            value = features.get(field)
+        if value is None and self.missing == 'error':
+            raise ValueError('Track {} has no {}'.format(
+                track.get('id'), field))
+        return value
+
+    def __call__(self, track):
+        for field, low, high in self.ranges:
+            value = self._value(track, field)
+            if value is None:
+                if self.missing == 'include':
+                    continue
+                return False
+            if not low <= value <= high:
+                return False
+        return True
+
+    def batch(self, tracks):
+        """
+        Returns a list of booleans, one per track.
+        Uses numpy array comparisons when numpy is installed.
+        """
+        if np is None:
+            return [self(track) for track in tracks]
+        result = np.ones(len(tracks), dtype=bool)
+        for field, low, high in self.ranges:
+            values = np.array(
+                [self._value(track, field) for track in tracks],
+                dtype=float)
+            # None becomes nan, which fails both comparisons
+            matches = (values >= low) & (values <= high)
+            if self.missing == 'include':
+                matches |= np.isnan(values)
+            result &= matches
+        return result.tolist()
+
+
+def compile_tuneables(margins=None, missing='exclude', **tuneables):
+    """
+    Compile tuneables (optionally prefixed by min_/max_/target_)
+    to a TuneablesPredicate.
+    """
+    return TuneablesPredicate(tuneables, margins=margins, missing=missing)
 
 
 @infer_content
-def tracks_filter_tuneables(tracks, invert=False, **tuneables):
+def tracks_filter_tuneables(tracks, invert=False, margins=None,
+                            missing='exclude', store=None, **tuneables):
     """
     Filter tracks by audio_features (**tuneables).
     Tuneables may be prefixed by min_/max_/target_
+    margins overrides DEFAULT_MARGINS for target_ tuneables.
+    missing is the policy for tracks without audio features,
+    see TuneablesPredicate.
+    If a featurestore.FeatureStore is given as store, values
+    are read from it instead of fetching audio features.
+    If invert is True, yield the tracks that don't match.
     """
-    for track in with_audio_features(tracks):
-        if _matches_tunables(track, **tuneables):
-            yield track
-        elif invert:
-            yield track
+    if store is not None:
+        for chunk in iter_chunked(tracks, 100):
+            mask = store.query(get_ids(chunk), margins=margins,
+                               missing=missing, **tuneables)
+            for track, is_match in zip(chunk, mask):
+                if is_match != invert:
+                    yield track
+        return
+    predicate = compile_tuneables(margins, missing, **tuneables)
+    for chunk in iter_chunked(with_audio_features(tracks), 100):
+        for track, is_match in zip(chunk, predicate.batch(chunk)):
+            if is_match != invert:
+                yield track
+
+
+def release_year(album):
+    """
+    Year of album['release_date'], which is 'YYYY',
+    'YYYY-MM' or 'YYYY-MM-DD' depending on
+    album['release_date_precision'].
+    """
+    return int(album['release_date'][:4])
 
 
 def _albums_filter_release_years(albums, start=1990, end=2000, invert=False):
     for album in albums:
-        rdate = isodate.parse_date(album['release_date'])
-        if start <= rdate.year <= end:
-            yield album
-        elif invert:
+        if (start <= release_year(album) <= end) != invert:
             yield album
 
 
 def _tracks_filter_release_years(tracks, start=1990, end=2000, invert=False):
     """
-    Assumes full track objects.
+    Reads the release date of the album embedded in the track.
+    Albums without a release date (simplified objects)
+    are looked up in batches.
     """
     for chunk in iter_chunked(tracks, 20):
-        aids = [track['album']['id'] for track in chunk]
-        albums = several_albums(aids)
-        for i, album in enumerate(albums):
-            rdate = isodate.parse_date(album['release_date'])
-            if start <= rdate.year <= end:
-                yield chunk[i]
-            elif invert:
-                yield album
+        missing = [track['album']['id'] for track in chunk
+                   if 'release_date' not in track['album']]
+        albums = {}
+        if missing:
+            albums = {album['id']: album
+                      for album in several_albums(missing) if album}
+        for track in chunk:
+            album = track['album']
+            if 'release_date' not in album:
+                album = albums.get(album['id'])
+                if album is None:
+                    continue
+            if (start <= release_year(album) <= end) != invert:
+                yield track
 
 
 @infer_content
@@ -96,16 +196,17 @@ def filter_release_years(items, start=1990, end=2000, invert=False):
 
 
 @infer_content
-def filter_unique(tracks):
+def filter_unique(tracks, mode='exact', **options):
     """
     Filter that yields each unique item only once.
+    mode and options are passed to dedup.seen_set,
+    e.g. mode='window', window=500 only drops items
+    seen in the last 500 unique items.
     """
-    used = set()
+    seen = seen_set(mode, **options)
     for track in tracks:
-        if track['id'] in used:
-            continue
-        used.add(track['id'])
-        yield track
+        if seen.add(track['id']):
+            yield track
 
 
 @infer_content
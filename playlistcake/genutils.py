@@ -1,11 +1,16 @@
 """
 This module is for adding and keeping track of faux attributes
 on generator objects.
+Works the same for generators and async generators.
+The generators are also where pipelines are instrumented
+(see playlistcake.instrument).
 """
 
 from functools import wraps
 import weakref
 
+from . import instrument
+
 content_types = weakref.WeakKeyDictionary()
 
 
@@ -13,8 +18,14 @@ def content_type(genobj):
     """
     Returns the stored content type of
     given generator.
+    Returns None for objects without a content type,
+    e.g. plain lists.
     """
-    return content_types.get(genobj)
+    try:
+        return content_types.get(genobj)
+    except TypeError:
+        # Not weak referencable
+        return None
 
 
 def yields(item_type):
@@ -24,7 +35,7 @@ def yields(item_type):
     def decorator(func):
         @wraps(func)
         def func_wrapper(*args, **kwargs):
-            gen = func(*args, **kwargs)
+            gen = instrument.call_stage(func, args, kwargs, item_type)
             content_types[gen] = item_type
             return gen
         return func_wrapper
@@ -40,7 +51,7 @@ def infer_content(func):
     def func_wrapper(*args, **kwargs):
         # First arg should be parent generator (items)
         item_type = content_type(args[0])
-        gen = func(*args, **kwargs)
+        gen = instrument.call_stage(func, args, kwargs, item_type)
         content_types[gen] = item_type
         return gen
     return func_wrapper
@@ -0,0 +1,387 @@
+"""
+Opt-in per stage instrumentation of pipelines.
+
+Every generator created by a function decorated with
+genutils.yields or genutils.infer_content, and every
+spotify.iterate_results call, is a stage.
+When a collector is set for the session, stages record:
+
+- items_in: items pulled from upstream stages
+- items_out: items yielded
+- upstream_time: seconds spent waiting on upstream stages
+- own_time: seconds spent in the stage itself
+- requests, bytes: api requests made by the stage (per endpoint
+  in `endpoints`) and the size of their responses
+
+Stats also hold the call's scalar arguments (`params`) and the
+length of its first argument if that is a list (`input_size`).
+
+    collector = MemoryCollector()
+    set_collector(collector)
+    ... run pipelines ...
+    print(collector.to_json())
+
+Only sync generators are instrumented, async generators
+are passed through untouched.
+"""
+
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+import contextvars
+from functools import wraps
+import inspect
+import itertools
+import json
+import threading
+import time
+
+from . import sessionenv
+
+_local = threading.local()
+_ids = itertools.count(1)
+# Collector set by use_collector, overriding the session's
+_scoped = contextvars.ContextVar('playlistcake_stage_collector',
+                                 default=None)
+
+
+def _stack():
+    try:
+        return _local.stack
+    except AttributeError:
+        _local.stack = []
+        return _local.stack
+
+
+class StageStats(object):
+    """
+    Counters of one stage, i.e. one generator.
+    consumer is the id of the stage pulling from this
+    one, inputs the ids of stages passed to it.
+    """
+    def __init__(self, name, inputs=()):
+        self.id = next(_ids)
+        self.name = name
+        self.inputs = list(inputs)
+        self.params = {}
+        self.input_size = None
+        self.consumer = None
+        self.content_type = None
+        self.items_in = 0
+        self.items_out = 0
+        self.total_time = 0.0
+        self.upstream_time = 0.0
+        self.requests = 0
+        self.bytes = 0
+        self.endpoints = Counter()
+        self.finished = False
+        self.error = None
+        self.lock = threading.Lock()
+
+    @property
+    def own_time(self):
+        return self.total_time - self.upstream_time
+
+    def as_dict(self):
+        return OrderedDict([
+            ('id', self.id),
+            ('name', self.name),
+            ('content_type', self.content_type),
+            ('inputs', self.inputs),
+            ('params', self.params),
+            ('consumer', self.consumer),
+            ('items_in', self.items_in),
+            ('items_out', self.items_out),
+            ('own_time', round(self.own_time, 6)),
+            ('upstream_time', round(self.upstream_time, 6)),
+            ('requests', self.requests),
+            ('bytes', self.bytes),
+            ('endpoints', dict(self.endpoints)),
+            ('finished', self.finished),
+            ('error', self.error),
+        ])
+
+
+class Collector(object):
+    """
+    Base class of collectors, which are told when a stage
+    is created and when it is exhausted or closed.
+    Stats keep updating between the two.
+    They are also told before and after every api request
+    (stats is None for requests made outside any stage).
+    before_request may raise to stop the request.
+    """
+    def stage_started(self, stats):
+        pass
+
+    def stage_finished(self, stats):
+        pass
+
+    def before_request(self, stats, endpoint):
+        pass
+
+    def after_request(self, stats, endpoint, nbytes):
+        pass
+
+
+class MemoryCollector(Collector):
+    """
+    Keeps the stats of all stages.
+    """
+    def __init__(self):
+        self.stages = []
+        self._lock = threading.Lock()
+
+    def stage_started(self, stats):
+        with self._lock:
+            self.stages.append(stats)
+
+    def clear(self):
+        with self._lock:
+            self.stages = []
+
+    def summary(self):
+        """
+        Stats added up per stage name, in order of
+        first appearance.
+        """
+        totals = OrderedDict()
+        for stats in list(self.stages):
+            t = totals.setdefault(stats.name, OrderedDict([
+                ('runs', 0), ('items_in', 0), ('items_out', 0),
+                ('own_time', 0.0), ('upstream_time', 0.0),
+                ('requests', 0), ('bytes', 0)]))
+            t['runs'] += 1
+            t['items_in'] += stats.items_in
+            t['items_out'] += stats.items_out
+            t['own_time'] += stats.own_time
+            t['upstream_time'] += stats.upstream_time
+            t['requests'] += stats.requests
+            t['bytes'] += stats.bytes
+        return totals
+
+    def to_json(self, path=None):
+        """
+        Returns the summary and per stage stats as json,
+        writing it to path if given.
+        """
+        data = json.dumps({
+            'summary': self.summary(),
+            'stages': [stats.as_dict() for stats in list(self.stages)],
+        }, indent=1)
+        if path:
+            with open(path, 'w') as f:
+                f.write(data)
+        return data
+
+
+def set_collector(collector):
+    """
+    Instrument pipelines of the current session,
+    reporting to collector. None turns it off.
+    """
+    sessionenv.set('stage_collector', collector)
+
+
+def get_collector():
+    collector = _scoped.get()
+    if collector is None:
+        collector = sessionenv.get('stage_collector')
+    return collector
+
+
+@contextmanager
+def use_collector(collector):
+    """
+    Report to collector (instead of the session's) inside
+    the block only, and in threads started by stages in it.
+    """
+    token = _scoped.set(collector)
+    try:
+        yield collector
+    finally:
+        _scoped.reset(token)
+
+
+def current_stage():
+    """
+    StageStats of the stage running in this thread, or None.
+    """
+    stack = _stack()
+    return stack[-1].stats if stack else None
+
+
+class _Stage(object):
+    """
+    Wraps a generator, recording its stats.
+    """
+    def __init__(self, gen, stats, collector):
+        self.gen = gen
+        self.stats = stats
+        self.collector = collector
+
+    def __iter__(self):
+        return self
+
+    def _step(self, method, *args):
+        stack = _stack()
+        parent = stack[-1] if stack else None
+        if parent is not None and self.stats.consumer is None:
+            self.stats.consumer = parent.stats.id
+        stack.append(self)
+        start = time.perf_counter()
+        try:
+            item = method(*args)
+        except StopIteration:
+            self._finish()
+            raise
+        except BaseException as e:
+            self._finish(repr(e))
+            raise
+        else:
+            self.stats.items_out += 1
+            if parent is not None:
+                parent.stats.items_in += 1
+            return item
+        finally:
+            elapsed = time.perf_counter() - start
+            stack.pop()
+            self.stats.total_time += elapsed
+            if parent is not None:
+                parent.stats.upstream_time += elapsed
+
+    def __next__(self):
+        return self._step(self.gen.__next__)
+
+    def send(self, value):
+        return self._step(self.gen.send, value)
+
+    def throw(self, *args):
+        return self._step(self.gen.throw, *args)
+
+    def close(self):
+        try:
+            self.gen.close()
+        finally:
+            self._finish()
+
+    def _finish(self, error=None):
+        if self.stats.finished:
+            return
+        self.stats.finished = True
+        self.stats.error = error
+        self.collector.stage_finished(self.stats)
+
+    def __del__(self):
+        self._finish()
+
+
+def stage(name, gen, inputs=(), content_type=None):
+    """
+    Returns gen wrapped as an instrumented stage when
+    a collector is set, otherwise gen itself.
+    Instrumented stages among inputs are recorded as
+    the stage's inputs.
+    """
+    collector = get_collector()
+    if collector is None or not inspect.isgenerator(gen):
+        return gen
+    return _start(collector, StageStats(name, _stage_ids(inputs)),
+                  gen, content_type)
+
+
+def call_stage(func, args, kwargs, content_type=None):
+    """
+    Call generator function func, returning the generator
+    as an instrumented stage when a collector is set.
+    """
+    gen = func(*args, **kwargs)
+    collector = get_collector()
+    if collector is None or not inspect.isgenerator(gen):
+        return gen
+    stats = StageStats(stage_name(func),
+                       _stage_ids(itertools.chain(args, kwargs.values())))
+    _describe_call(stats, func, args, kwargs)
+    return _start(collector, stats, gen, content_type)
+
+
+def _stage_ids(inputs):
+    return [i.stats.id for i in inputs if isinstance(i, _Stage)]
+
+
+def _start(collector, stats, gen, content_type):
+    stats.content_type = content_type
+    collector.stage_started(stats)
+    return _Stage(gen, stats, collector)
+
+
+_scalars = (int, float, str, bool, type(None))
+
+
+def _describe_call(stats, func, args, kwargs):
+    signature = inspect.signature(func)
+    try:
+        bound = signature.bind(*args, **kwargs)
+    except TypeError:
+        return
+    bound.apply_defaults()
+    for i, (name, value) in enumerate(bound.arguments.items()):
+        kind = signature.parameters[name].kind
+        if kind == inspect.Parameter.VAR_KEYWORD:
+            stats.params.update((k, v) for k, v in value.items()
+                                if isinstance(v, _scalars))
+        elif kind == inspect.Parameter.VAR_POSITIONAL:
+            continue
+        elif isinstance(value, _scalars):
+            stats.params[name] = value
+        elif i == 0 and isinstance(value, (list, tuple)):
+            stats.input_size = len(value)
+
+
+def stage_name(func):
+    return '{}.{}'.format(func.__module__.split('.')[-1], func.__qualname__)
+
+
+def before_request(endpoint):
+    """
+    Tell the collector an api request is about to be made.
+    """
+    collector = get_collector()
+    if collector is not None:
+        collector.before_request(current_stage(), endpoint)
+
+
+def record_request(endpoint, nbytes):
+    """
+    Count an api request made by the current stage.
+    """
+    collector = get_collector()
+    if collector is None:
+        return
+    stats = current_stage()
+    if stats is not None:
+        with stats.lock:
+            stats.requests += 1
+            stats.bytes += nbytes
+            stats.endpoints[endpoint] += 1
+    collector.after_request(stats, endpoint, nbytes)
+
+
+def carry(func):
+    """
+    Wrap func so api requests it makes in another
+    thread count towards the calling thread's stage.
+    """
+    stack = _stack()
+    if not stack:
+        return func
+    owner = stack[-1]
+
+    @wraps(func)
+    def func_wrapper(*args, **kwargs):
+        stack = _stack()
+        stack.append(owner)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            stack.pop()
+    return func_wrapper
@@ -1,11 +1,16 @@
 from datetime import datetime
 import itertools
+import json
+import os
+import tempfile
 
 import isodate
 
+from . import sessionenv
 from .util import get_limit
-from .spotify import iterate_results
+from .spotify import iterate_results, get_spotify, current_user
 from .genutils import yields, infer_content
+from .dedup import seen_set
 
 
 """
@@ -13,18 +18,126 @@ Methods dealing with the user library.
 """
 
 
+def set_library_dir(path):
+    """
+    Set the directory where snapshots of the user's
+    saved tracks and albums are kept for delta=True.
+    """
+    sessionenv.set('library_dir', path)
+
+
+def _snapshot_path(endpoint):
+    directory = sessionenv.get('library_dir')
+    if not directory:
+        raise ValueError('delta mode needs a library dir, '
+                         'see set_library_dir')
+    return os.path.join(
+        directory, '{}-{}.json'.format(current_user()['id'], endpoint))
+
+
+def _load_snapshot(path):
+    """
+    A missing or unreadable (e.g. cut short) snapshot is empty.
+    """
+    try:
+        with open(path) as f:
+            snapshot = json.load(f)
+    except (OSError, ValueError):
+        snapshot = None
+    if not isinstance(snapshot, dict) or \
+       not {'high_water_mark', 'items'} <= set(snapshot):
+        snapshot = {'high_water_mark': None, 'items': []}
+    return snapshot
+
+
+def _save_snapshot(path, snapshot):
+    # Written to a temporary file first, so a crash
+    # never leaves a partly written snapshot
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or '.',
+                               suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(snapshot, f)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def _delta_items(endpoint, kind):
+    """
+    Returns all saved items from endpoint, newest first.
+    Only items added since the stored snapshot are fetched,
+    paging stops at the first item already in the snapshot
+    (or older than its newest item).
+    Everything is fetched again when the snapshot doesn't line up
+    with what was read: the rest of the page where paging stopped
+    must match the start of the snapshot, and the new and stored
+    items must add up to the library's total.
+    Removals are only detected through those checks, so items
+    removed while others are added deeper in the library (e.g.
+    with older added_at dates) can still be returned, until a
+    later change shows up in them.
+    """
+    path = _snapshot_path(endpoint)
+    snapshot = _load_snapshot(path)
+    stored = snapshot['items']
+
+    def key(item):
+        return (item['added_at'], item[kind]['id'])
+
+    known = {key(item) for item in stored}
+    mark = snapshot['high_water_mark']
+
+    s = get_spotify()
+    result = getattr(s, endpoint)(limit=50)
+    total = result['total']
+    new = []
+    rest = None
+    while rest is None:
+        for i, item in enumerate(result['items']):
+            if key(item) in known or (mark and item['added_at'] < mark[0]):
+                rest = result['items'][i:]
+                break
+            new.append(item)
+        if rest is not None or not result['next']:
+            break
+        result = s.next(result)
+
+    items = new
+    if rest is not None:
+        # The snapshot's newest items are where paging stopped
+        consistent = [key(item) for item in rest] == \
+            [key(item) for item in stored[:len(rest)]]
+        items = new + stored if consistent else None
+    if items is None or len(items) != total:
+        items = list(iterate_results(endpoint, limit=50))
+    if items:
+        mark = [items[0]['added_at'], items[0][kind]['id']]
+    _save_snapshot(path, {'high_water_mark': mark, 'items': items})
+    return items
+
+
 @yields('albums')
-def saved_albums(max_results=None, album_only=False):
+def saved_albums(max_results=None, album_only=False, delta=False):
     """
     Yields saved album objects.
     {'album' full album, 'added_at': timestamp}
     If album_only==True, yield only album.
+    If delta==True, only albums saved since the last
+    run are fetched (see set_library_dir).
     """
     limit = get_limit(max_results, 50)
-    for item in iterate_results(
+    if delta:
+        items = itertools.islice(
+            _delta_items('current_user_saved_albums', 'album'),
+            max_results)
+    else:
+        items = iterate_results(
             'current_user_saved_albums',
             max_results=max_results,
-            limit=limit):
+            limit=limit)
+    for item in items:
         if album_only:
             yield item['album']
         else:
@@ -32,17 +145,25 @@ def saved_albums(max_results=None, album_only=False):
 
 
 @yields('tracks')
-def saved_tracks(max_results=None, track_only=False):
+def saved_tracks(max_results=None, track_only=False, delta=False):
     """
     Yields saved track objects.
     {'track' full track, 'added_at': timestamp}
     If track_only==True, yield only track.
+    If delta==True, only tracks saved since the last
+    run are fetched (see set_library_dir).
     """
     limit = get_limit(max_results, 50)
-    for item in iterate_results(
+    if delta:
+        items = itertools.islice(
+            _delta_items('current_user_saved_tracks', 'track'),
+            max_results)
+    else:
+        items = iterate_results(
             'current_user_saved_tracks',
             max_results=max_results,
-            limit=limit):
+            limit=limit)
+    for item in items:
         if track_only:
             yield item['track']
         else:
@@ -61,11 +182,12 @@ def followed_artists(max_results=None):
 
 
 @yields('artists')
-def saved_artists(max_results=None):
+def saved_artists(max_results=None, dedup='exact'):
     """
     Return all artists from saved_albums,
     saved_tracks and followed_artists.
     Each unique artist is returned only once.
+    dedup is the dedup.seen_set mode used.
     """
     albums = saved_albums(album_only=True)
     tracks = saved_tracks(track_only=True)
@@ -79,14 +201,14 @@ def saved_artists(max_results=None):
         artists_from_items(itertools.chain(albums, tracks)),
         followed_artists())
 
-    used = set()
+    seen = seen_set(dedup)
+    count = 0
     for artist in artists:
-        aid = artist['id']
-        if max_results and len(used) >= max_results:
+        if max_results and count >= max_results:
             return
-        if aid in used:
+        if not seen.add(artist['id']):
             continue
-        used.add(aid)
+        count += 1
         yield artist
 
 
@@ -113,13 +235,26 @@ def user_top_tracks(time_range='medium_term',
 
 
 @infer_content
-def library_filter_added_at(items, start=datetime.utcnow(),
-                            end=datetime.utcnow()):
+def library_filter_added_at(items, start=None, end=None, newest_first=True):
+    """
+    Yields the track/album of saved items added between
+    start and end (naive utc datetimes).
+    start defaults to no lower limit, end to now.
+    Items from saved_tracks/saved_albums come newest first,
+    so iteration stops at the first item older than start.
+    Pass newest_first=False for streams in any other order.
+    """
+    if end is None:
+        end = datetime.utcnow()
     for item in items:
         added = isodate.parse_datetime(item['added_at'])
         added = added.replace(tzinfo=None)
 
-        if start <= added <= end:
+        if start is not None and added < start:
+            if newest_first:
+                return
+            continue
+        if added <= end:
             if 'track' in item:
                 yield item['track']
             elif 'album' in item:
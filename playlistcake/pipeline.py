@@ -0,0 +1,275 @@
+"""
+Declarative pipelines.
+
+A pipeline spec is a dict (or its JSON) naming a source and
+the steps applied to it, each with the stage's keyword arguments:
+
+    {
+        "source": {"stage": "saved_tracks", "track_only": true},
+        "steps": [
+            {"stage": "tracks_filter_tuneables", "min_energy": 0.5},
+            {"stage": "filter_unique"},
+            {"stage": "sort", "key": "audio_features.tempo",
+             "audio_features": true}
+        ],
+        "max_results": 50
+    }
+
+A source may also be a nested pipeline spec, or a list of
+sources whose items are alternated.
+sort takes a dotted `key` path instead of a sort function.
+
+`plan` rewrites a spec into a cheaper equivalent one:
+- repeated audio feature enrichment is dropped
+- filters that need no api data are moved ahead of stages
+  doing lookups
+- max_results is pushed upstream into sort (as its limit)
+  and into the source's max_results
+
+`build` compiles a spec (planned by default) into the pipeline's
+generator, which can also be explained with explain.Pipeline:
+
+    Pipeline(lambda: build(spec), budget=100).explain()
+"""
+
+import copy
+import inspect
+import itertools
+import json
+
+from . import library, playlists, recommendations, sources, filters
+from .genutils import infer_content
+from .util import dict_get_nested
+
+
+@infer_content
+def limit(items, n):
+    """
+    Yields the first n items.
+    """
+    yield from itertools.islice(items, n)
+
+
+# Stage kinds:
+# source: doesn't take an input stream
+# map: yields one item per input item, in order
+# predicate: keeps or drops each item on its own
+# filter: keeps or drops items depending on the ones before
+# other: anything else (reorders, expands, aggregates)
+STAGES = {
+    'saved_tracks': (library.saved_tracks, 'source'),
+    'saved_albums': (library.saved_albums, 'source'),
+    'followed_artists': (library.followed_artists, 'source'),
+    'saved_artists': (library.saved_artists, 'source'),
+    'user_top_artists': (library.user_top_artists, 'source'),
+    'user_top_tracks': (library.user_top_tracks, 'source'),
+    'user_playlists': (playlists.user_playlists, 'source'),
+    'recommendations': (recommendations.recommendations, 'source'),
+    'library_filter_added_at': (library.library_filter_added_at, 'other'),
+    'playlists_tracks': (playlists.playlists_tracks, 'other'),
+    'batch_recommendations': (
+        recommendations.batch_recommendations, 'other'),
+    'recommended_albums': (recommendations.recommended_albums, 'other'),
+    'several_albums': (sources.several_albums, 'map'),
+    'several_tracks': (sources.several_tracks, 'map'),
+    'several_artists': (sources.several_artists, 'map'),
+    'with_audio_features': (sources.with_audio_features, 'map'),
+    'artists_albums': (sources.artists_albums, 'other'),
+    'artists_top_tracks': (sources.artists_top_tracks, 'other'),
+    'tracks_from_albums': (sources.tracks_from_albums, 'other'),
+    'prefetch': (sources.prefetch, 'map'),
+    'sort': (sources.sort, 'other'),
+    'shuffle': (sources.shuffle, 'other'),
+    'limit': (limit, 'other'),
+    'tracks_filter_tuneables': (filters.tracks_filter_tuneables, 'predicate'),
+    'filter_release_years': (filters.filter_release_years, 'predicate'),
+    'filter_unique': (filters.filter_unique, 'filter'),
+    'tracks_filter_artist_variety': (
+        filters.tracks_filter_artist_variety, 'filter'),
+}
+
+# Filters that make no api requests
+CHEAP_FILTERS = ('filter_unique', 'tracks_filter_artist_variety')
+
+# Stages that keep the item objects they are given,
+# so audio features added upstream survive them
+_KEEP_OBJECTS = ('with_audio_features', 'prefetch', 'sort', 'shuffle',
+                 'limit', 'tracks_filter_tuneables', 'filter_release_years',
+                 'filter_unique', 'tracks_filter_artist_variety',
+                 'library_filter_added_at')
+
+
+def _stage(step):
+    name = step.get('stage')
+    if name not in STAGES:
+        raise ValueError('Unknown pipeline stage: {}'.format(name))
+    return STAGES[name]
+
+
+def _is_pipeline(source):
+    return isinstance(source, dict) and 'source' in source
+
+
+def load(spec):
+    """
+    Returns a normalized copy of spec (a dict or json string),
+    with max_results turned into a final limit step.
+    """
+    if isinstance(spec, str):
+        spec = json.loads(spec)
+    spec = copy.deepcopy(spec)
+    if 'source' not in spec:
+        raise ValueError('Pipeline spec needs a source')
+    source = spec['source']
+    sources_ = source if isinstance(source, list) else [source]
+    for i, s in enumerate(sources_):
+        if _is_pipeline(s):
+            sources_[i] = load(s)
+        elif _stage(s)[1] != 'source':
+            raise ValueError('{} is not a source'.format(s['stage']))
+    steps = spec.get('steps', [])
+    for step in steps:
+        if _stage(step)[1] == 'source':
+            raise ValueError('{} can only be a source'.format(step['stage']))
+    max_results = spec.pop('max_results', None)
+    if max_results:
+        steps.append({'stage': 'limit', 'n': max_results})
+    spec['steps'] = steps
+    return spec
+
+
+def _merge_enrichment(steps):
+    """
+    Drop audio feature lookups of tracks that have them.
+    """
+    result = []
+    has_features = False
+    for step in steps:
+        name = step['stage']
+        if name == 'with_audio_features':
+            if has_features:
+                continue
+            has_features = True
+        elif name == 'tracks_filter_tuneables' and not step.get('store'):
+            has_features = True
+        elif name == 'sort' and step.get('audio_features'):
+            if has_features:
+                step = dict(step, audio_features=False)
+            has_features = True
+        elif name not in _KEEP_OBJECTS:
+            has_features = False
+        result.append(step)
+    return result
+
+
+def _can_pass(cheap, step):
+    kind = _stage(step)[1]
+    if kind == 'map':
+        return True
+    # Dropping duplicates commutes with per item filters,
+    # artist variety doesn't (it counts what is kept)
+    return kind == 'predicate' and cheap['stage'] == 'filter_unique'
+
+
+def _hoist_cheap_filters(steps):
+    """
+    Move filters needing no api data ahead of
+    the map and predicate stages before them.
+    """
+    steps = list(steps)
+    for i in range(len(steps)):
+        if steps[i]['stage'] not in CHEAP_FILTERS:
+            continue
+        j = i
+        while j > 0 and _can_pass(steps[j], steps[j-1]):
+            steps[j-1], steps[j] = steps[j], steps[j-1]
+            j -= 1
+    return steps
+
+
+def _accepts(step, param):
+    func = _stage(step)[0]
+    return param in inspect.signature(func).parameters
+
+
+def _push_limits(spec):
+    """
+    Push the final limit upstream through stages
+    yielding one item per input item.
+    """
+    steps = spec['steps']
+    if not steps or steps[-1]['stage'] != 'limit':
+        return
+    n = steps[-1]['n']
+    for i in range(len(steps) - 2, -1, -1):
+        step = steps[i]
+        if step['stage'] == 'sort':
+            steps[i] = dict(step, limit=min(step.get('limit') or n, n))
+            return
+        if step['stage'] in ('recommended_albums',
+                             'batch_recommendations'):
+            steps[i] = dict(step, max_results=min(
+                step.get('max_results') or n, n))
+            return
+        if _stage(step)[1] != 'map':
+            return
+    source = spec['source']
+    if isinstance(source, dict) and not _is_pipeline(source) \
+       and _accepts(source, 'max_results'):
+        spec['source'] = dict(source, max_results=min(
+            source.get('max_results') or n, n))
+
+
+def plan(spec):
+    """
+    Returns an optimized copy of spec.
+    """
+    spec = load(spec)
+    source = spec['source']
+    if isinstance(source, list):
+        spec['source'] = [plan(s) if _is_pipeline(s) else s
+                          for s in source]
+    elif _is_pipeline(source):
+        spec['source'] = plan(source)
+    spec['steps'] = _hoist_cheap_filters(_merge_enrichment(spec['steps']))
+    _push_limits(spec)
+    return spec
+
+
+def _sort_key(path):
+    keys = path.split('.')
+    return lambda item: dict_get_nested(keys, item)
+
+
+def _call(step, items=None):
+    func, kind = _stage(step)
+    kwargs = {k: v for k, v in step.items() if k != 'stage'}
+    if step['stage'] == 'sort':
+        kwargs['sort_func'] = _sort_key(kwargs.pop('key'))
+    if kind == 'source':
+        return func(**kwargs)
+    return func(items, **kwargs)
+
+
+def _build_source(source):
+    if isinstance(source, list):
+        return sources.alternate(*[_build_source(s) for s in source])
+    if _is_pipeline(source):
+        return _compile(source)
+    return _call(source)
+
+
+def _compile(spec):
+    items = _build_source(spec['source'])
+    for step in spec['steps']:
+        items = _call(step, items)
+    return items
+
+
+def build(spec, optimize=True):
+    """
+    Returns the generator of the pipeline described by spec,
+    planned by `plan` first if optimize is True.
+    """
+    spec = plan(spec) if optimize else load(spec)
+    return _compile(spec)
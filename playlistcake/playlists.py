@@ -1,13 +1,17 @@
-from .spotify import iterate_results, get_spotify
-from .util import get_limit, get_ids, iter_chunked
+from bisect import bisect_left
+from collections import Counter, defaultdict, deque
+import math
+
+from .spotify import (
+    iterate_results, iterate_paging, get_spotify, current_user)
+from .util import get_limit, get_ids, iter_chunked, parallel_map, parse_id
 from .genutils import yields
 
 
 @yields('playlists')
 def user_playlists(max_results=None):
     limit = get_limit(max_results, 50)
-    s = get_spotify()
-    user = s.current_user()['id']
+    user = current_user()['id']
     yield from iterate_results(
         'user_playlists',
         user,
@@ -35,18 +39,244 @@ def playlists_tracks(playlists):
 def create_playlist(name='Generated playlist', public=True):
     s = get_spotify()
     return s.user_playlist_create(
-        s.me()['id'],
+        current_user()['id'],
         name,
         public=public)
 
 
-def add_to_playlist(tracks, playlist):
+def add_to_playlist(tracks, playlist, sync=False, workers=None):
+    """
+    Add tracks to playlist (a playlist object or the
+    name of a new playlist to create).
+    If sync is True, make the playlist contain exactly
+    the given tracks instead, see sync_playlist.
+    """
     if isinstance(playlist, str):
         playlist = create_playlist(playlist)
+    if sync:
+        return sync_playlist(tracks, playlist, workers=workers)
     s = get_spotify()
-    for chunk in iter_chunked(tracks, 50):
+    for chunk in iter_chunked(tracks, 100):
         tids = get_ids(chunk)
         s.user_playlist_add_tracks(
             playlist['owner']['id'],
             playlist['id'],
             tids)
+    return playlist
+
+
+def _track_uri(track):
+    if isinstance(track, dict):
+        return track.get('uri') or 'spotify:track:' + track['id']
+    if track.startswith('spotify:'):
+        return track
+    return 'spotify:track:' + parse_id(track)
+
+
+def _read_playlist(playlist):
+    """
+    Returns the playlist's snapshot_id and the uris of its
+    tracks in order, None for unavailable tracks.
+    """
+    result = get_spotify().user_playlist(
+        playlist['owner']['id'], playlist['id'],
+        fields='snapshot_id,'
+               'tracks(items(track(uri)),total,limit,offset,next)')
+    uris = [item['track']['uri'] if item.get('track') else None
+            for item in iterate_paging(result['tracks'])]
+    return result['snapshot_id'], uris
+
+
+def playlist_uris(playlist):
+    """
+    Returns the uris of the tracks in playlist, in order.
+    Unavailable tracks are skipped.
+    """
+    return [uri for uri in _read_playlist(playlist)[1] if uri]
+
+
+def _increasing_subsequence(values):
+    """
+    Returns a set of the values in a longest
+    increasing subsequence of values.
+    """
+    tails = []
+    tail_index = []
+    parents = [None]*len(values)
+    for i, value in enumerate(values):
+        j = bisect_left(tails, value)
+        if j == len(tails):
+            tails.append(value)
+            tail_index.append(i)
+        else:
+            tails[j] = value
+            tail_index[j] = i
+        parents[i] = tail_index[j-1] if j else None
+    result = set()
+    i = tail_index[-1] if tail_index else None
+    while i is not None:
+        result.add(values[i])
+        i = parents[i]
+    return result
+
+
+def _plan_removals(current, desired):
+    """
+    Returns positions in current to remove, and the uris
+    from desired that are missing from current.
+    """
+    needed = Counter(desired)
+    removals = []
+    for i, uri in enumerate(current):
+        if needed[uri] > 0:
+            needed[uri] -= 1
+        else:
+            removals.append(i)
+    additions = []
+    for uri in desired:
+        if needed[uri] > 0:
+            needed[uri] -= 1
+            additions.append(uri)
+    return removals, additions
+
+
+class _Marks:
+    """
+    Positions 0..size-1 that can be marked, counting
+    the marked positions before one in O(log size).
+    """
+    def __init__(self, size):
+        self.tree = [0]*(size + 1)
+
+    def mark(self, i):
+        i += 1
+        while i < len(self.tree):
+            self.tree[i] += 1
+            i += i & -i
+
+    def before(self, i):
+        count = 0
+        while i > 0:
+            count += self.tree[i]
+            i -= i & -i
+        return count
+
+
+def _plan_moves(current, desired):
+    """
+    Returns (range_start, insert_before, range_length)
+    reorders turning current into desired, which must contain
+    the same uris. Tracks in the longest run already in
+    order stay put, the others are moved right after the
+    track that should precede them.
+    """
+    targets = defaultdict(deque)
+    for i, uri in enumerate(desired):
+        targets[uri].append(i)
+    order = [targets[uri].popleft() for uri in current]
+    # Original position of each target
+    index = [0]*len(order)
+    for i, t in enumerate(order):
+        index[t] = i
+    stay = sorted(_increasing_subsequence(order))
+    stay_index = [index[t] for t in stay]
+    # Targets < t are in order, those that moved right after
+    # the last one staying before them (or at the start),
+    # targets >= t where they were. Positions are counted
+    # from that instead of searching the reordered list.
+    moved = _Marks(len(order))
+    moves = []
+    t = 0
+    while t < len(order):
+        k = bisect_left(stay, t)
+        if k < len(stay) and stay[k] == t:
+            t += 1
+            continue
+        length = 1
+        while length < 100 and t + length < len(order) and \
+                (k == len(stay) or stay[k] != t + length):
+            # Only moved tracks between the next two targets
+            a, b = index[t + length - 1], index[t + length]
+            if b < a or moved.before(b) - moved.before(a + 1) != b - a - 1:
+                break
+            length += 1
+        # In place before it, and moved before the next staying
+        i = index[t]
+        k_next = bisect_left(stay_index, i)
+        next_stay = stay[k_next] if k_next < len(stay) else len(order)
+        bound = min(t, next_stay)
+        i += bound - bisect_left(stay, bound) - moved.before(i)
+        if t == 0:
+            before = 0
+        elif k:
+            # After t - 1, which is in order after the last staying
+            # target <= t - 1 and the tracks in place before it
+            anchor = stay_index[k - 1]
+            before = t + anchor - moved.before(anchor) - (k - 1)
+        else:
+            before = t
+        if before != i:
+            moves.append((i, before, length))
+        for moving in range(t, t + length):
+            moved.mark(index[moving])
+        t += length
+    return moves
+
+
+def sync_playlist(tracks, playlist, workers=None):
+    """
+    Make playlist contain exactly the given tracks, in order,
+    with as few changes as possible:
+    tracks that shouldn't be there are removed, missing tracks
+    are added and the rest are reordered, all in batches of 100.
+    Unavailable tracks can't be removed, they are moved to the end.
+    Changes are made against the snapshot that was read, so they
+    fail rather than apply to a playlist changed in the meantime.
+    If workers > 1, add requests are sent concurrently
+    and the playlist is read again before reordering.
+    If it would take more reorders than the requests needed to
+    write the whole playlist, it is replaced instead (dropping
+    unavailable tracks), which doesn't check the snapshot.
+    """
+    s = get_spotify()
+    owner, pid = playlist['owner']['id'], playlist['id']
+    snapshot, current = _read_playlist(playlist)
+    uris = [_track_uri(track) for track in tracks]
+    desired = uris + [None]*current.count(None)
+    removals, additions = _plan_removals(current, desired)
+    removed = set(removals)
+    kept = [uri for i, uri in enumerate(current) if i not in removed]
+    moves = _plan_moves(kept + additions, desired)
+    if len(moves) > math.ceil(len(uris)/100):
+        s.user_playlist_replace_tracks(owner, pid, uris[:100])
+        for chunk in iter_chunked(uris[100:], 100):
+            s.user_playlist_add_tracks(owner, pid, chunk)
+        return playlist
+
+    # From the end, so positions of earlier tracks don't change
+    for chunk in iter_chunked(reversed(removals), 100):
+        positions = defaultdict(list)
+        for i in chunk:
+            positions[current[i]].append(i)
+        snapshot = s.user_playlist_remove_specific_occurrences_of_tracks(
+            owner, pid,
+            [{'uri': uri, 'positions': p} for uri, p in positions.items()],
+            snapshot_id=snapshot)['snapshot_id']
+
+    def add(chunk):
+        return s.user_playlist_add_tracks(owner, pid, chunk)['snapshot_id']
+
+    chunks = list(iter_chunked(additions, 100))
+    if workers and workers > 1 and len(chunks) > 1:
+        list(parallel_map(add, chunks, workers))
+        snapshot, current = _read_playlist(playlist)
+        moves = _plan_moves(current, desired)
+    else:
+        for chunk in chunks:
+            snapshot = add(chunk)
+
+    for start, before, length in moves:
+        snapshot = s.user_playlist_reorder_tracks(
+            owner, pid, start, before,
+            range_length=length, snapshot_id=snapshot)['snapshot_id']
+    return playlist
@@ -0,0 +1,291 @@
+"""
+Client side rate limiting of spotify api requests.
+
+All requests made by the session's spotify client go through
+a Scheduler, which spaces them out with a token bucket,
+limits how many run at once and waits out 429 responses
+as told by their Retry-After header.
+"""
+
+import asyncio
+from email.utils import parsedate_to_datetime
+import multiprocessing
+import threading
+import time
+from urllib.parse import urlparse
+
+from . import instrument
+
+# Path segments followed by an object id
+_collections = ('albums', 'artists', 'tracks', 'users',
+                'playlists', 'audio-features')
+
+
+def endpoint_name(url):
+    """
+    Returns the api endpoint of url with ids
+    replaced, e.g. 'artists/{id}/albums'.
+    """
+    path = urlparse(url).path
+    if path.startswith('/v1/'):
+        path = path[len('/v1/'):]
+    parts = [part for part in path.split('/') if part]
+    for i in range(1, len(parts)):
+        if parts[i-1] in _collections:
+            parts[i] = '{id}'
+    return '/'.join(parts)
+
+
+class TokenBucket(object):
+    """
+    Allows `rate` requests per second on average,
+    with bursts of up to `capacity` requests.
+    """
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        # [tokens, time of last update]
+        self._state = [self.capacity, time.monotonic()]
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._state[0] = min(
+            self.capacity,
+            self._state[0] + (now - self._state[1])*self.rate)
+        self._state[1] = now
+
+    def reserve(self):
+        """
+        Take a token, returning the number of seconds
+        to wait before using it.
+        """
+        with self._lock:
+            self._refill()
+            # Reserve the token now and wait outside the lock,
+            # so waiting callers are served in order.
+            self._state[0] -= 1
+            tokens = self._state[0]
+            return -tokens/self.rate if tokens < 0 else 0
+
+    def acquire(self):
+        """
+        Take a token, sleeping until one is available.
+        Returns the number of seconds slept.
+        """
+        wait = self.reserve()
+        if wait:
+            time.sleep(wait)
+        return wait
+
+    def pause(self, seconds):
+        """
+        Hand out no tokens for the next `seconds`.
+        """
+        with self._lock:
+            self._refill()
+            self._state[0] = min(self._state[0], -seconds*self.rate)
+
+
+class SharedTokenBucket(TokenBucket):
+    """
+    TokenBucket kept in shared memory, so processes it
+    is passed to when they are created (e.g. through a
+    process pool's initializer) share one rate limit.
+    time.monotonic is system wide on linux, so the
+    processes agree on the time.
+    """
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._state = multiprocessing.Array(
+            'd', [self.capacity, time.monotonic()])
+        self._lock = self._state.get_lock()
+
+
+def _retry_after(response):
+    """
+    Seconds to wait according to the response's Retry-After
+    header, either a number of seconds or an http date.
+    Defaults to 1.
+    """
+    value = response.headers.get('Retry-After')
+    if not value:
+        return 1
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        date = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return 1
+    return max(date.timestamp() - time.time(), 0)
+
+
+class Scheduler(object):
+    """
+    Runs requests subject to a concurrency limit and, if `rate`
+    is given, a token bucket (`rate` per second, `burst`).
+    The concurrency limit adapts between `min_concurrency` and
+    `max_concurrency`: it is halved on every 429 response and
+    grows by one after a run of successful requests.
+    A 429 response pauses all requests for the Retry-After
+    period before the request is retried, at most `max_retries`
+    times.
+    A bucket (e.g. a SharedTokenBucket) can be given instead
+    of rate and burst. The Retry-After pause is passed on to it,
+    so it applies to everyone sharing the bucket.
+    """
+    def __init__(self, rate=None, burst=None, max_concurrency=10,
+                 min_concurrency=1, max_retries=5, bucket=None):
+        self.bucket = bucket or (TokenBucket(rate, burst) if rate else None)
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.concurrency = max_concurrency
+        self.max_retries = max_retries
+        self._active = 0
+        self._successes = 0
+        self._paused_until = 0
+        self._cond = threading.Condition()
+        self._metrics = {}
+
+    def _acquire(self):
+        start = time.monotonic()
+        with self._cond:
+            while True:
+                pause = self._paused_until - time.monotonic()
+                if pause > 0:
+                    self._cond.wait(pause)
+                elif self._active >= self.concurrency:
+                    self._cond.wait()
+                else:
+                    break
+            self._active += 1
+        if self.bucket:
+            self.bucket.acquire()
+        return time.monotonic() - start
+
+    async def _aacquire(self):
+        start = time.monotonic()
+        while True:
+            with self._cond:
+                pause = self._paused_until - time.monotonic()
+                if pause <= 0 and self._active < self.concurrency:
+                    self._active += 1
+                    break
+            # Waiting on the condition would block the event loop
+            await asyncio.sleep(pause if pause > 0 else 0.005)
+        if self.bucket:
+            try:
+                await asyncio.sleep(self.bucket.reserve())
+            except BaseException:
+                self._release(False)
+                raise
+        return time.monotonic() - start
+
+    def _release(self, throttled, retry_after=0):
+        with self._cond:
+            self._active -= 1
+            if throttled:
+                self._successes = 0
+                self.concurrency = max(
+                    self.min_concurrency, self.concurrency//2)
+                self._paused_until = max(
+                    self._paused_until, time.monotonic() + retry_after)
+                if self.bucket:
+                    self.bucket.pause(retry_after)
+            else:
+                self._successes += 1
+                if self._successes >= self.concurrency:
+                    self._successes = 0
+                    self.concurrency = min(
+                        self.max_concurrency, self.concurrency + 1)
+            self._cond.notify_all()
+
+    def _record(self, endpoint, waited, throttled):
+        with self._cond:
+            m = self._metrics.setdefault(
+                endpoint, {'requests': 0, 'throttled': 0, 'wait': 0.0})
+            m['requests'] += 1
+            m['throttled'] += throttled
+            m['wait'] += waited
+
+    def request(self, send, endpoint=None):
+        """
+        Call send() (returning a requests response)
+        when the limits allow it.
+        Returns the response, which is only a 429 response
+        when max_retries is exceeded.
+        """
+        retries = 0
+        while True:
+            waited = self._acquire()
+            throttled = False
+            retry_after = 0
+            try:
+                response = send()
+                throttled = response.status_code == 429
+                if throttled:
+                    retry_after = _retry_after(response)
+            finally:
+                self._release(throttled, retry_after)
+            self._record(endpoint, waited, throttled)
+            if not throttled or retries >= self.max_retries:
+                return response
+            retries += 1
+            response.close()
+
+    async def arequest(self, send, endpoint=None):
+        """
+        Async version of request, for a coroutine function
+        send returning a response with status_code and headers.
+        """
+        retries = 0
+        while True:
+            waited = await self._aacquire()
+            throttled = False
+            retry_after = 0
+            try:
+                response = await send()
+                throttled = response.status_code == 429
+                if throttled:
+                    retry_after = _retry_after(response)
+            finally:
+                self._release(throttled, retry_after)
+            self._record(endpoint, waited, throttled)
+            if not throttled or retries >= self.max_retries:
+                return response
+            retries += 1
+
+    def metrics(self):
+        """
+        Per endpoint request counts, number of 429
+        responses and seconds spent waiting for the limits.
+        """
+        with self._cond:
+            return {endpoint: dict(m)
+                    for endpoint, m in self._metrics.items()}
+
+
+class ThrottledSession(object):
+    """
+    Wraps a requests session so all requests
+    go through `scheduler`.
+    """
+    def __init__(self, session, scheduler):
+        self.session = session
+        self.scheduler = scheduler
+
+    def request(self, method, url, **kwargs):
+        endpoint = endpoint_name(url)
+
+        def send():
+            instrument.before_request(endpoint)
+            response = self.session.request(method, url, **kwargs)
+            instrument.record_request(endpoint, len(response.content))
+            return response
+        return self.scheduler.request(send, endpoint)
+
+    def __getattr__(self, name):
+        return getattr(self.session, name)
@@ -1,24 +1,25 @@
 from .spotify import iterate_results
 from .util import get_id, get_ids, get_limit
 from .genutils import yields, content_type
+from .dedup import seen_set
 
 
-def _generate_seeds(objects, seed_size=5):
+def _generate_seeds(objects, seed_size=5, dedup='exact'):
     """
     Convenience method to chunk iterables of artist or track
     object into lists of `seed_size` length of item ids.
     Has the added bonus of guaranteeing each item appears only
     once in the resulting set of seeds.
+    dedup is the dedup.seen_set mode used.
     """
     if seed_size > 5 or seed_size < 1:
         raise ValueError('Seed size must be between 1 and 5')
-    been_used = set()
+    been_used = seen_set(dedup)
     chunk = []
     for item in objects:
         iid = get_id(item)
-        if iid in been_used:
+        if not been_used.add(iid):
             continue
-        been_used.add(iid)
         chunk.append(iid)
         if len(chunk) == seed_size:
             yield chunk
@@ -52,6 +53,7 @@ def batch_recommendations(seed_gen=None, seed_size=5,
                           seed_genres=(),
                           max_results=None,
                           max_per_seed=50,
+                          dedup='exact',
                           **tuneables):
     """
     Gets recommendations using artists or tracks from
@@ -68,12 +70,13 @@ def batch_recommendations(seed_gen=None, seed_size=5,
     seed_genres: list of genres to supplement each
                   iteration of seed_gen
     max_results: total maximum results
-    limit: max number of tracks per seed_gen iteration
+    max_per_seed: max number of tracks per seed_gen iteration
+    dedup: dedup.seen_set mode used to keep seeds unique
     **tuneables: any number of tuneable audio attributes
     """
     seed_type = content_type(seed_gen)
     result_count = 0
-    for seed in _generate_seeds(seed_gen, seed_size):
+    for seed in _generate_seeds(seed_gen, seed_size, dedup):
         seed_artists = []
         seed_tracks = []
         if seed_type == 'artists':
@@ -100,18 +103,21 @@ def recommended_albums(seed_gen=None, seed_size=5,
                        suppl_tracks=(),
                        seed_genres=(),
                        max_results=None,
+                       dedup='exact',
                        **tuneables):
     batch = batch_recommendations(
         seed_gen, seed_size,
         suppl_artists, suppl_tracks,
         seed_genres,
+        dedup=dedup,
         **tuneables)
-    seen = set()
+    seen = seen_set(dedup)
+    count = 0
     for track in batch:
-        if max_results and len(seen) >= max_results:
+        if max_results and count >= max_results:
             return
         album = track['album']
-        if album['id'] in seen:
+        if not seen.add(album['id']):
             continue
-        seen.add(album['id'])
+        count += 1
         yield album
@@ -0,0 +1,176 @@
+"""
+Record and replay of spotify api responses.
+
+A ReplaySession stands in for the requests session of the
+spotify client, plug it in through the `spotify_kwargs`
+session variable:
+
+    session = ReplaySession('cassette.json', mode='record')
+    sessionenv.set('spotify_kwargs', {'requests_session': session})
+    ... run pipelines ...
+    session.save()
+
+Later runs with mode='replay' get the recorded responses
+without network access.
+"""
+
+import json
+import os
+import random
+import threading
+import time
+from collections import Counter
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+from .ratelimit import endpoint_name
+
+# Response headers worth keeping in recordings
+_kept_headers = ('Content-Type', 'Retry-After')
+
+
+class MissingRecording(LookupError):
+    pass
+
+
+def request_key(method, url, params=None, data=None):
+    """
+    Returns a key identifying a request by method, url
+    with sorted query parameters and body.
+    Headers (the auth token) are not part of the key.
+    """
+    url = requests.Request(method, url, params=params).prepare().url
+    parts = urlsplit(url)
+    query = urlencode(sorted(parse_qsl(parts.query)))
+    url = urlunsplit(parts._replace(query=query))
+    if isinstance(data, bytes):
+        data = data.decode()
+    if data:
+        return '{} {} {}'.format(method.upper(), url, data)
+    return '{} {}'.format(method.upper(), url)
+
+
+class _Connection(object):
+    # spotipy closes r.connection after every request
+    def close(self):
+        pass
+
+
+def make_response(url, status_code=200, body='', headers=None):
+    """
+    Returns a requests Response with the given content.
+    """
+    response = requests.Response()
+    response.url = url
+    response.status_code = status_code
+    response.headers = CaseInsensitiveDict(headers or {})
+    response.encoding = 'utf-8'
+    response._content = body.encode() if isinstance(body, str) else body
+    response._content_consumed = True
+    response.connection = _Connection()
+    return response
+
+
+class ReplaySession(object):
+    """
+    Requests session that records responses to, or replays
+    them from, the json file at `path`.
+
+    mode: 'record' sends requests with `session` (a new
+          requests.Session by default) and records the responses,
+          'replay' only answers from the recording and raises
+          MissingRecording for unknown requests,
+          'auto' replays what is recorded and records the rest.
+    latency: seconds added to every request, plus a random
+             amount up to `jitter` seconds.
+
+    A request made several times is answered with its
+    recorded responses in order, the last one repeating.
+    `counts` has the number of requests per endpoint.
+    """
+    def __init__(self, path, mode='replay', latency=0, jitter=0,
+                 session=None):
+        if mode not in ('record', 'replay', 'auto'):
+            raise ValueError('Unknown replay mode: {}'.format(mode))
+        self.path = path
+        self.mode = mode
+        self.latency = latency
+        self.jitter = jitter
+        self.session = session
+        self.counts = Counter()
+        self._lock = threading.Lock()
+        # key: number of times replayed
+        self._replayed = Counter()
+        self.recordings = {}
+        if mode != 'record' and os.path.exists(path):
+            with open(path) as f:
+                self.recordings = json.load(f)
+
+    def _sleep(self):
+        delay = self.latency + random.uniform(0, self.jitter)
+        if delay:
+            time.sleep(delay)
+
+    def _replay(self, key, url):
+        with self._lock:
+            responses = self.recordings.get(key)
+            if not responses:
+                return None
+            i = min(self._replayed[key], len(responses)-1)
+            self._replayed[key] += 1
+        r = responses[i]
+        return make_response(url, r['status'], r['body'], r['headers'])
+
+    def _record(self, key, method, url, **kwargs):
+        if self.session is None:
+            self.session = requests.Session()
+        response = self.session.request(method, url, **kwargs)
+        headers = {k: response.headers[k] for k in _kept_headers
+                   if k in response.headers}
+        with self._lock:
+            self.recordings.setdefault(key, []).append(
+                {'status': response.status_code,
+                 'headers': headers,
+                 'body': response.text})
+        return response
+
+    def request(self, method, url, params=None, data=None, **kwargs):
+        key = request_key(method, url, params, data)
+        with self._lock:
+            self.counts[endpoint_name(url)] += 1
+        self._sleep()
+        if self.mode != 'record':
+            response = self._replay(key, url)
+            if response is not None:
+                return response
+            if self.mode == 'replay':
+                raise MissingRecording(key)
+        return self._record(key, method, url, params=params,
+                            data=data, **kwargs)
+
+    def rewind(self):
+        """
+        Replay from the first recorded responses
+        again and reset the request counts.
+        """
+        with self._lock:
+            self._replayed.clear()
+            self.counts.clear()
+
+    @property
+    def total_requests(self):
+        return sum(self.counts.values())
+
+    def save(self, path=None):
+        """
+        Write the recordings to path (default self.path).
+        """
+        with self._lock:
+            with open(path or self.path, 'w') as f:
+                json.dump(self.recordings, f, indent=1, sort_keys=True)
+
+    def close(self):
+        if self.session is not None:
+            self.session.close()
@@ -1,12 +1,111 @@
+"""
+Per user session state (token, credentials, http session,
+caches, ...), carried by a context variable so every thread
+and asyncio task sees the session it was started in.
+
+    with session(token=token_a):
+        tracks = list(saved_tracks())
+
+Code outside any `with session()` block uses one default
+session shared by the whole process.
+"""
+
+from contextlib import contextmanager
+import contextvars
+from functools import wraps
 import threading
 
-session = threading.local()
-session.data = {}
+
+class Session(object):
+    """
+    Holds a session's values by key.
+    lock is for lazily creating per session objects
+    (clients, schedulers) without locking other sessions.
+    """
+    def __init__(self, data=None):
+        self.data = dict(data or {})
+        self.lock = threading.RLock()
+
+    def set(self, key, value):
+        self.data[key] = value
+
+    def get(self, key, default=None):
+        return self.data.get(key, default)
+
+
+_default = Session()
+_current = contextvars.ContextVar('playlistcake_session')
+
+
+def current():
+    """
+    Returns the Session of the current context.
+    """
+    return _current.get(_default)
 
 
 def set(key, value):
-    session.data[key] = value
+    current().set(key, value)
 
 
 def get(key, default=None):
-    return session.data.get(key, default)
+    return current().get(key, default)
+
+
+def lock():
+    """
+    The current session's lock.
+    """
+    return current().lock
+
+
+@contextmanager
+def session(token=None, credentials=None, http_session=None, cache=None,
+            scheduler=None, **data):
+    """
+    Run the block with a new session, e.g. for one user.
+    token: the user's spotify token
+    credentials: dict of client_id, client_secret,
+                 redirect_uri and scope for refreshing it
+    http_session: requests session for the spotify client
+    cache: entity cache (see playlistcake.cache)
+    scheduler: ratelimit.Scheduler, pass the same one to several
+               sessions to rate limit them together
+    Other keyword arguments are set as session values.
+    Yields the Session.
+    """
+    new = Session(data)
+    if token is not None:
+        new.set('spotify_token', token)
+    if credentials is not None:
+        new.set('spotify_credentials', credentials)
+    if http_session is not None:
+        kwargs = dict(new.get('spotify_kwargs') or {})
+        kwargs['requests_session'] = http_session
+        new.set('spotify_kwargs', kwargs)
+    if cache is not None:
+        new.set('cache', cache)
+    if scheduler is not None:
+        new.set('scheduler', scheduler)
+    reset = _current.set(new)
+    try:
+        yield new
+    finally:
+        manager = new.get('token_manager')
+        if manager is not None:
+            manager.stop()
+        _current.reset(reset)
+
+
+def wrap(func):
+    """
+    Wrap func to run in the calling context's
+    session, for running it in another thread.
+    """
+    context = contextvars.copy_context()
+
+    @wraps(func)
+    def func_wrapper(*args, **kwargs):
+        # A context can't be entered by two threads at once
+        return context.copy().run(func, *args, **kwargs)
+    return func_wrapper
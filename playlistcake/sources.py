@@ -1,25 +1,74 @@
+import heapq
 import random
 import itertools
-
-from .spotify import get_spotify
-from .util import get_id, get_ids, iter_chunked, reservoir_sample
+import queue
+import threading
+
+from . import batching, cache, sessionenv
+from .spotify import (get_spotify, iterate_results, iterate_paging,
+                      current_user)
+from .util import (get_id, get_ids, iter_chunked, parallel_map,
+                   reservoir_sample, external_sorted,
+                   buffered_shuffle, spilled_shuffle)
 from .genutils import yields, infer_content
+from .dedup import seen_set
+
+
+def _fetch_albums(aids):
+    return get_spotify().albums(aids)['albums']
+
+
+def _fetch_tracks(tids):
+    return get_spotify().tracks(tids)['tracks']
+
+
+def _fetch_artists(aids):
+    return get_spotify().artists(aids)['artists']
+
+
+def _fetch_audio_features(tids):
+    return get_spotify().audio_features(tracks=tids)
+
+
+# kind: (fetch function, max ids per request)
+_fetchers = {
+    'albums': (_fetch_albums, 20),
+    'tracks': (_fetch_tracks, 50),
+    'artists': (_fetch_artists, 50),
+    'audio_features': (_fetch_audio_features, 100),
+}
+
+
+def _lookup(kind, ids):
+    """
+    Get objects of `kind` for given ids,
+    using the session cache where possible.
+    Requests are shared with concurrent lookups
+    if coalescing is enabled (see batching).
+    """
+    fetch, batch_size = _fetchers[kind]
+    coalescer = batching.get_coalescer(kind, fetch, batch_size)
+    if coalescer:
+        fetch = coalescer.get_many
+    return cache.lookup(kind, ids, fetch, batch_size)
 
 
 @yields('albums')
 def several_albums(albums):
-    s = get_spotify()
     for chunk in iter_chunked(albums, 20):
-        aids = get_ids(chunk)
-        yield from s.albums(aids)['albums']
+        yield from _lookup('albums', get_ids(chunk))
 
 
 @yields('tracks')
 def several_tracks(tracks):
-    s = get_spotify()
     for chunk in iter_chunked(tracks, 50):
-        tids = get_ids(chunk)
-        yield from s.tracks(tids)['tracks']
+        yield from _lookup('tracks', get_ids(chunk))
+
+
+@yields('artists')
+def several_artists(artists):
+    for chunk in iter_chunked(artists, 50):
+        yield from _lookup('artists', get_ids(chunk))
 
 
 @yields('tracks')
@@ -27,63 +76,93 @@ def with_audio_features(tracks):
     """
     Yields the given tracks with
     audio_features (track['audio_features'])
+    Tracks that already have them are not looked up again.
     """
-    s = get_spotify()
     for chunk in iter_chunked(tracks, 100):
-        tids = get_ids(chunk)
-        features = s.audio_features(tracks=tids)
-        for i, item in enumerate(features):
-            track = chunk[i]
-            track['audio_features'] = item
-            yield track
+        missing = [t for t in chunk if 'audio_features' not in t]
+        if missing:
+            features = _lookup('audio_features', get_ids(missing))
+            for track, item in zip(missing, features):
+                track['audio_features'] = item
+        yield from chunk
 
 
 @yields('albums')
-def artists_albums(artists, album_type='album'):
+def artists_albums(artists, album_type='album', workers=None):
     """
     Get all albums from given artists.
+    If workers > 1, albums for that many artists are
+    fetched concurrently. Albums are yielded in artist order.
     """
     country = user_country()
-    s = get_spotify()
-
-    def _simple_albums(artists):
-        for artist in artists:
-            yield from s.artist_albums(
-                artist['id'],
-                country=country,
-                album_type=album_type,
-                limit=50)['items']
 
-    for chunk in iter_chunked(_simple_albums(artists), 20):
+    def _artist_albums(artist):
+        return list(iterate_results(
+            'artist_albums',
+            get_id(artist),
+            country=country,
+            album_type=album_type,
+            limit=50))
+
+    if workers and workers > 1:
+        album_lists = parallel_map(_artist_albums, artists, workers)
+    else:
+        album_lists = map(_artist_albums, artists)
+    simple_albums = itertools.chain.from_iterable(album_lists)
+    for chunk in iter_chunked(simple_albums, 20):
         yield from several_albums(chunk)
 
 
 @yields('tracks')
-def artists_top_tracks(artists, max_per_artist=10):
+def artists_top_tracks(artists, max_per_artist=10, workers=None):
     """
     Get top tracks from several artists.
     If max_per_artist is set a random sample is used.
+    If workers > 1, top tracks for that many artists are
+    fetched concurrently. Tracks are yielded in artist order.
     """
     s = get_spotify()
     country = user_country()
-    for artist in artists:
-        aid = get_id(artist)
-        yield from reservoir_sample(
-            s.artist_top_tracks(
-                aid, country=country)['tracks'], max_per_artist)
+
+    def _top_tracks(artist):
+        return s.artist_top_tracks(
+            get_id(artist), country=country)['tracks']
+
+    if workers and workers > 1:
+        track_lists = parallel_map(_top_tracks, artists, workers)
+    else:
+        track_lists = map(_top_tracks, artists)
+    for tracks in track_lists:
+        yield from reservoir_sample(tracks, max_per_artist)
 
 
 @yields('tracks')
-def tracks_from_albums(albums):
-    chunk = []
-    for album in albums:
-        if len(chunk) == 50:
-            yield from several_tracks(chunk)
-            chunk = []
-        for track in album['tracks']['items']:
-            chunk.append(track)
-    if chunk:
-        yield from several_tracks(chunk)
+def tracks_from_albums(albums, full=True):
+    """
+    Yields the tracks of given full album objects.
+    If full is False, the simplified track objects are
+    yielded with their album (without its track list)
+    as track['album'], which takes no extra requests.
+    Otherwise full track objects are yielded,
+    each track only once.
+    """
+    def simple_tracks():
+        for album in albums:
+            album_info = {k: v for k, v in album.items() if k != 'tracks'}
+            for track in iterate_paging(album['tracks']):
+                yield dict(track, album=album_info)
+
+    if not full:
+        yield from simple_tracks()
+        return
+    seen = seen_set()
+
+    def unique_ids():
+        for track in simple_tracks():
+            if seen.add(track['id']):
+                yield track['id']
+
+    yield from several_tracks(unique_ids())
 
 
 @infer_content
@@ -95,25 +174,117 @@ def alternate(*streams):
         lambda x: x is None, achain)
 
 
+_end = object()
+
+
+def _put(q, value, stop):
+    """
+    Put value on q, giving up if stop is set.
+    """
+    while not stop.is_set():
+        try:
+            q.put(value, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+@infer_content
+def prefetch(items, depth=1):
+    """
+    Reads items in a background thread, up to `depth`
+    items ahead of the consumer, so upstream requests
+    overlap with the work of downstream stages.
+    Exceptions raised upstream are re-raised here.
+    The background thread stops when this generator is
+    closed or garbage collected.
+    """
+    q = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def produce():
+        error = None
+        try:
+            for item in items:
+                if not _put(q, (item, None), stop):
+                    return
+        except BaseException as e:
+            error = e
+        finally:
+            if hasattr(items, 'close'):
+                items.close()
+        _put(q, (_end, error), stop)
+
+    thread = threading.Thread(target=sessionenv.wrap(produce))
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            item, error = q.get()
+            if item is _end:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stop.set()
+
+
 @infer_content
-def sort(items, sort_func, order='asc'):
+def sort(items, sort_func, order='asc', store=None, limit=None,
+         audio_features=False, chunk_size=None):
     """
     Sorts the stream of items using given sort_func as key.
+    Set audio_features to True if sort_func uses
+    track['audio_features'], they are fetched first.
+    If limit is set only the first `limit` items are yielded
+    and no more than that are kept in memory.
+    If chunk_size is set, the stream is sorted in chunks
+    of that size which are spilled to disk and merged.
+    If a featurestore.FeatureStore is given as store,
+    sort_func may be the name of a field in the store.
     """
     reverse = order == 'desc'
-    items = with_audio_features(items)
-    items = sorted(items, key=sort_func, reverse=reverse)
-    yield from items
+    if store is not None and isinstance(sort_func, str):
+        items = list(items)
+        positions = store.argsort(sort_func, get_ids(items), order)
+        for i in positions[:limit]:
+            yield items[i]
+        return
+    if audio_features:
+        items = with_audio_features(items)
+    if limit:
+        select = heapq.nlargest if reverse else heapq.nsmallest
+        yield from select(limit, items, key=sort_func)
+    elif chunk_size:
+        yield from external_sorted(
+            items, key=sort_func, reverse=reverse, chunk_size=chunk_size)
+    else:
+        yield from sorted(items, key=sort_func, reverse=reverse)
 
 
 @infer_content
-def shuffle(items):
+def shuffle(items, buffer_size=None, seed=None, spill_buckets=None):
     """
     Shuffles the stream.
+    If buffer_size is set, only that many items are held
+    and yielding starts as soon as the buffer is full
+    (see util.buffered_shuffle).
+    If spill_buckets is set, items are spilled to that many
+    temporary files for a uniform shuffle of streams too
+    large for memory (see util.spilled_shuffle).
+    seed makes the shuffle repeatable.
     """
-    items = list(items)
-    random.shuffle(items)
-    yield from items
+    rng = random.Random(seed)
+    if buffer_size:
+        yield from buffered_shuffle(items, buffer_size, rng)
+    elif spill_buckets:
+        yield from spilled_shuffle(items, spill_buckets, rng)
+    else:
+        items = list(items)
+        rng.shuffle(items)
+        yield from items
 
 
 def full_album(album_or_uri):
@@ -128,8 +299,7 @@ def full_album(album_or_uri):
             return a
         else:
             a = a['uri']
-    s = get_spotify()
-    return s.album(a)
+    return _lookup('albums', [a])[0]
 
 
 def full_track(track_or_uri):
@@ -144,8 +314,7 @@ def full_track(track_or_uri):
             return a
         else:
             a = a['uri']
-    s = get_spotify()
-    return s.track(a)
+    return _lookup('tracks', [a])[0]
 
 
 def find_artist(name):
@@ -178,5 +347,4 @@ def find_track(artist, name):
 
 
 def user_country():
-    s = get_spotify()
-    return s.current_user()['country']
+    return current_user()['country']
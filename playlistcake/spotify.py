@@ -1,12 +1,15 @@
 import os
 import time
 import base64
+import itertools
+import threading
 
-from spotipy.oauth2 import SpotifyOAuth
+from spotipy.oauth2 import SpotifyOAuth, SpotifyOauthError
 from spotipy import Spotify
 
-from . import sessionenv
-from .util import dict_get_nested
+from . import sessionenv, instrument
+from .ratelimit import Scheduler, ThrottledSession
+from .util import dict_get_nested, is_iterable, parallel_map
 
 
 def _monkey_search(self, q, limit=10, offset=0, type='track', market=None):
@@ -30,10 +33,53 @@ def set_client_credentials(client_id=None,
                     'client_secret': client_secret,
                     'redirect_uri': redirect_uri,
                     'scope': scope})
+    _reset_token_manager()
 
 
-def set_session_token(token):
+def set_session_token(token, background_refresh=False):
+    """
+    Set the spotify token for the current session.
+    If background_refresh is True the token is refreshed
+    in a background thread before it expires.
+    """
     sessionenv.set('spotify_token', token)
+    sessionenv.set('background_refresh', background_refresh)
+    sessionenv.set('current_user', None)
+    _reset_token_manager()
+
+
+def set_scheduler(scheduler):
+    """
+    Set the ratelimit.Scheduler that api requests
+    in the current session go through.
+    """
+    sessionenv.set('scheduler', scheduler)
+    _reset_token_manager()
+
+
+def get_scheduler():
+    """
+    Returns the session's scheduler, creating
+    one with default limits on first use
+    (no rate limit, see set_scheduler to set one).
+    """
+    scheduler = sessionenv.get('scheduler')
+    if scheduler is None:
+        with sessionenv.lock():
+            scheduler = sessionenv.get('scheduler')
+            if scheduler is None:
+                scheduler = Scheduler()
+                sessionenv.set('scheduler', scheduler)
+    return scheduler
+
+
+def set_page_workers(workers):
+    """
+    Set the default number of pages `iterate_results`
+    fetches concurrently for offset paged endpoints.
+    None or 1 fetches pages one at a time.
+    """
+    sessionenv.set('page_workers', workers)
 
 
 class ExtendedOAuth(SpotifyOAuth):
@@ -70,30 +116,223 @@ def token_is_almost_expired(token):
     return token['expires_at'] < time.time()+600
 
 
+class TokenManager(object):
+    """
+    Holds the session's token and a single spotify
+    client using it.
+    The token is refreshed at most once when it is about to
+    expire, however many threads ask for it at the same time.
+    Requests from the client go through `scheduler` if given.
+    """
+    def __init__(self, token, credentials=None, spotify_kwargs=None,
+                 refresh_margin=600, scheduler=None):
+        self.token = token
+        self.credentials = credentials or {}
+        self.spotify_kwargs = dict(spotify_kwargs or {})
+        self.scheduler = scheduler
+        self.refresh_margin = refresh_margin
+        self._client = None
+        self._lock = threading.Lock()
+        self._timer = None
+
+    def needs_refresh(self):
+        return self.token['expires_at'] < time.time()+self.refresh_margin
+
+    def _refresh(self):
+        c = self.credentials
+        auth = ExtendedOAuth(
+            c.get('client_id'), c.get('client_secret'),
+            c.get('redirect_uri'), scope=c.get('scope'))
+        token = auth._refresh_access_token(self.token['refresh_token'])
+        if not token:
+            # spotipy returns None when refreshing fails,
+            # keep the old token so the next call tries again
+            raise SpotifyOauthError('Failed to refresh the spotify token')
+        self.token = token
+        if self._client:
+            self._client._auth = self.token['access_token']
+
+    def get_token(self):
+        """
+        Returns the token, refreshing it if needed.
+        """
+        if self.needs_refresh():
+            with self._lock:
+                # Another thread may have refreshed it while we waited
+                if self.needs_refresh():
+                    self._refresh()
+        return self.token
+
+    def client(self):
+        """
+        Returns the spotify client with a valid token.
+        """
+        token = self.get_token()
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = self._create_client(token)
+        return self._client
+
+    def _create_client(self, token):
+        kwargs = dict(self.spotify_kwargs)
+        sessj = kwargs.pop('requests_session', None)
+        prefix = kwargs.pop('prefix', None)
+        s = Spotify(auth=token['access_token'], **kwargs)
+        if sessj:
+            s._session = sessj
+        if prefix:
+            s.prefix = prefix
+        if self.scheduler:
+            s._session = ThrottledSession(s._session, self.scheduler)
+        #s.trace = True
+        s.trace_out = True
+        return s
+
+    def start_background_refresh(self, delay=None):
+        """
+        Refresh the token in a background thread
+        shortly before it needs refreshing, so
+        callers never wait on it.
+        """
+        if delay is None:
+            delay = max(self.token['expires_at'] - time.time()
+                        - self.refresh_margin*1.5, 0)
+        self._timer = threading.Timer(delay, self._background_refresh)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _background_refresh(self):
+        delay = None
+        try:
+            with self._lock:
+                if self.token['expires_at'] < \
+                   time.time()+self.refresh_margin*1.5:
+                    self._refresh()
+        except Exception:
+            # Try again later, get_token() still refreshes
+            # the token if it's needed before then
+            delay = 30
+        if self._timer is not None:
+            self.start_background_refresh(delay)
+
+    def stop(self):
+        """
+        Stop background refreshing.
+        """
+        timer, self._timer = self._timer, None
+        if timer:
+            timer.cancel()
+
+
+def _reset_token_manager():
+    manager = sessionenv.get('token_manager')
+    if manager:
+        manager.stop()
+    sessionenv.set('token_manager', None)
+
+
+def get_token_manager():
+    """
+    Returns the session's TokenManager, creating it from the
+    session token and credentials on first use.
+    """
+    manager = sessionenv.get('token_manager')
+    if manager is None:
+        with sessionenv.lock():
+            manager = sessionenv.get('token_manager')
+            if manager is None:
+                token = sessionenv.get('spotify_token')
+                if not token:
+                    raise Exception('No spotify token, abort')
+                manager = TokenManager(
+                    token,
+                    sessionenv.get('spotify_credentials'),
+                    sessionenv.get('spotify_kwargs'),
+                    scheduler=get_scheduler())
+                if sessionenv.get('background_refresh'):
+                    manager.start_background_refresh()
+                sessionenv.set('token_manager', manager)
+    return manager
+
+
 def get_spotify():
-    token = sessionenv.get('spotify_token')
-    kwargs = sessionenv.get('spotify_kwargs', {})
-    try:
-        sessj = kwargs.pop('requests_session')
-    except KeyError:
-        sessj = None
-    if not token:
-        raise Exception('No spotify token, abort')
-    token = refresh_token(token,
-                          **sessionenv.get('spotify_credentials'))
-    s = sessionenv.get('spotify')
-    if s:
-        s._auth = token['access_token']
+    return get_token_manager().client()
+
+
+def current_user():
+    """
+    Returns the profile of the session's user.
+    It is fetched once and kept until the session
+    token is changed.
+    """
+    user = sessionenv.get('current_user')
+    if user is None:
+        user = get_spotify().current_user()
+        sessionenv.set('current_user', user)
+    return user
+
+
+def _offset_paging(result, items_path):
+    """
+    Returns the paging object of result if it can be
+    paged by offset (has total, limit and offset).
+    Returns None for cursor paged or unpaged results.
+    """
+    if is_iterable(items_path):
+        paging = dict_get_nested(items_path[:-1], result)
     else:
-        s = Spotify(auth=token['access_token'], **kwargs)
-    if sessj:
-        s._session = sessj
-    #s.trace = True
-    s.trace_out = True
-    return s
+        paging = result
+    if not isinstance(paging, dict) or 'cursors' in paging:
+        return None
+    if not all(isinstance(paging.get(k), int)
+               for k in ('total', 'limit', 'offset')):
+        return None
+    return paging
+
+
+def _iterate_offset_pages(func, args, kwargs, result, paging,
+                          items_path, max_results, workers):
+    """
+    Yield items from the first page (`result`) and
+    fetch the following pages concurrently.
+    """
+    limit = paging['limit']
+    end = paging['total']
+    if max_results:
+        end = min(end, paging['offset'] + max_results)
+
+    def fetch_page(offset):
+        page_kwargs = dict(kwargs, limit=limit, offset=offset)
+        return dict_get_nested(items_path, func(*args, **page_kwargs))
+
+    offsets = range(paging['offset'] + limit, end, limit)
+    pages = itertools.chain(
+        [dict_get_nested(items_path, result)],
+        parallel_map(fetch_page, offsets, workers))
+    count = 0
+    for itemlist in pages:
+        for item in itemlist:
+            if max_results and count >= max_results:
+                return
+            count += 1
+            yield item
 
 
 def iterate_results(endpoint, *args, **kwargs):
+    """
+    Call endpoint and yield the items from all
+    pages of the result.
+    Offset paged results are fetched `workers` pages
+    at a time when workers > 1. Cursor paged
+    results are always fetched one page at a time.
+    """
+    return instrument.stage(
+        'iterate_results:' + endpoint,
+        _iterate_results(endpoint, *args, **kwargs))
+
+
+def _iterate_results(endpoint, *args, **kwargs):
     s = get_spotify()
     func = getattr(s, endpoint)
     # The path to the result's list of items to be yielded
@@ -101,8 +340,16 @@ def iterate_results(endpoint, *args, **kwargs):
     # The path in result dict to the "next" url (usually result['next'])
     next_path = kwargs.pop('next_path', 'next')
     max_results = kwargs.pop('max_results',  None)
+    workers = kwargs.pop('workers', sessionenv.get('page_workers'))
 
     result = func(*args, **kwargs)
+    if workers and workers > 1 and items_path and next_path:
+        paging = _offset_paging(result, items_path)
+        if paging:
+            yield from _iterate_offset_pages(
+                func, args, kwargs, result, paging,
+                items_path, max_results, workers)
+            return
     count = 0
     while True:
         if items_path:
@@ -114,6 +361,8 @@ def iterate_results(endpoint, *args, **kwargs):
                 return
             count += 1
             yield item
+        if max_results and count >= max_results:
+            return
         if next_path:
             try:
                 next_url = dict_get_nested(next_path, result)
@@ -126,6 +375,20 @@ def iterate_results(endpoint, *args, **kwargs):
             return
 
 
+def iterate_paging(paging):
+    """
+    Yield the items of a paging object embedded in another
+    result (e.g. album['tracks']), following its next urls.
+    """
+    s = None
+    while True:
+        yield from paging['items']
+        if not paging.get('next'):
+            return
+        s = s or get_spotify()
+        paging = s._get(paging['next'])
+
+
 def get_authorize_url(client_id, client_secret, redirect_uri, scope):
     """
     Get a spotify oauth authorization url.
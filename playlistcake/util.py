@@ -1,5 +1,12 @@
-from collections import Iterable
+from collections import deque
+from collections.abc import Iterable
+from concurrent.futures import ThreadPoolExecutor
+import heapq
+import pickle
 import random
+import tempfile
+
+from . import sessionenv, instrument
 
 
 def get_ids(objects):
@@ -12,6 +19,18 @@ def get_id(item):
     return item['id'] if isinstance(item, dict) else item
 
 
+def parse_id(uri):
+    """
+    Get the bare spotify id from an id, uri
+    (spotify:track:id) or url (https://open.spotify.com/track/id).
+    """
+    if uri.startswith('spotify:'):
+        return uri.split(':')[-1]
+    if uri.startswith('http'):
+        return uri.split('/')[-1].split('?')[0]
+    return uri
+
+
 def get_limit(max_results, max_limit):
     if max_results and max_results < max_limit:
         limit = max_results
@@ -63,6 +82,101 @@ def iter_chunked(iterator, n):
         yield chunk
 
 
+def _unpickled(f):
+    while True:
+        try:
+            yield pickle.load(f)
+        except EOFError:
+            return
+
+
+def external_sorted(items, key=None, reverse=False, chunk_size=10000):
+    """
+    Like sorted(), but for streams that don't fit in memory.
+    Sorted runs of chunk_size items are pickled to temporary
+    files and lazily merged. The sort is stable.
+    """
+    files = []
+    try:
+        for chunk in iter_chunked(items, chunk_size):
+            chunk.sort(key=key, reverse=reverse)
+            f = tempfile.TemporaryFile()
+            for item in chunk:
+                pickle.dump(item, f, pickle.HIGHEST_PROTOCOL)
+            f.seek(0)
+            files.append(f)
+        yield from heapq.merge(*[_unpickled(f) for f in files],
+                               key=key, reverse=reverse)
+    finally:
+        for f in files:
+            f.close()
+
+
+def buffered_shuffle(items, buffer_size, rng=random):
+    """
+    Shuffle a stream holding at most buffer_size items.
+    Starts yielding once the buffer is full. Items can only
+    move forward by about buffer_size positions, so this is
+    not a uniform shuffle of long streams.
+    """
+    buffer = []
+    for item in items:
+        if len(buffer) < buffer_size:
+            buffer.append(item)
+            continue
+        i = rng.randrange(buffer_size)
+        yield buffer[i]
+        buffer[i] = item
+    rng.shuffle(buffer)
+    yield from buffer
+
+
+def spilled_shuffle(items, buckets, rng=random):
+    """
+    Uniformly shuffle a stream that doesn't fit in memory.
+    Items are scattered at random across `buckets` temporary
+    files, then each file is shuffled in memory in turn.
+    """
+    files = [tempfile.TemporaryFile() for i in range(buckets)]
+    try:
+        for item in items:
+            pickle.dump(item, files[rng.randrange(buckets)],
+                        pickle.HIGHEST_PROTOCOL)
+        for f in files:
+            f.seek(0)
+            bucket = list(_unpickled(f))
+            rng.shuffle(bucket)
+            yield from bucket
+    finally:
+        for f in files:
+            f.close()
+
+
+def parallel_map(func, iterable, workers):
+    """
+    Like map(), but runs func for up to `workers` items
+    at a time in a thread pool.
+    Results are yielded in input order. The input is consumed
+    no more than `workers` items ahead of the output, so
+    nothing more is pulled when the consumer stops.
+    func runs with the calling thread's session.
+    """
+    func = instrument.carry(sessionenv.wrap(func))
+    executor = ThreadPoolExecutor(max_workers=workers)
+    pending = deque()
+    try:
+        for item in iterable:
+            pending.append(executor.submit(func, item))
+            if len(pending) >= workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=False)
+
+
 def reservoir_sample(source, n):
     """
     Yield n randomally selected items
@@ -11,5 +11,7 @@ setup(
         'isodate==0.5.4',
         'requests==2.11.1',
         'spotipy==2.3.8'],
+    extras_require={
+        'aio': ['aiohttp']},
     license='LICENSE.md',
-    packages=['playlistcake'])
+    packages=['playlistcake', 'playlistcake.aio'])
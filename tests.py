@@ -1,40 +1,70 @@
 import itertools
+import os
+import time
 
 import pytest
-import requests_cache
 
+CASSETTE = os.path.join(os.path.dirname(__file__), 'tests_cassette.json')
 
-class DumbConnection(object):
-    def __init__(self, parent):
-        self.parent = parent
 
-    def close(self):
-        self.parent.close()
+@pytest.fixture(scope='session')
+def spotify():
+    """
+    Api responses are replayed from CASSETTE.
+    With PLAYLISTCAKE_TEST_TOKEN set, requests missing
+    from it are sent and recorded.
+    Without either, the tests using the api are skipped.
+    """
+    from playlistcake import sessionenv
+    from playlistcake.replay import ReplaySession
+    from playlistcake.spotify import get_spotify, set_session_token
+    token = os.getenv('PLAYLISTCAKE_TEST_TOKEN')
+    if token:
+        token = eval(token)
+        session = ReplaySession(CASSETTE, mode='auto')
+    elif not os.path.exists(CASSETTE):
+        pytest.skip('No recorded api responses in {}, set '
+                    'PLAYLISTCAKE_TEST_TOKEN to record them'.format(
+                        os.path.basename(CASSETTE)))
+    else:
+        token = {'access_token': 'replay', 'refresh_token': None,
+                 'expires_at': time.time() + 24*3600}
+        session = ReplaySession(CASSETTE)
+    sessionenv.set('spotify_kwargs', {'requests_session': session})
+    set_session_token(token)
+    yield get_spotify()
+    if session.mode == 'auto':
+        session.save()
 
 
-class DumbCachedSession(requests_cache.CachedSession):
+@pytest.fixture
+def fake_api():
     """
-    Spotipy calls connection.close() after an API request
-    but regular CachedSession's response object doesn't
-    have a connection attribute.
-    Too dumb to figure it out so here's a hack ...
+    Returns a function starting a FakeSpotifyServer for
+    catalogue and pointing the session at it, without a rate
+    limit or cache. The session is reset afterwards.
     """
-    def send(self, request, **kwargs):
-        response = super(DumbCachedSession, self).send(request, **kwargs)
-        response.connection = DumbConnection(self)
-        return response
+    from playlistcake import sessionenv, cache
+    from playlistcake.fakeserver import FakeSpotifyServer
+    from playlistcake.ratelimit import Scheduler
+    from playlistcake.spotify import set_session_token, set_scheduler
+    servers = []
 
+    def start(catalogue, scheduler=None, **kwargs):
+        server = FakeSpotifyServer(catalogue, **kwargs).start()
+        servers.append(server)
+        sessionenv.set('spotify_kwargs', server.spotify_kwargs())
+        set_scheduler(scheduler or Scheduler(rate=None))
+        set_session_token(server.token())
+        cache.set_cache(None)
+        return server
 
-@pytest.fixture(scope='session')
-def spotify():
-    import os
-    from playlistcake import sessionenv
-    from playlistcake import spotifystuff
-    token = eval(os.getenv('PLAYLISTCAKE_TEST_TOKEN'))
-    sessionenv.set('spotify_token', token)
-    sessionenv.set('spotify_kwargs',
-                   {'requests_session': DumbCachedSession()})
-    return spotifystuff.get_spotify()
+    yield start
+    sessionenv.set('spotify_kwargs', None)
+    set_scheduler(None)
+    set_session_token(None)
+    for server in servers:
+        server.stop()
 
 
 @pytest.fixture(scope='session')
@@ -198,3 +228,1025 @@ def test_decorators():
     assert content_type(filtered) == 'tracks'
     filtered = filters.filter_release_years(albums)
     assert content_type(filtered) == 'albums'
+
+
+def test_cache_lookup_fetches_only_misses(tmpdir):
+    from playlistcake import cache
+    cache.set_cache(cache.default_cache(str(tmpdir.join('cache.db'))))
+    calls = []
+
+    def fetch(ids):
+        calls.append(ids)
+        return [{'id': i} for i in ids]
+
+    try:
+        assert cache.lookup('tracks', ['a', 'b'], fetch, 50) == [
+            {'id': 'a'}, {'id': 'b'}]
+        result = cache.lookup('tracks', ['a', 'spotify:track:c'], fetch, 50)
+        assert result == [{'id': 'a'}, {'id': 'c'}]
+        assert calls == [['a', 'b'], ['c']]
+    finally:
+        cache.set_cache(None)
+
+
+def test_memory_cache_evicts_least_recently_used():
+    from playlistcake.cache import MemoryCache
+    c = MemoryCache(max_size=2)
+    c.set_many('tracks', {'a': {'id': 'a'}, 'b': {'id': 'b'}})
+    c.get_many('tracks', ['a'])
+    c.set_many('tracks', {'c': {'id': 'c'}})
+    assert sorted(c.get_many('tracks', ['a', 'b', 'c'])) == ['a', 'c']
+
+
+def test_sqlite_cache_evicts_least_recently_used(tmpdir):
+    from playlistcake.cache import SQLiteCache
+    c = SQLiteCache(str(tmpdir.join('cache.sqlite')), max_size=100)
+    c.set_many('tracks', {str(i): {'id': i} for i in range(100)})
+    c.get_many('tracks', ['0'])
+    for i in range(100, 110):
+        c.set_many('tracks', {str(i): {'id': i}})
+    count = c._conn.execute('SELECT COUNT(*) FROM entities').fetchone()[0]
+    assert count <= 100
+    assert c.get_many('tracks', ['0', '109']) == {
+        '0': {'id': 0}, '109': {'id': 109}}
+    assert c.get_many('tracks', ['1']) == {}
+
+
+def test_parallel_map_keeps_order_and_is_lazy():
+    import itertools
+    import time
+    from playlistcake.util import parallel_map
+    pulled = []
+
+    def source():
+        for i in range(100):
+            pulled.append(i)
+            yield i
+
+    def slow_square(x):
+        time.sleep(0.01 * (x % 3))
+        return x * x
+
+    result = list(itertools.islice(parallel_map(slow_square, source(), 4), 10))
+    assert result == [x * x for x in range(10)]
+    assert len(pulled) <= 14
+
+
+def test_async_generators_keep_content_type():
+    import asyncio
+    from playlistcake.genutils import yields, content_type
+    from playlistcake.aio.util import aiterate, alist
+
+    @yields('tracks')
+    async def tracks():
+        yield {'id': 'a'}
+
+    gen = aiterate(tracks())
+    assert content_type(gen) == 'tracks'
+    assert asyncio.run(alist(gen)) == [{'id': 'a'}]
+
+
+def test_token_refreshes_once_for_concurrent_callers(monkeypatch):
+    import threading
+    from playlistcake.spotify import ExtendedOAuth, TokenManager
+    calls = []
+    failing = [True]
+    barrier = threading.Barrier(8)
+
+    def refresh(self, refresh_token):
+        calls.append(refresh_token)
+        time.sleep(0.05)
+        if failing[0]:
+            return None
+        return {'access_token': 'new', 'refresh_token': 'r',
+                'expires_at': time.time() + 3600}
+
+    monkeypatch.setattr(ExtendedOAuth, '_refresh_access_token', refresh)
+    old = {'access_token': 'old', 'refresh_token': 'r',
+           'expires_at': time.time()}
+    manager = TokenManager(old, {'client_id': 'id', 'client_secret': 's'})
+
+    # A failed refresh keeps the old token and is tried again
+    with pytest.raises(Exception):
+        manager.get_token()
+    assert manager.token is old
+    failing[0] = False
+    del calls[:]
+
+    tokens = []
+
+    def get():
+        barrier.wait()
+        tokens.append(manager.get_token()['access_token'])
+
+    threads = [threading.Thread(target=get) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert tokens == ['new']*8
+    assert len(calls) == 1
+
+
+def test_scheduler_retries_after_429():
+    from playlistcake.ratelimit import Scheduler
+
+    class Response(object):
+        def __init__(self, status_code, headers=None):
+            self.status_code = status_code
+            self.headers = headers or {}
+
+        def close(self):
+            pass
+
+    responses = [Response(429, {'Retry-After': '0.01'}), Response(200)]
+    scheduler = Scheduler(rate=100, max_concurrency=4)
+    response = scheduler.request(lambda: responses.pop(0), 'tracks')
+    assert response.status_code == 200
+    assert scheduler.metrics()['tracks']['throttled'] == 1
+    assert scheduler.concurrency == 2
+
+    # Http date Retry-After (in the past, so no wait)
+    responses = [Response(429, {'Retry-After':
+                                'Wed, 21 Oct 2015 07:28:00 GMT'}),
+                 Response(200)]
+    assert scheduler.request(lambda: responses.pop(0)).status_code == 200
+
+    # Errors after sending don't leak concurrency slots
+    class Broken(Response):
+        @property
+        def headers(self):
+            raise ValueError('bad headers')
+
+        @headers.setter
+        def headers(self, value):
+            pass
+
+    assert Scheduler().bucket is None
+
+    scheduler = Scheduler(rate=None, max_concurrency=1, min_concurrency=1)
+    for i in range(3):
+        with pytest.raises(ValueError):
+            scheduler.request(lambda: Broken(429))
+    assert scheduler._active == 0
+
+
+def test_tuneables_predicate():
+    from playlistcake.filters import compile_tuneables
+    tracks = [
+        {'id': 'a', 'popularity': 50, 'audio_features': {'energy': 0.8}},
+        {'id': 'b', 'popularity': 50, 'audio_features': {'energy': 0.2}},
+        {'id': 'c', 'popularity': 90, 'audio_features': None}]
+    predicate = compile_tuneables(min_energy=0.5, target_popularity=50)
+    assert predicate.batch(tracks) == [True, False, False]
+    assert [predicate(t) for t in tracks] == [True, False, False]
+
+    predicate = compile_tuneables(missing='include', min_energy=0.5)
+    assert predicate.batch(tracks) == [True, False, True]
+
+    predicate = compile_tuneables(margins={'energy': 0.3}, energy=0.5)
+    assert predicate.batch(tracks) == [True, True, False]
+
+
+def test_feature_store_query_sort_and_load(tmpdir):
+    import numpy as np
+    from playlistcake.featurestore import FeatureStore, FIELDS
+    columns = {field: np.full(3, np.nan) for field in FIELDS}
+    columns['energy'] = np.array([0.9, 0.1, np.nan])
+    columns['popularity'] = np.array([10., 30., 20.])
+    store = FeatureStore(['a', 'b', 'c'], columns)
+
+    assert store.select(min_energy=0.5) == ['a']
+    assert store.select(missing='include', min_energy=0.5) == ['a', 'c']
+    assert list(store.query(['c', 'x', 'a'], min_energy=0.5)) == [
+        False, False, True]
+    assert store.sorted_ids('popularity', order='desc') == ['b', 'c', 'a']
+    assert store.sorted_ids('energy') == ['b', 'a', 'c']
+
+    store.save(str(tmpdir))
+    loaded = FeatureStore.load(str(tmpdir))
+    assert isinstance(loaded.columns['energy'], np.memmap)
+    assert loaded.select(max_popularity=20) == ['a', 'c']
+
+
+def test_sort_limit_and_chunked():
+    import random
+    from playlistcake.sources import sort
+    items = [{'id': str(i), 'n': random.randint(0, 50)} for i in range(500)]
+    expected = sorted(items, key=lambda x: x['n'], reverse=True)
+
+    top = list(sort(items, lambda x: x['n'], order='desc', limit=10))
+    assert top == expected[:10]
+    chunked = list(sort(items, lambda x: x['n'], order='desc', chunk_size=64))
+    assert chunked == expected
+
+
+def test_shuffle_modes():
+    import itertools
+    from playlistcake.sources import shuffle
+    items = list(range(1000))
+    for kwargs in ({}, {'buffer_size': 50}, {'spill_buckets': 8}):
+        first = list(shuffle(items, seed=1, **kwargs))
+        assert sorted(first) == items
+        assert first != items
+        assert first == list(shuffle(items, seed=1, **kwargs))
+
+    pulled = []
+
+    def source():
+        for i in items:
+            pulled.append(i)
+            yield i
+
+    next(shuffle(source(), buffer_size=50))
+    assert len(pulled) == 51
+
+
+def test_dedup_modes():
+    from playlistcake.dedup import seen_set, compact_key
+    assert compact_key('0abc') != compact_key('abc')
+    ids = ['4iV5W9uYEdYUVa79Axb7Rh', '1301WleyT98MSxVHPZCA6M']
+    for mode in ('exact', 'approximate', 'window'):
+        seen = seen_set(mode)
+        assert [seen.add(i) for i in ids + ids] == [True, True, False, False]
+        assert ids[0] in seen
+
+    window = seen_set('window', window=1)
+    assert [window.add(i) for i in ['a', 'b', 'a']] == [True, True, True]
+
+
+def test_prefetch_forwards_items_errors_and_content_type():
+    from playlistcake.sources import prefetch
+    from playlistcake.genutils import yields, content_type
+
+    @yields('tracks')
+    def tracks(fail=False):
+        yield {'id': 'a'}
+        yield {'id': 'b'}
+        if fail:
+            raise KeyError('upstream')
+
+    stream = prefetch(tracks(), depth=2)
+    assert content_type(stream) == 'tracks'
+    assert [t['id'] for t in stream] == ['a', 'b']
+    with pytest.raises(KeyError):
+        list(prefetch(tracks(fail=True)))
+
+
+def test_coalescer_batches_concurrent_lookups():
+    import threading
+    from playlistcake.batching import Coalescer
+    calls = []
+
+    def fetch(ids):
+        calls.append(ids)
+        return [{'id': i} for i in ids]
+
+    coalescer = Coalescer(fetch, batch_size=4, window=0.05)
+    results = {}
+
+    def lookup(ids):
+        results[ids[0]] = coalescer.get_many(ids)
+
+    threads = [threading.Thread(target=lookup, args=(ids,))
+               for ids in (['a', 'b'], ['c', 'a'], ['d', 'e'])]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert results['c'] == [{'id': 'c'}, {'id': 'a'}]
+    assert sorted(i for ids in calls for i in ids) == ['a', 'b', 'c', 'd', 'e']
+    assert len(calls) == 2
+
+    # Short results fail the callers left over instead of hanging
+    short = Coalescer(lambda ids: [{'id': i} for i in ids[:1]],
+                      batch_size=4, window=0.01)
+    with pytest.raises(KeyError):
+        short.get_many(['x', 'y'])
+    assert short.get_many(['x']) == [{'id': 'x'}]
+
+
+def test_batch_recommendations_dedup(monkeypatch):
+    from playlistcake import recommendations
+    from playlistcake.genutils import yields
+    seeds = []
+
+    def fake_recommendations(seed_artists, seed_tracks, seed_genres,
+                             max_results, **tuneables):
+        seeds.append(seed_artists)
+        return [{'id': 't' + a} for a in seed_artists]
+
+    monkeypatch.setattr(recommendations, 'recommendations',
+                        fake_recommendations)
+
+    @yields('artists')
+    def artists():
+        for aid in ['a', 'b', 'a', 'c', 'b']:
+            yield {'id': aid}
+
+    tracks = list(recommendations.batch_recommendations(
+        artists(), seed_size=2, dedup='window'))
+    assert seeds == [['a', 'b'], ['c']]
+    assert len(tracks) == 3
+    with pytest.raises(ValueError):
+        list(recommendations.batch_recommendations(
+            artists(), dedup='unknown'))
+
+
+def test_playlist_sync_plan():
+    import random
+    from playlistcake.playlists import _plan_removals, _plan_moves
+
+    def apply_plan(current, desired):
+        removals, additions = _plan_removals(current, desired)
+        result = [uri for i, uri in enumerate(current)
+                  if i not in set(removals)] + additions
+        moves = _plan_moves(result, desired)
+        for start, before, length in moves:
+            block = result[start:start + length]
+            if before > start:
+                result[before:before] = block
+                del result[start:start + length]
+            else:
+                del result[start:start + length]
+                result[before:before] = block
+        return result, moves
+
+    for i in range(200):
+        pool = [str(n) for n in range(random.randint(1, 20))]
+        current = [random.choice(pool) for n in range(random.randint(0, 30))]
+        desired = [random.choice(pool) for n in range(random.randint(0, 30))]
+        assert apply_plan(current, desired)[0] == desired
+
+    desired = [str(n) for n in range(300)]
+    current = desired[100:] + desired[:100]
+    assert apply_plan(current, desired)[1] == [(200, 0, 100)]
+
+
+def test_saved_tracks_delta(tmpdir, monkeypatch):
+    import json
+    from datetime import datetime
+    from playlistcake import library, sessionenv
+
+    def saved(ids):
+        return [{'added_at': '2017-01-{:02d}T00:00:00Z'.format(int(i)),
+                 'track': {'id': i}} for i in ids]
+
+    class FakeSpotify(object):
+        def __init__(self, items):
+            self.items = items
+            self.requests = 0
+
+        def _page(self, offset):
+            self.requests += 1
+            nxt = offset + 2 if offset + 2 < len(self.items) else None
+            return {'items': self.items[offset:offset+2],
+                    'total': len(self.items), 'next': nxt}
+
+        def current_user_saved_tracks(self, limit):
+            return self._page(0)
+
+        def next(self, result):
+            return self._page(result['next'])
+
+    fake = FakeSpotify(saved(['05', '04', '03', '02', '01']))
+    monkeypatch.setattr(library, 'get_spotify', lambda: fake)
+    monkeypatch.setattr(library, 'current_user', lambda: {'id': 'me'})
+    monkeypatch.setattr(library, 'iterate_results',
+                        lambda endpoint, limit: iter(fake.items))
+    library.set_library_dir(str(tmpdir))
+    try:
+        ids = lambda: [t['id'] for t in library.saved_tracks(
+            track_only=True, delta=True)]
+        assert ids() == ['05', '04', '03', '02', '01']
+        fake.items = saved(['07', '06']) + fake.items
+        fake.requests = 0
+        assert ids() == ['07', '06', '05', '04', '03', '02', '01']
+        assert fake.requests == 2
+        # A removed track makes the totals differ, so all is refetched
+        fake.items = saved(['07', '05', '04', '03', '02', '01'])
+        assert ids() == ['07', '05', '04', '03', '02', '01']
+        # One removed, one added: the counts don't add up
+        fake.items = saved(['08', '07', '05', '04', '02', '01'])
+        assert ids() == ['08', '07', '05', '04', '02', '01']
+        # Newest removed, an older one added: the same total, but
+        # the page where paging stops doesn't match the snapshot
+        fake.items = saved(['07', '05', '04', '02', '01', '00'])
+        assert ids() == ['07', '05', '04', '02', '01', '00']
+        # A snapshot cut short by a crash is read as empty
+        path = tmpdir.join('me-current_user_saved_tracks.json')
+        path.write(path.read()[:20])
+        assert ids() == ['07', '05', '04', '02', '01', '00']
+        assert json.loads(path.read())['high_water_mark'][1] == '07'
+        assert tmpdir.listdir('*.tmp') == []
+    finally:
+        sessionenv.set('library_dir', None)
+
+    items = saved(['09', '05', '03', '01'])
+    since = datetime(2017, 1, 4)
+    assert [t['id'] for t in library.library_filter_added_at(
+        iter(items), start=since)] == ['09', '05']
+
+
+def test_replay_session_records_and_replays(tmpdir):
+    from playlistcake.replay import (
+        ReplaySession, MissingRecording, make_response)
+
+    class FakeSession(object):
+        def __init__(self):
+            self.sent = 0
+
+        def request(self, method, url, params=None, data=None, **kwargs):
+            self.sent += 1
+            return make_response(url, body='{"n": %d}' % self.sent)
+
+    path = str(tmpdir.join('cassette.json'))
+    recorder = ReplaySession(path, mode='record', session=FakeSession())
+    url = 'https://api.spotify.com/v1/albums'
+    for i in range(2):
+        recorder.request('GET', url, params={'ids': 'a,b', 'market': None})
+    recorder.save()
+
+    replay = ReplaySession(path, latency=0.01)
+    start = time.monotonic()
+    results = [replay.request('GET', url, params={'ids': 'a,b'}).json()
+               for i in range(3)]
+    assert time.monotonic() - start >= 0.03
+    assert results == [{'n': 1}, {'n': 2}, {'n': 2}]
+    assert replay.counts == {'albums': 3}
+    with pytest.raises(MissingRecording):
+        replay.request('GET', url, params={'ids': 'c'})
+
+
+def test_fake_server_pipelines(fake_api, monkeypatch):
+    from spotipy.client import SpotifyException
+    from playlistcake import playlists
+    from playlistcake.fakeserver import Catalogue
+    from playlistcake.ratelimit import Scheduler
+    from playlistcake.library import saved_tracks, followed_artists
+    from playlistcake.sources import (
+        with_audio_features, artists_albums, find_artist)
+    from playlistcake.playlists import (
+        create_playlist, sync_playlist, playlist_uris)
+
+    catalogue = Catalogue(artists=20, saved_tracks=120,
+                          followed_artists=30, playlists=0)
+    server = fake_api(catalogue, Scheduler(rate=None, max_retries=20),
+                      error_rate=0.1, retry_after=0, seed=0)
+    tracks = list(with_audio_features(
+        saved_tracks(max_results=110, track_only=True)))
+    assert len(tracks) == 110
+    assert all(t['audio_features']['id'] == t['id'] for t in tracks)
+
+    artists = list(followed_artists())
+    assert sorted(a['id'] for a in artists) == catalogue.followed
+    albums = list(artists_albums(artists[:3]))
+    assert albums and all('tracks' in a for a in albums)
+    assert find_artist('Artist 7')['name'] == 'Artist 7'
+
+    playlist = create_playlist('synced')
+    uris = [t['uri'] for t in tracks]
+    sync_playlist(tracks, playlist)
+    assert playlist_uris(playlist) == uris
+    sync_playlist(tracks[50:] + tracks[:10], playlist)
+    assert playlist_uris(playlist) == uris[50:] + uris[:10]
+
+    # Unavailable tracks are skipped and kept at the end
+    items = catalogue.playlists[playlist['id']]['tracks']
+    items.insert(3, {'added_at': '2017-01-01T00:00:00Z', 'track': None})
+    assert playlist_uris(playlist) == uris[50:] + uris[:10]
+    sync_playlist(tracks[:20], playlist)
+    assert playlist_uris(playlist) == uris[:20]
+    assert items[-1]['track'] is None
+
+    # Changes made since reading the playlist make it fail
+    read = playlists._read_playlist
+
+    def read_then_change(playlist):
+        state = read(playlist)
+        catalogue.playlists[playlist['id']]['snapshot_id'] = 'changed'
+        return state
+
+    monkeypatch.setattr(playlists, '_read_playlist', read_then_change)
+    with pytest.raises(SpotifyException):
+        sync_playlist(tracks[5:20], playlist)
+    assert playlist_uris(playlist) == uris[:20]
+    metrics = server.metrics()
+    assert sum(m['throttled'] for m in metrics.values()) > 0
+
+
+def test_sync_reshuffled_playlist(fake_api):
+    import random
+    from playlistcake.fakeserver import Catalogue
+    from playlistcake.playlists import (
+        create_playlist, sync_playlist, playlist_uris)
+
+    catalogue = Catalogue(artists=100, albums_per_artist=2, playlists=0)
+    server = fake_api(catalogue)
+    uris = ['spotify:track:' + tid for tid in sorted(catalogue.tracks)]
+    assert len(uris) >= 1000
+    uris = uris[:1000]
+    playlist = create_playlist('reshuffled')
+    sync_playlist(uris, playlist)
+    before = server.metrics()
+    random.shuffle(uris)
+    sync_playlist(uris, playlist)
+    after = server.metrics()
+    # Reading the playlist, then one replace and 9 adds
+    assert sum(m['requests'] for m in after.values()) - sum(
+        m['requests'] for m in before.values()) == 10 + 10
+    assert playlist_uris(playlist) == uris
+
+
+def test_artists_albums_pages_in_artist_order(fake_api):
+    import asyncio
+    from playlistcake.fakeserver import Catalogue
+    from playlistcake import sources
+    from playlistcake.sources import artists_albums
+    from playlistcake.aio import sources as asources, spotify as aspotify
+    from playlistcake.aio.util import alist
+
+    catalogue = Catalogue(artists=3, albums_per_artist=70,
+                          tracks_per_album=1, saved_tracks=0, playlists=0)
+    fake_api(catalogue)
+    artists = sorted(catalogue.artists)
+    expected = [aid for artist in artists
+                for aid in catalogue.artist_albums[artist]
+                if catalogue.albums[aid]['album_type'] == 'album']
+    assert all(len(catalogue.artist_albums[a]) > 50 for a in artists)
+
+    for workers in (None, 3):
+        albums = list(artists_albums(artists, workers=workers))
+        assert [a['id'] for a in albums] == expected
+
+    async def run(workers):
+        try:
+            return await alist(asources.artists_albums(
+                artists, workers=workers))
+        finally:
+            await aspotify.close()
+
+    for workers in (None, 3):
+        albums = asyncio.run(run(workers))
+        assert [a['id'] for a in albums] == expected
+
+    async def top_tracks(workers):
+        try:
+            return await alist(asources.artists_top_tracks(
+                artists, workers=workers))
+        finally:
+            await aspotify.close()
+
+    expected = [t['id'] for a in artists
+                for t in sources.artists_top_tracks([a])]
+    assert len(expected) == 30
+    for workers in (None, 3):
+        tracks = asyncio.run(top_tracks(workers))
+        assert [t['id'] for t in tracks] == expected
+
+
+def test_filter_release_years_of_tracks(fake_api, monkeypatch):
+    from playlistcake import filters
+    from playlistcake.fakeserver import Catalogue
+    from playlistcake.genutils import yields
+    from playlistcake.filters import filter_release_years, release_year
+
+    assert release_year({'release_date': '1983',
+                         'release_date_precision': 'year'}) == 1983
+    assert release_year({'release_date': '1983-09',
+                         'release_date_precision': 'month'}) == 1983
+
+    @yields('albums')
+    def albums():
+        yield {'id': 'a', 'release_date': '1983'}
+        yield {'id': 'b', 'release_date': '1999-02'}
+        yield {'id': 'c', 'release_date': '2004-02-01'}
+
+    assert [a['id'] for a in filter_release_years(
+        albums(), 1980, 1999)] == ['a', 'b']
+    assert [a['id'] for a in filter_release_years(
+        albums(), 1980, 1999, invert=True)] == ['c']
+
+    catalogue = Catalogue(artists=10, tracks_per_album=2, playlists=0)
+    fake_api(catalogue)
+    tracks = list(catalogue.tracks.values())
+
+    def in_range(track):
+        return 1980 <= release_year(catalogue.albums[
+            track['album']['id']]) <= 1999
+
+    @yields('tracks')
+    def full_tracks():
+        yield from tracks
+
+    @yields('tracks')
+    def simple_album_tracks():
+        for track in tracks:
+            yield dict(track, album={'id': track['album']['id']})
+
+    # Tracks with release dates need no album lookups
+    monkeypatch.setattr(filters, 'several_albums', None)
+    kept = list(filter_release_years(full_tracks(), 1980, 1999))
+    assert kept == [t for t in tracks if in_range(t)]
+    dropped = list(filter_release_years(full_tracks(), 1980, 1999,
+                                        invert=True))
+    assert dropped == [t for t in tracks if not in_range(t)]
+    assert kept and dropped
+    assert all(t['type'] == 'track' for t in dropped)
+    monkeypatch.undo()
+
+    kept = list(filter_release_years(simple_album_tracks(), 1980, 1999))
+    assert [t['id'] for t in kept] == [t['id'] for t in tracks
+                                       if in_range(t)]
+    dropped = list(filter_release_years(simple_album_tracks(), 1980, 1999,
+                                        invert=True))
+    assert [t['id'] for t in dropped] == [t['id'] for t in tracks
+                                          if not in_range(t)]
+
+
+def test_tracks_from_albums(fake_api):
+    from playlistcake.fakeserver import Catalogue
+    from playlistcake.sources import several_albums, tracks_from_albums
+
+    catalogue = Catalogue(artists=1, albums_per_artist=2,
+                          tracks_per_album=120, saved_tracks=0, playlists=0)
+    server = fake_api(catalogue)
+    albums = list(several_albums(list(catalogue.albums)))
+    assert all(len(a['tracks']['items']) == 50 for a in albums)
+    expected = [t['id'] for a in catalogue.albums.values()
+                for t in a['tracks']]
+
+    simple = list(tracks_from_albums(albums, full=False))
+    assert [t['id'] for t in simple] == expected
+    assert all(t['album']['id'] in catalogue.albums and
+               'tracks' not in t['album'] for t in simple)
+    # Pages past the first 50 tracks, but no track lookups
+    assert server.metrics()['albums/{id}/tracks']['requests'] == 4
+    assert 'tracks' not in server.metrics()
+
+    tracks = list(tracks_from_albums(albums))
+    assert len(tracks) == 240
+    assert [t['id'] for t in tracks] == expected
+    assert tracks[0]['popularity'] == catalogue.tracks[expected[0]][
+        'popularity']
+    # Each track only once when albums come twice
+    assert [t['id'] for t in tracks_from_albums(albums*2)] == expected
+
+
+def test_current_user_is_cached(fake_api):
+    from playlistcake.fakeserver import Catalogue
+    from playlistcake.spotify import current_user, set_session_token
+
+    server = fake_api(Catalogue(artists=1, saved_tracks=0, playlists=0))
+    for i in range(3):
+        assert current_user()['id'] == server.catalogue.user['id']
+    assert server.metrics()['me']['requests'] == 1
+    set_session_token(server.token())
+    current_user()
+    assert server.metrics()['me']['requests'] == 2
+
+
+def test_iterate_results_parallel_pages(fake_api):
+    from playlistcake.fakeserver import Catalogue
+    from playlistcake.spotify import iterate_results
+
+    catalogue = Catalogue(artists=30, saved_tracks=230,
+                          followed_artists=25, playlists=0)
+    # Jitter makes pages finish out of order
+    server = fake_api(catalogue, jitter=0.02)
+    expected = [item['track']['id'] for item in catalogue.saved_tracks]
+
+    items = list(iterate_results('current_user_saved_tracks',
+                                 limit=50, workers=4))
+    assert [item['track']['id'] for item in items] == expected
+    assert server.metrics()['me/tracks']['requests'] == 5
+
+    items = list(iterate_results('current_user_saved_tracks', limit=50,
+                                 max_results=120, workers=4))
+    assert [item['track']['id'] for item in items] == expected[:120]
+    assert server.metrics()['me/tracks']['requests'] == 5 + 3
+
+    # Cursor paged results follow next urls
+    artists = list(iterate_results(
+        'current_user_followed_artists', items_path=['artists', 'items'],
+        next_path=['artists', 'next'], limit=10, workers=4))
+    assert sorted(a['id'] for a in artists) == sorted(catalogue.followed)
+    assert server.metrics()['me/following']['requests'] == 3
+
+
+def test_async_requests_go_through_scheduler(fake_api):
+    import asyncio
+    from playlistcake.fakeserver import Catalogue
+    from playlistcake.ratelimit import Scheduler
+    from playlistcake.aio import spotify as aspotify
+    from playlistcake.aio.util import alist
+
+    scheduler = Scheduler(rate=50, burst=1, max_retries=20)
+    fake_api(Catalogue(artists=5, saved_tracks=200, playlists=0),
+             scheduler, error_rate=0.2, retry_after=0, seed=1)
+
+    async def run():
+        try:
+            return await alist(aspotify.iterate_results(
+                'current_user_saved_tracks', limit=20, workers=4))
+        finally:
+            await aspotify.close()
+
+    start = time.monotonic()
+    assert len(asyncio.run(run())) == 200
+    metrics = scheduler.metrics()['me/tracks']
+    assert metrics['throttled'] > 0
+    assert metrics['requests'] == 10 + metrics['throttled']
+    # 50 per second with a burst of 1
+    assert time.monotonic() - start >= (metrics['requests'] - 1)/50
+
+
+def test_async_http_session_per_loop(fake_api):
+    import asyncio
+    import threading
+    from playlistcake.fakeserver import Catalogue
+    from playlistcake.aio import spotify as aspotify
+
+    server = fake_api(Catalogue(artists=1, saved_tracks=0, playlists=0))
+
+    async def me(close=False):
+        try:
+            s = await aspotify.get_spotify()
+            return (await s.current_user())['id']
+        finally:
+            if close:
+                await aspotify.close()
+
+    user = server.catalogue.user['id']
+    # The session of a finished loop isn't reused
+    assert asyncio.run(me()) == user
+    assert asyncio.run(me()) == user
+    results = []
+    thread = threading.Thread(
+        target=lambda: results.append(asyncio.run(me(close=True))))
+    thread.start()
+    thread.join()
+    assert results == [user]
+    assert asyncio.run(me(close=True)) == user
+
+
+def test_stage_instrumentation():
+    import json
+    from playlistcake import instrument
+    from playlistcake.genutils import yields, infer_content, content_type
+
+    @yields('tracks')
+    def source(n):
+        for i in range(n):
+            instrument.record_request('tracks', 100)
+            yield {'id': str(i)}
+
+    @infer_content
+    def slow_filter(items):
+        for item in items:
+            time.sleep(0.001)
+            if int(item['id']) % 2:
+                yield item
+
+    assert not isinstance(source(1), instrument._Stage)
+    collector = instrument.MemoryCollector()
+    instrument.set_collector(collector)
+    try:
+        gen = slow_filter(source(10))
+        assert content_type(gen) == 'tracks'
+        assert len(list(itertools.islice(gen, 3))) == 3
+        gen.close()
+    finally:
+        instrument.set_collector(None)
+    src, filt = collector.stages
+    assert (src.items_out, src.requests, src.bytes) == (6, 6, 600)
+    assert src.consumer == filt.id and filt.inputs == [src.id]
+    assert (filt.items_in, filt.items_out) == (6, 3)
+    assert filt.own_time >= 0.005 > src.own_time
+    assert filt.finished
+    summary = json.loads(collector.to_json())['summary']
+    assert summary['tests.test_stage_instrumentation.<locals>.source']['runs'] == 1
+
+
+def test_pipeline_explain_and_budget(fake_api):
+    from playlistcake.fakeserver import Catalogue
+    from playlistcake.library import saved_tracks, followed_artists
+    from playlistcake.filters import tracks_filter_tuneables
+    from playlistcake.sources import sort, artists_albums
+    from playlistcake.explain import Pipeline, BudgetExceeded
+
+    fake_api(Catalogue(artists=30, albums_per_artist=3,
+                       saved_tracks=120, followed_artists=20))
+    sizes = {'saved_tracks': 120, 'followed_artists': 20,
+             'artist_albums': 3}
+    pipeline = Pipeline(lambda: sort(
+        tracks_filter_tuneables(
+            saved_tracks(track_only=True), min_energy=0.2),
+        lambda t: t['popularity'], limit=10), sizes=sizes)
+    assert pipeline.estimated_requests() == 3 + 2
+    assert len(list(pipeline.run())) == 10
+    assert sorted(pipeline.actual_requests().values()) == [0, 2, 3]
+    assert 'actual requests: 5' in pipeline.explain()
+
+    pipeline = Pipeline(
+        lambda: artists_albums(followed_artists()),
+        budget=10, sizes=sizes)
+    assert pipeline.estimated_requests() == 1 + 20 + 3
+    with pytest.raises(BudgetExceeded):
+        list(pipeline.run(check_estimate=True))
+    assert pipeline.collector.requests == 0
+    with pytest.raises(BudgetExceeded):
+        list(pipeline.run())
+    assert pipeline.aborted
+    assert pipeline.collector.requests == 10
+
+
+def test_pipeline_counts_only_its_own_requests(fake_api):
+    from playlistcake.fakeserver import Catalogue
+    from playlistcake.library import saved_tracks, followed_artists
+    from playlistcake.explain import Pipeline
+    from playlistcake import instrument
+    from playlistcake.spotify import get_spotify
+
+    fake_api(Catalogue(artists=30, albums_per_artist=3,
+                       saved_tracks=120, followed_artists=20))
+    pipeline = Pipeline(lambda: saved_tracks(track_only=True), budget=3)
+    for track in pipeline.run():
+        # The consumer's requests are neither counted nor budgeted
+        get_spotify().track(track['id'])
+    assert not pipeline.aborted
+    assert pipeline.collector.requests == 3
+    assert instrument.get_collector() is None
+
+    tracks = Pipeline(lambda: saved_tracks(track_only=True))
+    artists = Pipeline(lambda: followed_artists())
+    assert len(list(zip(tracks.run(), artists.run()))) == 20
+    assert tracks.collector.requests == 1
+    assert artists.collector.requests == 1
+    assert instrument.get_collector() is None
+
+
+def test_pipeline_spec_planning(fake_api):
+    from playlistcake.fakeserver import Catalogue
+    from playlistcake.explain import Pipeline
+    from playlistcake.pipeline import plan, build
+
+    # Two copies of the library, so every track comes twice
+    spec = {
+        'source': [{'stage': 'saved_tracks', 'track_only': True}]*2,
+        'steps': [
+            {'stage': 'with_audio_features'},
+            {'stage': 'tracks_filter_tuneables', 'min_energy': 0.2},
+            {'stage': 'filter_unique'},
+            {'stage': 'sort', 'key': 'audio_features.tempo',
+             'audio_features': True},
+        ],
+        'max_results': 20,
+    }
+    planned = plan(spec)
+    assert [s['stage'] for s in planned['steps']] == [
+        'filter_unique', 'with_audio_features', 'tracks_filter_tuneables',
+        'sort', 'limit']
+    assert planned['steps'][3]['audio_features'] is False
+    assert planned['steps'][3]['limit'] == 20
+    assert all('max_results' not in s for s in planned['source'])
+
+    mapped = plan({'source': {'stage': 'saved_tracks', 'track_only': True},
+                   'steps': [{'stage': 'with_audio_features'},
+                             {'stage': 'prefetch'}],
+                   'max_results': 30})
+    assert mapped['source']['max_results'] == 30
+    # Limits don't pass filters
+    filtered = plan({'source': {'stage': 'saved_tracks'},
+                     'steps': [{'stage': 'tracks_filter_artist_variety'}],
+                     'max_results': 30})
+    assert 'max_results' not in filtered['source']
+    with pytest.raises(ValueError):
+        plan({'source': {'stage': 'sort'}})
+
+    fake_api(Catalogue(artists=30, saved_tracks=300))
+    results = {}
+    for optimize in (False, True):
+        pipeline = Pipeline(lambda: build(spec, optimize))
+        results[optimize] = list(pipeline.run())
+        results[optimize, 'requests'] = pipeline.collector.requests
+    assert results[True] == results[False]
+    assert len(results[True]) == 20
+    assert results[True, 'requests'] < results[False, 'requests']
+    fewer = Pipeline(lambda: build(mapped))
+    assert len(list(fewer.run())) == 30
+    assert fewer.collector.requests == 2
+
+
+def test_sessions_per_context():
+    import asyncio
+    import threading
+    from concurrent.futures import ThreadPoolExecutor
+    from playlistcake import sessionenv, cache
+    from playlistcake.fakeserver import FakeSpotifyServer, Catalogue
+    from playlistcake.ratelimit import Scheduler
+    from playlistcake.spotify import current_user
+    from playlistcake.library import saved_tracks
+    from playlistcake.aio import spotify as aspotify
+
+    seen = []
+    thread = threading.Thread(
+        target=lambda: seen.append(sessionenv.get('missing', 'default')))
+    thread.start()
+    thread.join()
+    assert seen == ['default']
+
+    servers = [FakeSpotifyServer(Catalogue(artists=5, saved_tracks=40,
+                                           user_id=name)).start()
+               for name in ('alice', 'bob')]
+    scheduler = Scheduler(rate=None)
+
+    def user_session(server):
+        return sessionenv.session(
+            token=server.token(), scheduler=scheduler, cache=cache.MemoryCache(),
+            spotify_kwargs=server.spotify_kwargs(), page_workers=4)
+
+    def work(server):
+        with user_session(server):
+            tracks = list(saved_tracks(track_only=True))
+            return current_user()['id'], [t['id'] for t in tracks]
+
+    async def awork(server):
+        with user_session(server):
+            try:
+                return (await aspotify.current_user())['id']
+            finally:
+                await aspotify.close()
+
+    async def arun():
+        return await asyncio.gather(*[awork(s) for s in servers*4])
+
+    try:
+        with ThreadPoolExecutor(8) as executor:
+            results = list(executor.map(work, servers*4))
+        for server, (user, ids) in zip(servers*4, results):
+            assert user == server.catalogue.user['id']
+            assert ids == [item['track']['id']
+                           for item in server.catalogue.saved_tracks]
+        assert asyncio.run(arun()) == ['alice', 'bob']*4
+        assert sessionenv.get('spotify_token') is None
+    finally:
+        for server in servers:
+            server.stop()
+
+
+def test_batch_runner(tmpdir, monkeypatch):
+    import json
+    from playlistcake import batch
+    from playlistcake.fakeserver import FakeSpotifyServer, Catalogue
+
+    spec = {'source': {'stage': 'saved_tracks', 'track_only': True},
+            'steps': [{'stage': 'tracks_filter_tuneables',
+                       'min_energy': 0.2}],
+            'max_results': 20}
+    checkpoint = str(tmpdir.join('batch.jsonl'))
+    with FakeSpotifyServer(Catalogue(
+            artists=10, saved_tracks=60, playlists=0)) as server:
+        users = [{'id': 'user{}'.format(i), 'token': server.token()}
+                 for i in range(4)]
+        kwargs = dict(playlist='Mix {user}', workers=2, rate=None,
+                      cache_path=str(tmpdir.join('cache.sqlite')),
+                      checkpoint=checkpoint, backoff=0,
+                      spotify_kwargs=server.spotify_kwargs(),
+                      verbose=False)
+        run_once = batch._run_once
+
+        def slow_first_user(user, config):
+            if user['id'] == 'user0':
+                time.sleep(1)
+            return run_once(user, config)
+
+        # Worker processes are forked, so they see this
+        monkeypatch.setattr(batch, '_run_once', slow_first_user)
+        summary = batch.run_batch(users + [{'id': 'notoken'}], spec, **kwargs)
+        monkeypatch.undo()
+        assert summary['done'] == 4
+        assert summary['failed'] == 1
+        assert summary['failures'][0]['user'] == 'notoken'
+        assert summary['failures'][0]['attempts'] == 1
+        assert summary['tracks'] == 80
+        assert summary['requests'] > 0
+        # Users finishing behind a slow one are written first
+        with open(checkpoint) as f:
+            assert json.loads(f.readline())['user'] != 'user0'
+        names = sorted(p['name'] for p in server.catalogue.playlists.values())
+        assert names == ['Mix user{}'.format(i) for i in range(4)]
+        assert all(len(p['tracks']) == 20
+                   for p in server.catalogue.playlists.values())
+
+        # Resuming skips the users done and keeps the playlists
+        users.append({'id': 'user4', 'token': server.token()})
+        summary = batch.run_batch(users, spec, **dict(kwargs, workers=0))
+        assert (summary['done'], summary['skipped']) == (1, 4)
+        # rate=None means no rate limit in the workers
+        scheduler = batch._worker['scheduler']
+        assert scheduler.bucket is None
+        assert sum(m['wait'] for m in scheduler.metrics().values()) < 0.5
+        assert len(server.catalogue.playlists) == 5
+        assert set(batch.load_checkpoint(checkpoint)) == {
+            'user{}'.format(i) for i in range(5)}